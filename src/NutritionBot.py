@@ -19,9 +19,11 @@ from aiogram.types import (
 )
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+import config
 from config import *
 from enrollment import (
     existing_uids_from_rows,
+    NameIndex,
     find_row_by_candidate_name,
     parse_start_candidate,
     start_date_sheet_value,
@@ -44,16 +46,23 @@ from parser import (
     parse_sheet_weight,
     parse_weight_delta,
 )
-from report_status import report_row_status, red_report_uids
-from sheets import Sheets, GREEN, RED, DEFAULT_EXPORT_SCALE, normalize_uid_value
+from report_status import DayStatusSnapshot, report_row_status, red_report_uids
+from sheets import (
+    Sheets, GREEN, RED, DEFAULT_EXPORT_SCALE,
+    PRIORITY_BULK, PRIORITY_PING, request_priority,
+    bulkhead_stats, rate_limit_stats, close_sessions, normalize_uid_value, rows_from_columns,
+    start_user_row,
+)
 from exporter import pdf_to_jpeg
+from outbox import OUTBOX_PATH, SheetOutbox
 from schedule_utils import staggered_daily_time
 from state import (
-    mark_active, mark_excused, get_sets, save_mention, save_user, get_users,
-    set_excused_until, is_excused_today, parse_until_date, cleanup_expired_excused_until, remove_excused,
-    save_start_candidate, get_start_candidates, mark_start_candidate_imported,
-    cleanup_expired_manual_green, get_manual_green, remove_manual_green,
-    set_manual_green,
+    get_sets, get_users,
+    parse_until_date,
+    get_start_candidates,
+    get_manual_green,
+    configure as configure_state, flush as flush_state,
+    StateTransaction, transaction as state_transaction,
 )
 
 # -------------------------
@@ -76,9 +85,17 @@ def get_sc(chat_id : int) -> Sheets:
             cfg["SPREADSHEET_ID"],
             cfg["SHEET_NAME"],
             export_scale=cfg.get("EXPORT_SCALE", DEFAULT_EXPORT_SCALE),
+            rows_cache_ttl=cfg.get("ROWS_CACHE_TTL"),
         )
     return _sheets_cache[chat_id]
 
+# Записи из обработчиков сообщений уходят в таблицу фоном и пишутся в журнал на диске,
+# чтобы после сбоя или перезапуска отправиться повторно.
+sheet_outbox = SheetOutbox(OUTBOX_PATH, get_sc)
+
+def outbox_key(m: Message, suffix: str = "") -> str:
+    return f"{m.chat.id}:{m.message_id}{suffix}"
+
 def is_admin(chat_id: int, uid: int) -> bool:
     cfg = GROUPS.get(chat_id, {})
     admins = cfg.get("ADMINS", set())
@@ -145,6 +162,47 @@ def message_is_report(text: str) -> bool:
 
 from aiogram.filters import Command
 
+@dp.message(Command("sheetstats"))
+async def sheet_stats(m: Message):
+    if not m.from_user:
+        return
+
+    if m.from_user.id not in ADMIN_IDS:
+        await m.reply("⛔️ У тебя нет доступа к этой команде.")
+        return
+
+    stats = bulkhead_stats()
+    lines = []
+    for chat_id, cfg in GROUPS.items():
+        s = stats.get(cfg["SPREADSHEET_ID"])
+        if s is None:
+            continue
+        line = (
+            f"<code>{chat_id}</code>: в работе {s['in_flight']}, в очереди {s['queued']} "
+            f"(макс. {s['max_queued']}), запросов {s['calls']}, отказов {s['rejected']}, "
+            f"ожидание ср. {s['wait_avg']:.2f}с / макс. {s['wait_max']:.2f}с"
+        )
+        sc = _sheets_cache.get(chat_id)
+        if sc is not None:
+            c = sc.cache_stats()
+            line += (
+                f"; кэш строк: попаданий {c['hits']}, промахов {c['misses']}, правок {c['patches']}, "
+                f"подтверждено через Drive {c['revalidated']} из {c['probes']}, "
+                f"чтений отдельных колонок {c['column_fetches']}"
+            )
+        lines.append(line)
+
+    for (scope, _owner, kind), q in rate_limit_stats().items():
+        if scope != "account":
+            continue
+        lines.append(
+            f"квота аккаунта ({kind}): токенов {q['tokens']}, ждут {q['waiting']}, "
+            f"выдано {q['granted']}, с ожиданием {q['delayed']} (макс. {q['wait_max']:.2f}с), "
+            f"сбросов после 429: {q['drained']}"
+        )
+
+    await m.reply("\n".join(lines) if lines else "К таблицам пока не обращались.")
+
 @dp.message(Command("reportnow"))
 async def report_now(m: Message):
     if not m.from_user:
@@ -232,13 +290,14 @@ def mention_from_user(user) -> str:
     safe_name = html.escape((getattr(user, "full_name", None) or "участник").strip() or "участник")
     return f'<a href="tg://user?id={user.id}">{safe_name}</a>'
 
-def remember_chat_user(chat_id: int, user) -> bool:
+def remember_chat_user(chat_id: int, user, tx: StateTransaction | None = None) -> bool:
     if chat_id not in GROUPS or not user or getattr(user, "is_bot", False):
         return False
 
     uid = int(user.id)
-    save_mention(chat_id, uid, mention_from_user(user))
-    save_user(chat_id, uid, getattr(user, "username", None), getattr(user, "full_name", None))
+    with tx or state_transaction(chat_id) as group_state:
+        group_state.save_mention(uid, mention_from_user(user))
+        group_state.save_user(uid, getattr(user, "username", None), getattr(user, "full_name", None))
     return True
 
 def saved_user_name(info: dict) -> str:
@@ -263,18 +322,9 @@ def telegram_user_display_name(user) -> str:
 
     return "участник"
 
-def manual_green_entry_is_active(entry: dict[str, str] | None, today: date) -> bool:
-    if entry is None:
-        return False
-
-    until = str(entry.get("until", "") or "").strip()
-    if not until:
-        return True
-
-    try:
-        return today <= date.fromisoformat(until)
-    except Exception:
-        return False
+def day_status_snapshot(chat_id: int, day: date) -> DayStatusSnapshot:
+    excused, _active, _mentions, excused_until = get_sets(chat_id)
+    return DayStatusSnapshot.from_state(day, excused, excused_until, get_manual_green(chat_id))
 
 def manual_green_entry_sheet_value(entry: dict[str, str] | None) -> str:
     if entry is None:
@@ -304,25 +354,26 @@ def resolve_manual_green_target(m: Message):
 
     return None, "Ответом на чужое сообщение зелёную строку может ставить или убирать только админ."
 
-def ensure_manual_green_row(chat_id: int, sc: Sheets, user) -> int | None:
+async def ensure_manual_green_row(chat_id: int, sc: Sheets, user, key: str) -> int | None:
     uid = int(user.id)
-    row = sc.find_row_by_uid(uid)
+    row = await sc.find_row_by_uid(uid)
     if row is not None:
         return row
 
     if not AUTO_BIND_UID:
         return None
 
-    rows = sc.rows()
+    rows, names = await sc.rows_with_names()
     display_name = telegram_user_display_name(user)
-    found_row = find_row_by_fio_in_rows(rows, display_name)
+    found_row = find_row_by_fio_in_rows(rows, display_name, names)
     if found_row is not None:
-        sc.write(found_row, "J", uid)
+        sheet_outbox.enqueue(chat_id, f"{key}:bind", [["write", found_row, "J", uid]])
         return found_row
 
-    return sc.append_start_user(display_name, "", uid)
+    # The new row number is needed right away, so the append itself is not deferred.
+    return await sc.append_start_user(display_name, "", uid)
 
-async def handle_manual_green_command(m: Message, text: str, msg_dt: datetime) -> bool:
+async def handle_manual_green_command(m: Message, text: str, msg_dt: datetime, tx: StateTransaction) -> bool:
     command = parse_manual_green_command(text, msg_dt.date())
     if command is None:
         return False
@@ -338,30 +389,29 @@ async def handle_manual_green_command(m: Message, text: str, msg_dt: datetime) -
         await m.reply("Не поняла, кому ставить зелёную строку.")
         return True
 
-    remember_chat_user(m.chat.id, m.from_user)
-    remember_chat_user(m.chat.id, target_user)
+    remember_chat_user(m.chat.id, m.from_user, tx)
+    remember_chat_user(m.chat.id, target_user, tx)
 
     chat_id = m.chat.id
     target_uid = int(target_user.id)
     target_name = html.escape(telegram_user_display_name(target_user))
     sc = get_sc(chat_id)
-    row = ensure_manual_green_row(chat_id, sc, target_user)
+    key = outbox_key(m)
+    row = await ensure_manual_green_row(chat_id, sc, target_user, key)
     if row is None:
         await m.reply("Не нашла строку этого участника в таблице.")
         return True
 
     if command.action == "remove":
-        remove_manual_green(chat_id, target_uid)
-        remove_excused(chat_id, target_uid)
-        sc.write(row, "I", "")
-        sc.clear_row_background(row)
+        tx.remove_manual_green(target_uid)
+        tx.remove_excused(target_uid)
+        sheet_outbox.enqueue(chat_id, key, [["write", row, "I", ""], ["clear_row", row]])
         await m.reply(f"Ок, убрала зелёную строку для <b>{target_name}</b> и очистила колонку I.")
         return True
 
     until_iso = command.until.isoformat() if command.until else ""
-    set_manual_green(chat_id, target_uid, until_iso)
-    sc.write(row, "I", command.sheet_value)
-    sc.paint_row(row, GREEN)
+    tx.set_manual_green(target_uid, until_iso)
+    sheet_outbox.enqueue(chat_id, key, [["write", row, "I", command.sheet_value], ["paint_row", row, GREEN]])
 
     if command.until:
         await m.reply(
@@ -372,26 +422,6 @@ async def handle_manual_green_command(m: Message, text: str, msg_dt: datetime) -
 
     return True
 
-def update_local_user_row(rows: list[list], row: int, uid: int, start_date: str = ""):
-    row_index = row - 2
-    if not 0 <= row_index < len(rows):
-        return
-
-    while len(rows[row_index]) <= 9:
-        rows[row_index].append("")
-    if start_date:
-        while len(rows[row_index]) <= 8:
-            rows[row_index].append("")
-        rows[row_index][8] = start_date
-    rows[row_index][9] = str(uid)
-
-def append_local_user_row(rows: list[list], full_name: str, uid: int, start_date: str = ""):
-    new_row = [""] * 11
-    new_row[0] = full_name
-    new_row[8] = start_date
-    new_row[9] = str(uid)
-    rows.append(new_row)
-
 async def user_is_in_chat(chat_id: int, uid: int) -> bool:
     try:
         member = await bot.get_chat_member(chat_id, uid)
@@ -412,11 +442,14 @@ def saved_user_sort_key(item) -> int:
     except ValueError:
         return 0
 
-async def sync_known_chat_users(chat_id: int, sc: Sheets, rows: list[list], existing_uids: set[str]) -> tuple[int, int, int, int]:
+async def sync_known_chat_users(chat_id: int, sc: Sheets, existing_uids: set[str]) -> tuple[int, int, int, int]:
     added = 0
     linked_existing = 0
     skipped_no_name = 0
     skipped_not_in_chat = 0
+    # New rows go out in one append at the end; names queued so far still count as taken.
+    new_rows = []
+    new_names = NameIndex()
 
     for uid_raw, info in sorted(get_users(chat_id).items(), key=saved_user_sort_key):
         uid_key = normalize_uid_value(uid_raw)
@@ -440,22 +473,25 @@ async def sync_known_chat_users(chat_id: int, sc: Sheets, rows: list[list], exis
             skipped_no_name += 1
             continue
 
-        matched_row, matched_uid = find_row_by_candidate_name(rows, full_name)
+        # Our own writes and appends are already in the cached snapshot.
+        rows, names = await sc.rows_with_names()
+        matched_row, matched_uid = find_row_by_candidate_name(rows, full_name, names)
         if matched_row is not None and not matched_uid:
             sc.write(matched_row, "J", uid)
-            update_local_user_row(rows, matched_row, uid)
             linked_existing += 1
             existing_uids.add(uid_key)
             continue
 
         if matched_row is not None and matched_uid:
             continue
+        if find_row_by_candidate_name(new_rows, full_name, new_names)[0] is not None:
+            continue
 
-        sc.append_start_user(full_name, "", uid)
-        append_local_user_row(rows, full_name, uid)
-        added += 1
+        new_rows.append(start_user_row(full_name, "", uid))
+        new_names.add(len(new_rows) + 1, new_rows[-1])
         existing_uids.add(uid_key)
 
+    added = len(await sc.append_rows(new_rows))
     return added, linked_existing, skipped_no_name, skipped_not_in_chat
 
 def _tsv_value(value) -> str:
@@ -580,7 +616,7 @@ def parse_history_day(raw: str | None, base: date) -> date | None:
     except ValueError:
         return None
 
-def remember_start_candidate(m: Message, text: str, msg_dt: datetime) -> bool:
+def remember_start_candidate(m: Message, text: str, msg_dt: datetime, tx: StateTransaction) -> bool:
     if m.chat.id not in GROUPS or not m.from_user or getattr(m.from_user, "is_bot", False):
         return False
 
@@ -589,10 +625,8 @@ def remember_start_candidate(m: Message, text: str, msg_dt: datetime) -> bool:
         return False
 
     uid = m.from_user.id
-    save_mention(m.chat.id, uid, mention_from_user(m.from_user))
-    save_user(m.chat.id, uid, getattr(m.from_user, "username", None), getattr(m.from_user, "full_name", None))
-    save_start_candidate(
-        m.chat.id,
+    remember_chat_user(m.chat.id, m.from_user, tx)
+    tx.save_start_candidate(
         uid,
         candidate.full_name,
         candidate.start_date.isoformat(),
@@ -627,17 +661,12 @@ async def ping_red(m: Message):
         await m.reply("⛔️ У тебя нет доступа к этой команде.")
         return
 
-    cleanup_expired_excused_until(m.chat.id)
     today = datetime.now(tz).date()
-    cleanup_expired_manual_green(m.chat.id, today=today)
-    manual_green = get_manual_green(m.chat.id)
-
     sc = get_sc(m.chat.id)
-    red_uids = red_report_uids(
-        sc.rows(),
-        lambda uid: is_excused_today(m.chat.id, uid),
-        lambda uid: manual_green_entry_is_active(manual_green.get(str(uid)), today),
-    )
+    sc.invalidate()
+    with request_priority(PRIORITY_PING):
+        columns = await sc.columns("D", "E", "F", "G", "H", "J")
+    red_uids = red_report_uids(rows_from_columns(columns), snapshot=day_status_snapshot(m.chat.id, today))
 
     if not red_uids:
         await m.answer("Красных полосочек сейчас не нашла ✅")
@@ -661,88 +690,101 @@ async def scan_start_candidates(m: Message):
         await m.reply("⛔️ У тебя нет доступа к этой команде.")
         return
 
-    remember_chat_user(m.chat.id, m.from_user)
-
-    replied = getattr(m, "reply_to_message", None)
-    replied_parsed = False
-    if replied is not None:
-        if getattr(replied, "from_user", None):
-            remember_chat_user(m.chat.id, replied.from_user)
-        reply_text = get_msg_text(replied)
-        reply_dt = replied.date.astimezone(tz) if replied.date else datetime.now(tz)
-        replied_parsed = remember_start_candidate(replied, reply_text, reply_dt)
-
-    candidates = get_start_candidates(m.chat.id)
-    pending = {
-        uid: candidate
-        for uid, candidate in candidates.items()
-        if isinstance(candidate, dict) and not candidate.get("imported_at")
-    }
-    reply_notes = []
-    if not pending and replied is not None and not replied_parsed:
-        reply_notes.append("Не смогла разобрать сообщение, на которое ты ответила. Нужны ФИО и дата старта.")
-
-    now = datetime.now(tz)
-    sc = get_sc(m.chat.id)
-    rows = sc.rows()
-    existing_uids = existing_uids_from_rows(rows)
-
-    added = 0
-    linked_existing = 0
-    already_in_table = 0
-    duplicate_names = 0
-    invalid = 0
-
-    for uid_raw, candidate in sorted(pending.items(), key=lambda item: item[1].get("message_date", "")):
-        try:
-            uid = int(uid_raw)
-            start_date = date.fromisoformat(str(candidate.get("start_date", "")))
-        except Exception:
-            invalid += 1
-            continue
-
-        full_name = str(candidate.get("full_name", "")).strip()
-        if not full_name:
-            invalid += 1
-            continue
+    # Импорт пачкой не должен отнимать квоту у отчётов участников.
+    with request_priority(PRIORITY_BULK), state_transaction(m.chat.id) as tx:
+        remember_chat_user(m.chat.id, m.from_user, tx)
+
+        replied = getattr(m, "reply_to_message", None)
+        replied_parsed = False
+        if replied is not None:
+            if getattr(replied, "from_user", None):
+                remember_chat_user(m.chat.id, replied.from_user, tx)
+            reply_text = get_msg_text(replied)
+            reply_dt = replied.date.astimezone(tz) if replied.date else datetime.now(tz)
+            replied_parsed = remember_start_candidate(replied, reply_text, reply_dt, tx)
+
+        candidates = get_start_candidates(m.chat.id)
+        pending = {
+            uid: candidate
+            for uid, candidate in candidates.items()
+            if isinstance(candidate, dict) and not candidate.get("imported_at")
+        }
+        reply_notes = []
+        if not pending and replied is not None and not replied_parsed:
+            reply_notes.append("Не смогла разобрать сообщение, на которое ты ответила. Нужны ФИО и дата старта.")
+
+        now = datetime.now(tz)
+        sc = get_sc(m.chat.id)
+        # Админы могли поправить таблицу руками прямо перед сканом.
+        sc.invalidate()
+        existing_uids = existing_uids_from_rows(await sc.rows())
+
+        linked_existing = 0
+        already_in_table = 0
+        duplicate_names = 0
+        invalid = 0
+        # Новые строки добавляем одним append после цикла.
+        new_rows = []
+        new_names = NameIndex()
+        new_uids = []
+
+        for uid_raw, candidate in sorted(pending.items(), key=lambda item: item[1].get("message_date", "")):
+            try:
+                uid = int(uid_raw)
+                start_date = date.fromisoformat(str(candidate.get("start_date", "")))
+            except Exception:
+                invalid += 1
+                continue
 
-        uid_key = normalize_uid_value(uid)
-        if uid_key in existing_uids:
-            already_in_table += 1
-            mark_start_candidate_imported(m.chat.id, uid, now.isoformat())
-            continue
+            full_name = str(candidate.get("full_name", "")).strip()
+            if not full_name:
+                invalid += 1
+                continue
 
-        date_value = start_date_sheet_value(start_date, today=now.date())
-        matched_row, matched_uid = find_row_by_candidate_name(rows, full_name)
+            uid_key = normalize_uid_value(uid)
+            if uid_key in existing_uids:
+                already_in_table += 1
+                tx.mark_start_candidate_imported(uid, now.isoformat())
+                continue
 
-        if matched_row is not None:
-            if matched_uid:
-                duplicate_names += 1
-                mark_start_candidate_imported(m.chat.id, uid, now.isoformat())
+            date_value = start_date_sheet_value(start_date, today=now.date())
+            rows, names = await sc.rows_with_names()
+            matched_row, matched_uid = find_row_by_candidate_name(rows, full_name, names)
+            if matched_row is None:
+                matched_row, matched_uid = find_row_by_candidate_name(new_rows, full_name, new_names)
+
+            if matched_row is not None:
+                if matched_uid:
+                    duplicate_names += 1
+                    tx.mark_start_candidate_imported(uid, now.isoformat())
+                    continue
+
+                sc.write(matched_row, "J", uid)
+                if date_value:
+                    sc.write(matched_row, "I", date_value)
+                linked_existing += 1
+                existing_uids.add(uid_key)
+
+                tx.mark_start_candidate_imported(uid, now.isoformat())
                 continue
 
-            sc.write(matched_row, "J", uid)
-            if date_value:
-                sc.write(matched_row, "I", date_value)
-            linked_existing += 1
+            new_rows.append(start_user_row(full_name, date_value, uid))
+            new_names.add(len(new_rows) + 1, new_rows[-1])
+            new_uids.append(uid)
             existing_uids.add(uid_key)
-            update_local_user_row(rows, matched_row, uid, date_value)
 
-            mark_start_candidate_imported(m.chat.id, uid, now.isoformat())
-            continue
+        # Отмечаем импорт только после того, как строки реально добавились.
+        added = len(await sc.append_rows(new_rows))
+        for uid in new_uids:
+            tx.mark_start_candidate_imported(uid, now.isoformat())
 
-        sc.append_start_user(full_name, date_value, uid)
-        added += 1
-        existing_uids.add(uid_key)
-        append_local_user_row(rows, full_name, uid, date_value)
-        mark_start_candidate_imported(m.chat.id, uid, now.isoformat())
-
-    known_added, known_linked, skipped_no_name, skipped_not_in_chat = await sync_known_chat_users(
-        m.chat.id,
-        sc,
-        rows,
-        existing_uids,
-    )
+    with request_priority(PRIORITY_BULK):
+        known_added, known_linked, skipped_no_name, skipped_not_in_chat = await sync_known_chat_users(
+            m.chat.id,
+            sc,
+            existing_uids,
+        )
+        await sc.flush()
 
     parts = ["Скан завершён."]
     parts.extend(reply_notes)
@@ -861,32 +903,13 @@ def extract_fio_prefix(text: str) -> str:
 
     return " ".join(fio_parts).strip()
 
-def find_row_by_fio_in_rows(rows: list[list], fio: str) -> int | None:
+def find_row_by_fio_in_rows(rows: list[list], fio: str, names: NameIndex | None = None) -> int | None:
     """
-    Ищем строку по колонке A (индекс 0) по фамилии/ФИО.
+    Ищем строку по колонке A (индекс 0) по фамилии/ФИО:
+    первое слово совпадает с фамилией или совпадают первые 1-2 слова.
     Возвращаем номер строки в sheet (начиная с 2).
     """
-    fio_n = _norm(fio)
-    if not fio_n:
-        return None
-
-    fio_first = fio_n.split()[0]
-
-    for i, r in enumerate(rows, start=2):
-        a = _norm(r[0] if len(r) > 0 else "")
-        if not a:
-            continue
-        a_first = a.split()[0]
-
-        # матч по фамилии (первое слово)
-        if a_first == fio_first:
-            return i
-
-        # или полное совпадение первых 1-2 слов
-        if a == fio_n:
-            return i
-
-    return None
+    return (names or NameIndex(rows)).row_by_fio(fio)
 
 
 # -------------------------
@@ -1058,8 +1081,9 @@ async def new_chat_members(m: Message):
     if m.chat.id not in GROUPS:
         return
 
-    for user in m.new_chat_members or []:
-        remember_chat_user(m.chat.id, user)
+    with state_transaction(m.chat.id) as tx:
+        for user in m.new_chat_members or []:
+            remember_chat_user(m.chat.id, user, tx)
 
 @dp.message((F.text | F.caption))
 async def report_handler(m: Message):
@@ -1093,11 +1117,15 @@ async def report_handler(m: Message):
     if getattr(m.from_user, "is_bot", False):
         return
 
-    remember_chat_user(m.chat.id, m.from_user)
-    if await handle_manual_green_command(m, text, msg_dt):
+    with state_transaction(m.chat.id) as tx:
+        await process_report_message(m, text, msg_dt, tx)
+
+async def process_report_message(m: Message, text: str, msg_dt: datetime, tx: StateTransaction):
+    remember_chat_user(m.chat.id, m.from_user, tx)
+    if await handle_manual_green_command(m, text, msg_dt, tx):
         return
 
-    remember_start_candidate(m, text, msg_dt)
+    remember_start_candidate(m, text, msg_dt, tx)
 
     if needs_weight_value_warning(text):
         await m.reply("⚠️ Вес нужно писать с цифрой в этом же сообщении: <code>Сунко вес 80</code>.")
@@ -1113,42 +1141,41 @@ async def report_handler(m: Message):
     uid = m.from_user.id
     hour, minute = msg_dt.hour, msg_dt.minute
 
-    mention = mention_from_user(m.from_user)
-
     chat_id = m.chat.id
     sc = get_sc(chat_id)
-    save_mention(chat_id, uid, mention)
-    save_user(chat_id, uid, getattr(m.from_user, "username", None), getattr(m.from_user, "full_name", None))
 
     meal_marks = extract_meal_marks(text, hour=hour)
 
     if is_excuse(text):
         until_iso = parse_until_date(text)
         if until_iso:
-            set_excused_until(chat_id, uid, until_iso)
+            tx.set_excused_until(uid, until_iso)
             await m.reply(f"Ок, принял. До <b>{until_iso}</b> не буду ждать отчёты ✅")
         else:
-            mark_excused(chat_id, uid)
+            tx.mark_excused(uid)
             await m.reply("Ок, принял. Сегодня отмечу зелёным ✅")
 
         if not meal_marks and parse_weight_delta(text) is None and parse_explicit_weight(text) is None:
             return
 
-    row = sc.find_row_by_uid(uid)
+    row = await sc.find_row_by_uid(uid)
 
     if AUTO_BIND_UID and row is None:
         fio = extract_fio_prefix(text)
-        rows = sc.rows()
-        found_row = find_row_by_fio_in_rows(rows, fio)
+        rows, names = await sc.rows_with_names()
+        found_row = find_row_by_fio_in_rows(rows, fio, names)
 
         if found_row is not None:
-            sc.write(found_row, "J", uid)
+            sheet_outbox.enqueue(chat_id, outbox_key(m, ":bind"), [["write", found_row, "J", uid]])
             row = found_row
         else:
             new_row = len(rows) + 2
             fio_to_write = fio if fio else (m.from_user.full_name or "Участник")
-            sc.write(new_row, "A", fio_to_write)
-            sc.write(new_row, "J", uid)
+            sheet_outbox.enqueue(
+                chat_id,
+                outbox_key(m, ":bind"),
+                [["write", new_row, "A", fio_to_write], ["write", new_row, "J", uid]],
+            )
             row = new_row
 
     if row is None:
@@ -1159,13 +1186,17 @@ async def report_handler(m: Message):
     explicit_weight = parse_explicit_weight(text)
     weight_message = explicit_weight is not None or delta is not None
     sheet_name = GROUPS[chat_id]["SHEET_NAME"] if weight_message else None
-    row_uid_raw = sc.get_cell(f"J{row}") if weight_message else None
-    row_name = sc.get_cell(f"A{row}") if weight_message else None
+    # J, A и B одним чтением строки вместо трёх запросов.
+    row_cells = await sc.read_row(row) if weight_message else None
+    row_uid_raw = row_cells[9] if weight_message else None
+    row_name = row_cells[0] if weight_message else None
     row_uid = normalize_uid_value(row_uid_raw) if weight_message else ""
     expected_uid = normalize_uid_value(uid) if weight_message else ""
-    prev_raw = sc.get_cell(f"B{row}") if weight_message else None
+    prev_raw = row_cells[1] if weight_message else None
     prev = parse_sheet_weight(prev_raw) if weight_message else None
     new_weight = None
+    # Вес, разница и отметки еды уходят в outbox одной записью в конце.
+    updates = {}
 
     if weight_message:
         print(
@@ -1192,14 +1223,14 @@ async def report_handler(m: Message):
 
     if explicit_weight is not None:
         new_weight = explicit_weight
-        sc.write(row, "B", explicit_weight)
+        updates["B"] = explicit_weight
 
         if prev is not None:
             diff = round(explicit_weight - prev, 3)
             if abs(diff) <= 5:
-                sc.write(row, "C", diff)
+                updates["C"] = diff
             else:
-                sc.write(row, "C", "")
+                updates["C"] = ""
                 print(
                     "WEIGHT_WARN",
                     "reason=", "explicit_diff_too_large",
@@ -1230,9 +1261,9 @@ async def report_handler(m: Message):
                     "prev=", prev_raw,
                 )
         else:
-            sc.write(row, "C", "")
+            updates["C"] = ""
 
-        mark_active(chat_id, uid)
+        tx.mark_active(uid)
 
     elif delta is not None:
         if prev is None:
@@ -1281,9 +1312,9 @@ async def report_handler(m: Message):
                 )
             else:
                 new_weight = candidate_weight
-                sc.write(row, "B", candidate_weight)
-                sc.write(row, "C", delta)
-                mark_active(chat_id, uid)
+                updates["B"] = candidate_weight
+                updates["C"] = delta
+                tx.mark_active(uid)
 
     if weight_message:
         print(
@@ -1303,64 +1334,82 @@ async def report_handler(m: Message):
         )
 
     seen_meals = set()
+    late_replies = []
     for meal, mark in meal_marks:
         if meal not in MEAL_TO_COL or meal in seen_meals:
             continue
 
         seen_meals.add(meal)
-        col = MEAL_TO_COL[meal]
-        sc.write(row, col, mark)
-        mark_active(chat_id, uid)
+        updates[MEAL_TO_COL[meal]] = mark
+        tx.mark_active(uid)
 
         if mark == "+":
             msg = late_message(meal, hour, minute)
             if msg:
-                await m.reply(msg)
+                late_replies.append(msg)
+
+    if updates:
+        sheet_outbox.enqueue(chat_id, outbox_key(m), [["write", row, col, value] for col, value in updates.items()])
+    for msg in late_replies:
+        await m.reply(msg)
 # Отчёт: красим и отправляем
 # -------------------------
-async def report(chat_id: int):
-    today = datetime.now(tz).date()
-    cleanup_expired_excused_until(chat_id)
-    expired_manual_green_uids = cleanup_expired_manual_green(chat_id, today=today)
-
-    sc = get_sc(chat_id)
-    for uid in expired_manual_green_uids:
-        row = sc.find_row_by_uid(uid)
-        if row is not None:
+def expire_state_entries(chat_id: int, today: date) -> list[int]:
+    with state_transaction(chat_id) as tx:
+        tx.cleanup_expired_excused_until(today)
+        return tx.cleanup_expired_manual_green(today)
+
+async def clear_expired_manual_green_rows(sc: Sheets, uids: list[int]):
+    # Look every row up before writing: a queued write would make the next lookup refetch.
+    rows = [row for row in [await sc.find_row_by_uid(uid) for uid in uids] if row is not None]
+    async with sc.formatting() as fmt:
+        for row in rows:
             sc.write(row, "I", "")
-            sc.clear_row_background(row)
+            fmt.clear_row_background(row)
+    await sc.flush()
 
-    rows = sc.rows()
-    manual_green = get_manual_green(chat_id)
-
-    for row_num, r in enumerate(rows, start=2):
-        status = report_row_status(
-            r,
-            lambda uid: is_excused_today(chat_id, uid),
-            lambda uid: manual_green_entry_is_active(manual_green.get(str(uid)), today),
-        )
-        if status is None:
-            continue
-
-        if status.has_any_food:
-            remove_excused(chat_id, status.uid)
-        if status.force_green:
-            value = manual_green_entry_sheet_value(manual_green.get(str(status.uid)))
-            current_value = str(r[8]).strip() if len(r) > 8 else ""
-            if current_value != value:
-                sc.write(row_num, "I", value)
-            sc.paint_row(row_num, GREEN)
-            continue
-        if status.is_excused:
-            sc.paint_row(row_num, GREEN)
-            continue
-        if status.red_row:
-            sc.paint_row(row_num,RED)
-            continue
-        for col in status.red_cells:
-            sc.paint_cell(row_num, col, RED)
-
-    pdf_path = sc.export_pdf()
+async def report(chat_id: int):
+    today = datetime.now(tz).date()
+    # Normally a no-op: the midnight job has already expired today's entries.
+    expired_manual_green_uids = expire_state_entries(chat_id, today)
+
+    # Покраска и выгрузка уступают квоту отчётам участников и напоминаниям.
+    with request_priority(PRIORITY_BULK):
+        sc = get_sc(chat_id)
+        await clear_expired_manual_green_rows(sc, expired_manual_green_uids)
+
+        sc.invalidate()
+        rows = await sc.rows()
+        manual_green = get_manual_green(chat_id)
+        snapshot = day_status_snapshot(chat_id, today)
+
+        with state_transaction(chat_id) as tx:
+            async with sc.formatting() as fmt:
+                for row_num, r in enumerate(rows, start=2):
+                    status = report_row_status(r, snapshot=snapshot)
+                    if status is None:
+                        continue
+
+                    if status.has_any_food:
+                        tx.remove_excused(status.uid)
+                    if status.force_green:
+                        value = manual_green_entry_sheet_value(manual_green.get(str(status.uid)))
+                        current_value = str(r[8]).strip() if len(r) > 8 else ""
+                        if current_value != value:
+                            sc.write(row_num, "I", value)
+                        fmt.paint_row(row_num, GREEN)
+                        continue
+                    if status.is_excused:
+                        fmt.paint_row(row_num, GREEN)
+                        continue
+                    if status.red_row:
+                        fmt.paint_row(row_num, RED)
+                        continue
+                    for col in status.red_cells:
+                        fmt.paint_cell(row_num, col, RED)
+
+        await sc.flush()
+        pdf_path = await sc.export_pdf()
     jpg_path = pdf_to_jpeg(pdf_path)
 
     await  bot.send_photo(
@@ -1382,32 +1431,37 @@ async def scheduled_report(chat_id: int):
         traceback.print_exc()
 
 
+async def scheduled_state_expiry(chat_id: int):
+    try:
+        expired_manual_green_uids = expire_state_entries(chat_id, datetime.now(tz).date())
+        if expired_manual_green_uids:
+            await clear_expired_manual_green_rows(get_sc(chat_id), expired_manual_green_uids)
+    except Exception:
+        print(f"Scheduled state expiry failed: chat_id={chat_id}")
+        traceback.print_exc()
+
+
 async def lunch_ping(chat_id: int):
     today = datetime.now(tz).date()
-    cleanup_expired_excused_until(chat_id)
-    cleanup_expired_manual_green(chat_id, today=today)
 
     sc = get_sc(chat_id)
-    rows = sc.rows()
+    with request_priority(PRIORITY_PING):
+        # lunch = колонка F, uid = колонка J
+        columns = await sc.columns("F", "J")
+    lunch_col, uid_col = columns["F"], columns["J"]
     _excused, _active, mentions, _excused_until = get_sets(chat_id)
-    manual_green = get_manual_green(chat_id)
+    snapshot = day_status_snapshot(chat_id, today)
 
     missing = []
-    for i, r in enumerate(rows, start=2):
-        if len(r) <= 9 or not str(r[9]).strip():
-            continue
-
-        uid_raw = normalize_uid_value(r[9])
+    for i, uid_val in enumerate(uid_col):
+        uid_raw = normalize_uid_value(uid_val)
         if not uid_raw:
             continue
         uid = int(uid_raw)
-        if is_excused_today(chat_id, uid):
-            continue
-        if manual_green_entry_is_active(manual_green.get(str(uid)), today):
+        if snapshot.is_excused(uid) or snapshot.is_force_green(uid):
             continue
 
-        # lunch = колонка F = индекс 5
-        lunch_val = str(r[5]).strip() if len(r) > 5 else ""
+        lunch_val = str(lunch_col[i]).strip() if i < len(lunch_col) else ""
         if lunch_val == "":
             missing.append(uid)
 
@@ -1426,11 +1480,25 @@ async def lunch_ping(chat_id: int):
 # Запуск
 # -------------------------
 async def main():
+    configure_state(
+        getattr(config, "STATE_BACKEND", "json"),
+        shared=getattr(config, "STATE_SHARED", False),
+    )
     await bot.delete_webhook(drop_pending_updates=True)
 
     scheduler = AsyncIOScheduler(timezone=tz)
 
     for index, (chat_id, _cfg) in enumerate(GROUPS.items()):
+        # Снимаем истёкшие "до даты" и зелёные строки
+        scheduler.add_job(
+            scheduled_state_expiry, "cron",
+            hour=0, minute=0,
+            args=[chat_id],
+            id=f"state_expiry_{chat_id}",
+            replace_existing=True,
+            misfire_grace_time=REPORT_MISFIRE_GRACE_SECONDS
+        )
+
         # Пинг по обеду
         scheduler.add_job(
             lunch_ping, "cron",
@@ -1461,7 +1529,16 @@ async def main():
     for job in scheduler.get_jobs():
         print("JOB:", job.id, "next:", job.next_run_time)
 
-    await dp.start_polling(bot)
+    outbox_worker = asyncio.create_task(sheet_outbox.run())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        outbox_worker.cancel()
+        await sheet_outbox.stop()
+        for sc in _sheets_cache.values():
+            await sc.close()
+        await close_sessions()
+        await asyncio.to_thread(flush_state)
 
 if __name__ == "__main__":
     asyncio.run(main())
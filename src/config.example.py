@@ -3,12 +3,25 @@ TZ = "Europe/Moscow"
 
 ADMIN_IDS = {123456789}
 
+# "json" (state.json), "sharded" (one file per chat in state.d/) or "sqlite"
+# (state.sqlite3); the last two are migrated from state.json on first start.
+STATE_BACKEND = "json"
+# True when several bot processes share the same state files (Linux only):
+# writes are locked with fcntl and every process sees the others' changes
+# about a second after they are made (state.FLUSH_DELAY).
+# With "sqlite" each write is also logged to a changes table, and a process
+# re-reads only the rows the others touched; one that falls more than
+# CHANGES_KEEP (state_sqlite.py) log rows behind reloads the whole database.
+STATE_SHARED = False
+
 GROUPS = {
     -1000000000000: {
         "SPREADSHEET_ID": "YOUR_SPREADSHEET_ID",
         "SHEET_NAME": "Sheet1",
         # Optional Google export scale. 4 fits rows and columns to one page.
         "EXPORT_SCALE": 4,
+        # Optional: seconds the cached sheet rows stay fresh (default 60).
+        "ROWS_CACHE_TTL": 60,
         "ADMINS": {123456789},
     },
 }
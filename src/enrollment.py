@@ -1,4 +1,5 @@
 import re
+from bisect import insort
 from dataclasses import dataclass
 from datetime import date, timedelta
 from typing import Optional, Sequence
@@ -207,6 +208,102 @@ def names_match(left: str, right: str) -> bool:
     return left_key == right_key or set(left_key) == set(right_key)
 
 
+def _lower_words(text) -> str:
+    return re.sub(r"\s+", " ", str(text or "").strip().lower())
+
+
+def _add_row(index: dict, key, row_number: int):
+    insort(index.setdefault(key, []), row_number)
+
+
+def _remove_row(index: dict, key, row_number: int):
+    rows = index.get(key)
+    if rows and row_number in rows:
+        rows.remove(row_number)
+        if not rows:
+            del index[key]
+
+
+class NameIndex:
+    """Row numbers by column A surname, (surname, name) and order-insensitive name_key.
+
+    Built once per rows snapshot, so every lookup is a dict access instead of
+    a rescan that re-normalizes column A.
+    """
+
+    def __init__(self, rows: Sequence[Sequence[object]] = ()):
+        self.by_full: dict[str, list[int]] = {}
+        self.by_surname: dict[str, list[int]] = {}
+        self.by_surname_name: dict[tuple[str, str], list[int]] = {}
+        self.by_name_key: dict[tuple[str, ...], list[int]] = {}
+        for row_number, row in enumerate(rows, start=2):
+            self.add(row_number, row)
+
+    @staticmethod
+    def _keys(row: Sequence[object]):
+        full = _lower_words(row[0]) if len(row) > 0 else ""
+        if not full:
+            return None
+        name = _lower_words(row[1]) if len(row) > 1 else ""
+        key = name_key(str(row[0]))
+        return full, full.split()[0], (full, name), tuple(sorted(key)) if len(key) >= 2 else None
+
+    def add(self, row_number: int, row: Sequence[object]):
+        keys = self._keys(row)
+        if keys is None:
+            return
+        full, surname, surname_name, key = keys
+        _add_row(self.by_full, full, row_number)
+        _add_row(self.by_surname, surname, row_number)
+        _add_row(self.by_surname_name, surname_name, row_number)
+        if key:
+            _add_row(self.by_name_key, key, row_number)
+
+    def discard(self, row_number: int, row: Sequence[object]):
+        keys = self._keys(row)
+        if keys is None:
+            return
+        full, surname, surname_name, key = keys
+        _remove_row(self.by_full, full, row_number)
+        _remove_row(self.by_surname, surname, row_number)
+        _remove_row(self.by_surname_name, surname_name, row_number)
+        if key:
+            _remove_row(self.by_name_key, key, row_number)
+
+    def rows_by_surname(self, surname: str) -> list[int]:
+        """Rows whose column A is the surname or starts with it (old "Surname Name" rows)."""
+        surname = _lower_words(surname)
+        if not surname:
+            return []
+        if " " in surname:
+            return list(self.by_full.get(surname, []))
+        return list(self.by_surname.get(surname, []))
+
+    def row_by_surname_name(self, surname: str, name: str) -> Optional[int]:
+        surname = _lower_words(surname)
+        name = _lower_words(name)
+        if not surname:
+            return None
+        rows = self.by_surname_name.get((surname, name)) if name else self.by_full.get(surname)
+        return rows[0] if rows else None
+
+    def row_by_fio(self, fio: str) -> Optional[int]:
+        """First row whose A matches the first word of fio, or all of it."""
+        fio = _lower_words(fio)
+        if not fio:
+            return None
+        found = self.by_surname.get(fio.split()[0], [])[:1] + self.by_full.get(fio, [])[:1]
+        return min(found) if found else None
+
+    def row_by_name(self, full_name: str) -> Optional[int]:
+        """First row whose A has the same two name tokens in either order."""
+        key = name_key(full_name)
+        if len(key) < 2:
+            return None
+        rows = self.by_name_key.get(tuple(sorted(key)))
+        return rows[0] if rows else None
+
+
 def existing_uids_from_rows(rows: Sequence[Sequence[object]]) -> set[str]:
     uids: set[str] = set()
     for row in rows:
@@ -221,13 +318,12 @@ def existing_uids_from_rows(rows: Sequence[Sequence[object]]) -> set[str]:
 def find_row_by_candidate_name(
     rows: Sequence[Sequence[object]],
     full_name: str,
+    names: NameIndex | None = None,
 ) -> tuple[Optional[int], str]:
-    for row_number, row in enumerate(rows, start=2):
-        row_name = str(row[0]).strip() if row else ""
-        if not row_name or not names_match(row_name, full_name):
-            continue
-
-        row_uid = normalize_uid_value(row[UID_INDEX]) if len(row) > UID_INDEX else ""
-        return row_number, row_uid
+    row_number = (names or NameIndex(rows)).row_by_name(full_name)
+    if row_number is None:
+        return None, ""
 
-    return None, ""
+    row = rows[row_number - 2]
+    row_uid = normalize_uid_value(row[UID_INDEX]) if len(row) > UID_INDEX else ""
+    return row_number, row_uid
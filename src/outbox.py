@@ -0,0 +1,261 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTBOX_PATH = os.path.join(BASE_DIR, "sheets_outbox.jsonl")
+
+# Сколько ждём после первой записи, чтобы соседние сообщения ушли тем же запросом.
+OUTBOX_BATCH_DELAY = 0.5
+# Потолок паузы между повторами, пока Google не отвечает.
+OUTBOX_RETRY_MAX = 60.0
+# Журнал переписываем, когда он вырос больше этого.
+OUTBOX_COMPACT_BYTES = 1 << 20
+# Столько ключей уже отправленных сообщений помним после сжатия,
+# чтобы повторно доставленный апдейт не записался второй раз.
+OUTBOX_KEEP_DONE = 2000
+
+
+class SheetOutbox:
+    """Sheet mutations journaled to disk, so none is lost while Google is down.
+
+    Handlers call enqueue() and move on. Cell writes go into the Sheets
+    buffer at once, so reads see them and its write timer may send them
+    before the journal has them; run() flushes the affected sheets in the
+    background, sends the paints, retries until Google accepts and, after a
+    restart, replays whatever was not confirmed. Every entry has a key (chat
+    and message id), and a key seen before is ignored.
+
+    The journal is appended and fsynced by a single writer thread, so the
+    event loop never waits on the disk; records still land in enqueue order.
+
+    Ops: ["write", row, col, value], ["paint_row", row, color],
+    ["paint_cell", row, col, color], ["clear_row", row].
+    """
+
+    def __init__(self, path: str, get_sheets):
+        self.path = path
+        self.get_sheets = get_sheets
+        # key -> (chat_id, ops), in enqueue order.
+        self.pending: dict[str, tuple[int, list]] = {}
+        # Recently confirmed keys, oldest first.
+        self.done: dict[str, None] = {}
+        self._file = None
+        # One thread, so journal records reach the file in the order they were queued.
+        self._journal = ThreadPoolExecutor(max_workers=1, thread_name_prefix="outbox-journal")
+        self._journal_last = None
+        self._journal_size = 0
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self.stats = {"enqueued": 0, "duplicates": 0, "sent": 0, "retries": 0}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        self._journal_size = sum(len(line.encode("utf-8")) for line in lines)
+
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn last line from a crash mid-append.
+                continue
+            if record[0] == "put":
+                _action, key, chat_id, ops = record
+                self.pending[key] = (chat_id, ops)
+            elif record[0] == "done":
+                self.pending.pop(record[1], None)
+                self._remember_done(record[1])
+
+        if not self.pending:
+            return
+        print(f"OUTBOX_REPLAY path={self.path} pending={len(self.pending)}")
+        # Put the replayed writes into the buffers now, before any handler runs,
+        # so a newer write to the same cell lands on top of them and wins.
+        for key, (chat_id, ops) in self.pending.items():
+            try:
+                sc = self.get_sheets(chat_id)
+            except KeyError:
+                # drain() reports and drops these.
+                continue
+            self._apply_writes(sc, ops)
+
+    def _journal_write(self, records: list):
+        """Queue records for the writer thread; durable once journaled() returns."""
+        text = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        self._journal_size += len(text.encode("utf-8"))
+        self._journal_submit(self._append, text)
+
+    def _journal_submit(self, fn, *args):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop yet (startup or tests): nothing to block, write in place.
+            fn(*args)
+            return
+        future = loop.run_in_executor(self._journal, fn, *args)
+        future.add_done_callback(self._journal_done)
+        self._journal_last = future
+
+    def _journal_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"OUTBOX_JOURNAL_FAILED path={self.path} error={future.exception()!r}")
+
+    async def journaled(self):
+        """Wait until everything queued for the journal is on disk."""
+        if self._journal_last is not None:
+            await asyncio.shield(self._journal_last)
+
+    def _append(self, text: str):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(text)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _remember_done(self, key: str):
+        self.done[key] = None
+        while len(self.done) > OUTBOX_KEEP_DONE:
+            del self.done[next(iter(self.done))]
+
+    def enqueue(self, chat_id: int, key: str, ops: list) -> bool:
+        """Journal ops for chat_id; False if key was already taken. Writes are visible to reads at once."""
+        if not ops:
+            return False
+        if key in self.pending or key in self.done:
+            self.stats["duplicates"] += 1
+            return False
+
+        self.pending[key] = (chat_id, ops)
+        self._journal_write([["put", key, chat_id, ops]])
+        self.stats["enqueued"] += 1
+        self._apply_writes(self.get_sheets(chat_id), ops)
+        self._wake.set()
+        return True
+
+    def _apply_writes(self, sc, ops: list):
+        for op in ops:
+            if op[0] == "write":
+                sc.write(op[1], op[2], op[3])
+
+    async def drain(self) -> int:
+        """Send everything pending; returns the entries confirmed. Raises if a chat failed."""
+        by_chat: dict[int, list[tuple[str, list]]] = {}
+        for key, (chat_id, ops) in list(self.pending.items()):
+            by_chat.setdefault(chat_id, []).append((key, ops))
+
+        sent = 0
+        error = None
+        for chat_id, entries in by_chat.items():
+            try:
+                sc = self.get_sheets(chat_id)
+            except KeyError:
+                # The group was removed from the config; nowhere left to send these.
+                print(f"OUTBOX_DROPPED chat_id={chat_id} entries={len(entries)}")
+                self._mark_done([key for key, _ops in entries])
+                continue
+            try:
+                await self._send_chat(sc, entries)
+            except Exception as e:
+                # Other chats still go out; this one stays pending for the retry.
+                print(f"OUTBOX_SEND_FAILED chat_id={chat_id} entries={len(entries)} error={e!r}")
+                error = error or e
+                continue
+            sent += len(entries)
+
+        self.stats["sent"] += sent
+        self._maybe_compact()
+        await self.journaled()
+        if error is not None:
+            raise error
+        return sent
+
+    async def _send_chat(self, sc, entries: list[tuple[str, list]]):
+        # Cell writes are plain overwrites, so sending one twice after a crash is harmless.
+        await sc.flush()
+
+        paints = [op for _key, ops in entries for op in ops if op[0] != "write"]
+        if paints:
+            async with sc.formatting() as fmt:
+                for op in paints:
+                    if op[0] == "paint_row":
+                        fmt.paint_row(op[1], op[2])
+                    elif op[0] == "paint_cell":
+                        fmt.paint_cell(op[1], op[2], op[3])
+                    elif op[0] == "clear_row":
+                        fmt.clear_row_background(op[1])
+
+        self._mark_done([key for key, _ops in entries])
+
+    def _mark_done(self, keys: list[str]):
+        self._journal_write([["done", key] for key in keys])
+        for key in keys:
+            self.pending.pop(key, None)
+            self._remember_done(key)
+
+    def _maybe_compact(self):
+        if self._journal_size < OUTBOX_COMPACT_BYTES:
+            return
+        # The snapshot is taken here, on the loop; the writer thread only puts it on disk,
+        # after every record queued before it.
+        records = [["done", key] for key in self.done]
+        records += [["put", key, chat_id, ops] for key, (chat_id, ops) in self.pending.items()]
+        text = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        self._journal_size = len(text.encode("utf-8"))
+        self._journal_submit(self._rewrite, text)
+
+    def _rewrite(self, text: str):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.replace(tmp_path, self.path)
+
+    async def run(self):
+        """Background worker: drain whenever something is enqueued, backing off while Google fails."""
+        delay = 0.0
+        while not self._stopping:
+            if not self.pending:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+
+            await asyncio.sleep(OUTBOX_BATCH_DELAY)
+            try:
+                await self.drain()
+                delay = 0.0
+            except Exception:
+                self.stats["retries"] += 1
+                delay = min(OUTBOX_RETRY_MAX, delay * 2 or 1.0)
+                print(f"OUTBOX_RETRY pending={len(self.pending)} delay={delay}")
+                await asyncio.sleep(delay)
+
+    async def stop(self):
+        """Stop the worker and make one last attempt to send what is pending."""
+        if self._stopping:
+            return
+        self._stopping = True
+        self._wake.set()
+        if self.pending:
+            try:
+                await self.drain()
+            except Exception:
+                print(f"OUTBOX_LEFT_PENDING pending={len(self.pending)}")
+        try:
+            await self.journaled()
+        except Exception:
+            # Already reported by _journal_done.
+            pass
+        self._journal.shutdown(wait=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
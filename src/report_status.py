@@ -1,5 +1,6 @@
 from dataclasses import dataclass
-from typing import Callable, Optional, Sequence
+from datetime import date
+from typing import Callable, Mapping, Optional, Sequence
 
 from sheets import normalize_uid_value
 
@@ -27,6 +28,56 @@ class ReportRowStatus:
     force_green: bool = False
 
 
+@dataclass(frozen=True)
+class DayStatusSnapshot:
+    day: date
+    excused: frozenset[int]
+    manual_green: frozenset[int]
+
+    @classmethod
+    def from_state(
+        cls,
+        day: date,
+        excused: set[int],
+        excused_until: Mapping[str, str],
+        manual_green: Mapping[str, Mapping[str, str]],
+    ) -> "DayStatusSnapshot":
+        excused_uids = set(excused)
+        for uid, until in excused_until.items():
+            if _date_covers(until, day, empty_covers=False):
+                _add_int(excused_uids, uid)
+
+        green_uids: set[int] = set()
+        for uid, entry in manual_green.items():
+            if _date_covers(entry.get("until", ""), day, empty_covers=True):
+                _add_int(green_uids, uid)
+
+        return cls(day=day, excused=frozenset(excused_uids), manual_green=frozenset(green_uids))
+
+    def is_excused(self, uid: int) -> bool:
+        return uid in self.excused
+
+    def is_force_green(self, uid: int) -> bool:
+        return uid in self.manual_green
+
+
+def _date_covers(raw_until: object, day: date, empty_covers: bool) -> bool:
+    until = str(raw_until or "").strip()
+    if not until:
+        return empty_covers
+    try:
+        return day <= date.fromisoformat(until)
+    except ValueError:
+        return False
+
+
+def _add_int(values: set[int], raw_value: str):
+    try:
+        values.add(int(raw_value))
+    except ValueError:
+        pass
+
+
 def row_uid(row: Sequence[object]) -> Optional[int]:
     if len(row) <= 9 or not str(row[9]).strip():
         return None
@@ -48,13 +99,19 @@ def _cell_val(row: Sequence[object], letter: str) -> str:
 
 def report_row_status(
     row: Sequence[object],
-    is_excused_today: Callable[[int], bool],
+    is_excused_today: Callable[[int], bool] | None = None,
     is_force_green: Callable[[int], bool] | None = None,
+    *,
+    snapshot: DayStatusSnapshot | None = None,
 ) -> Optional[ReportRowStatus]:
     uid = row_uid(row)
     if uid is None:
         return None
 
+    if snapshot is not None:
+        is_excused_today = snapshot.is_excused
+        is_force_green = snapshot.is_force_green
+
     values = {col: _cell_val(row, col) for col in ALL_MEALS}
     has_any_food = any(value in MEAL_MARKS for value in values.values())
     force_green = bool(is_force_green and is_force_green(uid))
@@ -87,14 +144,16 @@ def report_row_status(
 
 def red_report_uids(
     rows: Sequence[Sequence[object]],
-    is_excused_today: Callable[[int], bool],
+    is_excused_today: Callable[[int], bool] | None = None,
     is_force_green: Callable[[int], bool] | None = None,
+    *,
+    snapshot: DayStatusSnapshot | None = None,
 ) -> list[int]:
     red_uids: list[int] = []
     seen: set[int] = set()
 
     for row in rows:
-        status = report_row_status(row, is_excused_today, is_force_green)
+        status = report_row_status(row, is_excused_today, is_force_green, snapshot=snapshot)
         if status is None or status.uid in seen:
             continue
         if status.red_row or status.red_cells:
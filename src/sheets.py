@@ -1,10 +1,19 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
 import os
 import re
 import ssl
+import traceback
 import time
 import uuid
 import random
-from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+from urllib.parse import quote, urlencode
 from typing import Optional, List, Tuple
 
 GREEN = {"red": 0.8, "green": 0.95, "blue": 0.8}
@@ -13,6 +22,17 @@ RED   = {"red": 0.95, "green": 0.8,  "blue": 0.8}
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SERVICE_ACCOUNT_PATH = os.path.join(BASE_DIR, "service_account.json")
+# sheetId, название и размер листов каждой таблицы, чтобы после
+# перезапуска не спрашивать метаданные у Google заново.
+SHEETS_META_PATH = os.path.join(BASE_DIR, "sheets_meta.json")
+SHEET_PROPERTIES_FIELDS = "sheets.properties(sheetId,title,gridProperties(rowCount,columnCount))"
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
+SHEETS_API = "https://sheets.googleapis.com/v4/spreadsheets"
+DRIVE_FILES_API = "https://www.googleapis.com/drive/v3/files"
+EXPORT_URL = "https://docs.google.com/spreadsheets/d/{sid}/export"
 
 # Таблица A..K
 RANGE_ROWS = "A2:K"
@@ -25,23 +45,356 @@ DEFAULT_EXPORT_SCALE = 4
 # UID в J
 UID_COL_LETTER = "J"
 UID_INDEX = 9  # A=0 -> J=9
+
+# Сколько секунд снимок A2:K считается свежим. Свои записи в него вносим
+# сразу, так что перечитывать нужно только ради правок руками в таблице.
+ROWS_CACHE_TTL = 60.0
+# Устаревший снимок сначала сверяем с modifiedTime файла в Drive и
+# перечитываем целиком, только если таблицу меняли. Но не дольше этого
+# срока: после него читаем A2:K в любом случае.
+ROWS_CACHE_MAX_AGE = 15 * 60.0
+
+# Записи в ячейки копятся и уходят одним values:batchUpdate
+# не позже чем через столько секунд.
+WRITE_BUFFER_DELAY = 0.5
+
+# Столько repeatCell-запросов отправляем в одном spreadsheets:batchUpdate.
+FORMAT_BATCH_MAX_REQUESTS = 1000
+
+# Таймаут одного HTTP-запроса к Google, секунды.
+REQUEST_TIMEOUT = 60
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Переборка на каждую таблицу: столько запросов одновременно, столько
+# ещё может ждать в очереди, столько потоков на блокирующую работу.
+SHEETS_MAX_IN_FLIGHT = 4
+SHEETS_MAX_QUEUED = 50
+SHEETS_BLOCKING_WORKERS = 1
+
+# Токен сервисного аккаунта обновляем в фоне, когда до истечения
+# остаётся меньше стольких секунд. Соединений на аккаунт не больше.
+TOKEN_REFRESH_MARGIN = 300
+SESSION_MAX_CONNECTIONS = 16
+
+# Квоты Sheets API в минуту: на сервисный аккаунт (так считает Google)
+# и на одну таблицу (чтобы одна группа не выбирала квоту всех остальных).
+# Запас токенов на всплеск — RATE_LIMIT_BURST запросов.
+ACCOUNT_READS_PER_MINUTE = 60
+ACCOUNT_WRITES_PER_MINUTE = 60
+SPREADSHEET_READS_PER_MINUTE = 30
+SPREADSHEET_WRITES_PER_MINUTE = 30
+RATE_LIMIT_BURST = 10
+
+# Кто первым получает освободившийся токен: ответы участникам, потом
+# напоминания, потом вечерние отчёты и /scan.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_PING = 1
+PRIORITY_BULK = 2
+
 Credentials = None
-build = None
-HttpError = None
+AuthRequest = None
+aiohttp = None
 
 
 def _load_google_api():
-    global Credentials, build, HttpError
+    global Credentials, AuthRequest, aiohttp
     if Credentials is not None:
         return
 
+    import aiohttp as aiohttp_module
+    import google_auth_httplib2
+    import httplib2
     from google.oauth2.service_account import Credentials as GoogleCredentials
-    from googleapiclient.discovery import build as google_build
-    from googleapiclient.errors import HttpError as GoogleHttpError
 
     Credentials = GoogleCredentials
-    build = google_build
-    HttpError = GoogleHttpError
+    AuthRequest = lambda: google_auth_httplib2.Request(httplib2.Http(timeout=REQUEST_TIMEOUT))
+    aiohttp = aiohttp_module
+
+
+class GoogleApiError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Google API error {status}: {message}")
+        self.status = status
+
+
+class SheetsBusyError(RuntimeError):
+    pass
+
+
+class Bulkhead:
+    """Limits Google calls for one spreadsheet so a throttled one cannot starve the others."""
+
+    def __init__(self, sid: str):
+        self.sid = sid
+        self.semaphore = asyncio.Semaphore(SHEETS_MAX_IN_FLIGHT)
+        self.executor = ThreadPoolExecutor(
+            max_workers=SHEETS_BLOCKING_WORKERS,
+            thread_name_prefix=f"sheets-{sid[:8]}",
+        )
+        self.in_flight = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.calls = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        if self.queued >= SHEETS_MAX_QUEUED:
+            self.rejected += 1
+            raise SheetsBusyError(f"Too many queued Google API calls for spreadsheet {self.sid}")
+
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        started = time.monotonic()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        waited = time.monotonic() - started
+        self.calls += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queued": self.max_queued,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_total / self.calls if self.calls else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+
+_bulkheads: dict[str, Bulkhead] = {}
+
+
+def _bulkhead_for(sid: str) -> Bulkhead:
+    bulkhead = _bulkheads.get(sid)
+    if bulkhead is None:
+        bulkhead = _bulkheads[sid] = Bulkhead(sid)
+    return bulkhead
+
+
+def bulkhead_stats() -> dict[str, dict]:
+    """Queue depth and wait times per spreadsheet id."""
+    return {sid: bulkhead.stats() for sid, bulkhead in _bulkheads.items()}
+
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("sheets_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def request_priority(level: int):
+    """Google calls made inside the block (and tasks started from it) queue at this priority."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """A per-minute quota; callers waiting for a token are served lowest priority value first."""
+
+    def __init__(self, name: str, per_minute: int):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = float(min(per_minute, RATE_LIMIT_BURST))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._waiters: list[tuple[int, int]] = []
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self.granted = 0
+        self.delayed = 0
+        self.wait_max = 0.0
+        self.drained = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _notify(self):
+        # Everyone re-checks who is at the head now; the old event stays set for them.
+        self._wake.set()
+        self._wake = asyncio.Event()
+
+    async def acquire(self, priority: int):
+        entry = (priority, next(self._seq))
+        heapq.heappush(self._waiters, entry)
+        started = time.monotonic()
+        try:
+            while True:
+                self._refill()
+                head = self._waiters[0] == entry
+                if head and self.tokens >= 1:
+                    break
+                timeout = (1 - self.tokens) / self.rate if head else None
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+            self._notify()
+            raise
+
+        heapq.heappop(self._waiters)
+        self.tokens -= 1
+        self._notify()
+
+        waited = time.monotonic() - started
+        self.granted += 1
+        if waited > 0.001:
+            self.delayed += 1
+        self.wait_max = max(self.wait_max, waited)
+
+    def drain(self):
+        """Google answered 429 anyway: stop handing out tokens until they refill."""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+        self.drained += 1
+
+    def stats(self) -> dict:
+        return {
+            "tokens": round(self.tokens, 2),
+            "waiting": len(self._waiters),
+            "granted": self.granted,
+            "delayed": self.delayed,
+            "wait_max": self.wait_max,
+            "drained": self.drained,
+        }
+
+
+_rate_limits: dict[tuple[str, str, str], TokenBucket] = {}
+
+
+def _buckets_for(sid: str, write: bool) -> tuple[TokenBucket, TokenBucket]:
+    """The spreadsheet's bucket and the service account's bucket for this kind of call."""
+    kind = "write" if write else "read"
+    keys = (
+        ("spreadsheet", sid, kind),
+        ("account", SERVICE_ACCOUNT_PATH, kind),
+    )
+    limits = (
+        SPREADSHEET_WRITES_PER_MINUTE if write else SPREADSHEET_READS_PER_MINUTE,
+        ACCOUNT_WRITES_PER_MINUTE if write else ACCOUNT_READS_PER_MINUTE,
+    )
+    buckets = []
+    for key, per_minute in zip(keys, limits):
+        bucket = _rate_limits.get(key)
+        if bucket is None:
+            bucket = _rate_limits[key] = TokenBucket(f"{key[0]}:{kind}", per_minute)
+        buckets.append(bucket)
+    return buckets[0], buckets[1]
+
+
+def rate_limit_stats() -> dict[tuple[str, str, str], dict]:
+    """Token bucket state per (scope, spreadsheet id or account, read/write)."""
+    return {key: bucket.stats() for key, bucket in _rate_limits.items()}
+
+
+class ServiceAccount:
+    """Credentials and one keep-alive HTTP session shared by every Sheets client of an account."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.creds = None
+        self.session = None
+        self.refreshes = 0
+        self._refresh_task = None
+
+    def _credentials(self):
+        if self.creds is None:
+            _load_google_api()
+            if not os.path.exists(self.path):
+                raise FileNotFoundError(f"service_account.json not found at: {self.path}")
+            self.creds = Credentials.from_service_account_file(self.path, scopes=SCOPES)
+        return self.creds
+
+    def _expires_in(self) -> float:
+        expiry = self.creds.expiry
+        if expiry is None:
+            return float("inf")
+        # google-auth keeps expiry as naive UTC.
+        return (expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+
+    def _start_refresh(self):
+        # Concurrent callers join the refresh already running instead of starting another.
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    async def _refresh(self):
+        # google-auth refreshes synchronously; keep it off the event loop.
+        await asyncio.get_running_loop().run_in_executor(None, self.creds.refresh, AuthRequest())
+        self.refreshes += 1
+
+    def _log_background_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            # The token is still valid; the next call tries again or refreshes inline.
+            print(f"SHEETS_TOKEN_REFRESH_FAILED account={self.path} error={task.exception()!r}")
+
+    async def token(self, force_refresh: bool = False) -> str:
+        creds = self._credentials()
+        if force_refresh or not creds.valid:
+            await self._start_refresh()
+        elif self._expires_in() < TOKEN_REFRESH_MARGIN:
+            # Refresh ahead of expiry without making this request wait for it.
+            self._start_refresh().add_done_callback(self._log_background_failure)
+        return creds.token
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            _load_google_api()
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=SESSION_MAX_CONNECTIONS, keepalive_timeout=60),
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+_accounts: dict[str, ServiceAccount] = {}
+
+
+def _account_for(path: str) -> ServiceAccount:
+    account = _accounts.get(path)
+    if account is None:
+        account = _accounts[path] = ServiceAccount(path)
+    return account
+
+
+async def close_sessions():
+    """Close the shared HTTP sessions; call once on shutdown, after every client is flushed."""
+    for account in _accounts.values():
+        await account.close()
+
+
+def _is_transient(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, ssl.SSLError, ConnectionError)):
+        return True
+    return aiohttp is not None and isinstance(error, aiohttp.ClientError)
 
 
 def normalize_uid_value(value) -> str:
@@ -101,169 +454,599 @@ def _last_data_row(rows: list[list]) -> int:
             last_row = row_num
     return last_row
 
+def _load_sheet_meta(sid: str) -> list[dict] | None:
+    try:
+        with open(SHEETS_META_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    entry = data.get(sid) if isinstance(data, dict) else None
+    return entry if isinstance(entry, list) else None
+
+
+def _store_sheet_meta(sid: str, sheets_meta: list[dict]):
+    # Small file, written once per refresh: a plain read-modify-replace on the loop thread.
+    try:
+        with open(SHEETS_META_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    data[sid] = sheets_meta
+
+    tmp_path = f"{SHEETS_META_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, SHEETS_META_PATH)
+    except OSError as e:
+        print(f"SHEETS_META_SAVE_FAILED path={SHEETS_META_PATH} error={e}")
+
+
+def _write_bytes(path: str, content: bytes):
+    with open(path, "wb") as f:
+        f.write(content)
+
 def export_range_for_rows(rows: list[list]) -> str:
     last_col = _column_letter(EXPORT_TOTAL_COLS)
     return f"{EXPORT_FIRST_COL}{EXPORT_FIRST_ROW}:{last_col}{_last_data_row(rows)}"
 
+def start_user_row(full_name: str, start_date: str, uid: int) -> list[str]:
+    """A new participant's row: ФИО in A, start date in I, uid in J."""
+    new_row = [""] * TOTAL_COLS
+    new_row[0] = (full_name or "").strip()  # A
+    new_row[8] = (start_date or "").strip()  # I
+    new_row[9] = str(uid)  # J
+    return new_row
+
+def rows_from_columns(columns: dict[str, list]) -> list[list]:
+    """Positional rows (A=0) holding only the given columns, for code written against rows()."""
+    height = max((len(values) for values in columns.values()), default=0)
+    width = max((ord(letter) - ord("A") + 1 for letter in columns), default=0)
+    rows = [[""] * width for _ in range(height)]
+    for letter, values in columns.items():
+        c = ord(letter) - ord("A")
+        for i, value in enumerate(values):
+            rows[i][c] = value
+    return rows
+
 class Sheets:
-    def __init__(self, spreadsheet_id: str, sheet_name: str, export_scale: int = DEFAULT_EXPORT_SCALE):
-        _load_google_api()
-
-        if not os.path.exists(SERVICE_ACCOUNT_PATH):
-            raise FileNotFoundError(f"service_account.json not found at: {SERVICE_ACCOUNT_PATH}")
-
-        creds = Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_PATH,
-            scopes=[
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive",
-            ],
-        )
+    """Async client for one sheet of one spreadsheet.
+
+    Nothing is fetched on construction: the sheet id is resolved on first
+    use, credentials and the HTTP session come from the shared ServiceAccount.
+    """
 
-        self.sheets = build("sheets", "v4", credentials=creds)
-        self.drive  = build("drive", "v3", credentials=creds)
+    def __init__(
+        self,
+        spreadsheet_id: str,
+        sheet_name: str,
+        export_scale: int = DEFAULT_EXPORT_SCALE,
+        rows_cache_ttl: float | None = None,
+    ):
         self.sid = spreadsheet_id
         self.sheet = sheet_name
         self.sheet_ref = _sheet_ref(sheet_name)
         self.export_scale = int(export_scale or DEFAULT_EXPORT_SCALE)
+        self.sheet_id = None
+        self.grid_size: tuple[int, int] | None = None
+        # A sheet id read from SHEETS_META_PATH is trusted until Google rejects it.
+        self._sheet_id_verified = False
+        self.bulkhead = _bulkhead_for(spreadsheet_id)
+
+        self.account = _account_for(SERVICE_ACCOUNT_PATH)
 
         self._rows_cache = None
         self._rows_cache_ts = 0.0
-        self._rows_cache_ttl = 2.0
+        self._rows_fetched_ts = 0.0
+        self._sheet_modified = None
+        self._probe_enabled = True
+        self._rows_cache_ttl = ROWS_CACHE_TTL if rows_cache_ttl is None else float(rows_cache_ttl)
+        self._cache_stats = {
+            "hits": 0, "misses": 0, "patches": 0, "probes": 0, "revalidated": 0, "column_fetches": 0,
+        }
+        # Column letter -> values from row 2 down, for callers that asked only
+        # for a few columns while the full snapshot was stale.
+        self._columns_cache: dict[str, list] = {}
+        self._columns_ts: dict[str, float] = {}
+        # Normalized UID -> row numbers, rebuilt with every fetched snapshot
+        # and kept in step with our own writes to column J.
+        self._uid_rows: dict[str, list[int]] = {}
+        # enrollment.NameIndex over the same snapshot, built on first name lookup.
+        self._name_index = None
 
-        meta_req = self.sheets.spreadsheets().get(spreadsheetId=self.sid)
-        meta = self._exec(meta_req)
-        self.sheet_id = None
-        for sh in meta.get("sheets", []):
-            props = sh.get("properties", {})
-            if props.get("title") == self.sheet:
-                self.sheet_id = props.get("sheetId")
-                break
-        if self.sheet_id is None:
-            self.sheet_id = meta["sheets"][0]["properties"]["sheetId"]
+        # (row, col) -> value; a later write to the same cell replaces the earlier one.
+        self._pending_writes: dict[tuple[int, str], object] = {}
+        # The batch flush() is sending right now; reads overlay it like queued writes.
+        self._sending_writes: dict[tuple[int, str], object] = {}
+        # The most urgent priority among the queued writes; the batch goes out at it.
+        self._pending_priority = PRIORITY_BULK
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    # --- transport ---
+
+    async def _send(self, method: str, url: str, params: dict | None, body: dict | None, raw: bool, force_refresh: bool = False):
+        """One HTTP round trip; returns the status and the parsed JSON, raw bytes or error text."""
+        headers = {"Authorization": f"Bearer {await self.account.token(force_refresh)}"}
+        session = self.account.get_session()
+        async with session.request(method, url, params=params, json=body, headers=headers) as resp:
+            if resp.status >= 400:
+                return resp.status, await resp.text()
+            if raw:
+                return resp.status, await resp.read()
+            return resp.status, await resp.json(content_type=None)
 
-    def _exec(self, request, retries: int = 8, base_sleep: float = 0.8):
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        *,
+        params: dict | None = None,
+        body: dict | None = None,
+        raw: bool = False,
+        retries: int = 8,
+        base_sleep: float = 0.8,
+    ):
+        # Wait for quota before taking a slot, so low-priority calls parked on
+        # the bucket do not hold the in-flight slots interactive writes need.
+        await self._throttle(method, url)
+        # The slot is held through backoff too: a throttled spreadsheet
+        # queues up against its own limit, never against another group's.
+        async with self.bulkhead.slot():
+            return await self._request_with_retries(method, url, params, body, raw, retries, base_sleep)
+
+    async def _throttle(self, method: str, url: str, drain: bool = False):
+        # Only the Sheets API counts against the Sheets quota; Drive and export do not.
+        if not url.startswith(SHEETS_API):
+            return
+        buckets = _buckets_for(self.sid, method != "GET")
+        if drain:
+            for bucket in buckets:
+                bucket.drain()
+        priority = _priority.get()
+        for bucket in buckets:
+            await bucket.acquire(priority)
+
+    async def _request_with_retries(self, method, url, params, body, raw, retries, base_sleep):
+        force_refresh = False
+        throttled = False
         for attempt in range(retries):
+            if attempt:
+                await self._throttle(method, url, drain=throttled)
+            throttled = False
             try:
-                return request.execute()
-
-            except HttpError as e:
-                status = getattr(e.resp, "status", None)
-                if status in (429, 500, 503):
-                    sleep_s = min(base_sleep * (2 ** attempt) + random.random(), 60)
-                    time.sleep(sleep_s)
-                    continue
-                raise
+                status, payload = await self._send(method, url, params, body, raw, force_refresh)
+            except Exception as e:
+                if not _is_transient(e):
+                    raise
+                await asyncio.sleep(min(base_sleep * (2 ** attempt) + random.random(), 30))
+                continue
 
-            except ssl.SSLError:
-                sleep_s = min(base_sleep * (2 ** attempt) + random.random(), 30)
-                time.sleep(sleep_s)
+            force_refresh = False
+            throttled = status == 429
+            if status in RETRY_STATUSES:
+                # Other chats keep being served while this spreadsheet backs off.
+                await asyncio.sleep(min(base_sleep * (2 ** attempt) + random.random(), 60))
+                continue
+            if status == 401 and attempt == 0:
+                force_refresh = True
                 continue
+            if status >= 400:
+                raise GoogleApiError(status, str(payload)[:500])
+            return payload
 
         raise RuntimeError("Google API request failed after retries")
 
+    def _values_url(self, cell_range: str, suffix: str = "") -> str:
+        return f"{SHEETS_API}/{self.sid}/values/{quote(f'{self.sheet_ref}!{cell_range}', safe='')}{suffix}"
+
+    async def close(self):
+        """Send queued writes; the shared session is closed by close_sessions()."""
+        await self.flush()
+
+    # --- reads and writes ---
+
+    async def get_sheet_id(self) -> int:
+        if self.sheet_id is not None:
+            return self.sheet_id
+
+        cached = _load_sheet_meta(self.sid)
+        if cached and self._use_sheet_meta(cached, exact=True):
+            return self.sheet_id
+        return await self.refresh_metadata()
+
+    async def refresh_metadata(self) -> int:
+        """Re-read sheet ids, titles and grid sizes from Google and save them to SHEETS_META_PATH."""
+        meta = await self._request(
+            "GET",
+            f"{SHEETS_API}/{self.sid}",
+            params={"fields": SHEET_PROPERTIES_FIELDS},
+        )
+        sheets_meta = []
+        for sh in meta.get("sheets", []):
+            props = sh.get("properties", {})
+            grid = props.get("gridProperties", {})
+            sheets_meta.append({
+                "sheetId": props.get("sheetId"),
+                "title": props.get("title"),
+                "rowCount": grid.get("rowCount"),
+                "columnCount": grid.get("columnCount"),
+            })
+        self._use_sheet_meta(sheets_meta, exact=False)
+        self._sheet_id_verified = True
+        _store_sheet_meta(self.sid, sheets_meta)
+        return self.sheet_id
+
+    def _use_sheet_meta(self, sheets_meta: list[dict], exact: bool) -> bool:
+        chosen = next((sh for sh in sheets_meta if sh.get("title") == self.sheet), None)
+        if chosen is None:
+            if exact:
+                # The sheet may have been added or renamed since the file was saved.
+                return False
+            chosen = sheets_meta[0]
+        self.sheet_id = chosen["sheetId"]
+        self.grid_size = (chosen.get("rowCount"), chosen.get("columnCount"))
+        return True
+
+    async def _with_verified_sheet_id(self, call):
+        """Run call(); if a sheet id taken from disk is rejected, refresh it once and retry."""
+        try:
+            result = await call()
+        except GoogleApiError as e:
+            if self._sheet_id_verified or e.status not in (400, 404):
+                raise
+            print(f"SHEETS_META_STALE sid={self.sid} sheet_id={self.sheet_id} status={e.status}")
+            await self.refresh_metadata()
+            result = await call()
+        self._sheet_id_verified = True
+        return result
+
+    def invalidate(self):
+        """Treat the rows snapshot as stale, e.g. before a job that must see manual edits.
+
+        The next rows() asks Drive whether the file changed and refetches A2:K only then.
+        """
+        self._rows_cache_ts = 0.0
+        self._columns_ts = {}
+
+    def cache_stats(self) -> dict:
+        return dict(self._cache_stats)
+
     def _drop_cache(self):
         self._rows_cache = None
         self._rows_cache_ts = 0.0
+        self._columns_cache = {}
+        self._columns_ts = {}
+        self._uid_rows = {}
+        self._name_index = None
+
+    async def rows(self):
+        """The A2:K snapshot, including writes still queued; treat it as read-only.
 
-    def rows(self):
+        Reads never wait for queued writes to go out: they are overlaid on what
+        Google returns. If the refresh fails, the stale snapshot is served.
+        """
         now = time.time()
-        if self._rows_cache is not None and (now - self._rows_cache_ts) <= self._rows_cache_ttl:
+        if self._rows_cache is not None and (now - self._rows_cache_ts) < self._rows_cache_ttl:
+            self._cache_stats["hits"] += 1
             return self._rows_cache
 
-        req = self.sheets.spreadsheets().values().get(
-            spreadsheetId=self.sid,
-            range=f"{self.sheet_ref}!{RANGE_ROWS}",
-        )
-        vals = self._exec(req).get("values", [])
-        self._rows_cache = vals
-        self._rows_cache_ts = now
-        return vals
+        try:
+            return await self._refresh_rows(now)
+        except Exception as e:
+            if self._rows_cache is None:
+                raise
+            print(f"SHEETS_STALE_ROWS sid={self.sid} error={e!r}")
+            return self._rows_cache
+
+    async def _refresh_rows(self, now: float) -> list:
+        modified = None
+        probed = False
+        if self._rows_cache is not None and (now - self._rows_fetched_ts) < ROWS_CACHE_MAX_AGE:
+            # Writes still queued change modifiedTime once they go out, so the
+            # next probe refetches rather than trusting a snapshot without them.
+            modified = await self._probe_modified()
+            probed = True
+            if modified is not None and modified == self._sheet_modified:
+                self._cache_stats["revalidated"] += 1
+                self._rows_cache_ts = now
+                return self._rows_cache
+
+        self._cache_stats["misses"] += 1
+        if not probed:
+            # Record modifiedTime with the first full read too, or the first
+            # revalidation could never match. The probe must finish before the
+            # GET: an edit landing between them then only costs a refetch, where
+            # the other order would pair a newer time with older rows.
+            modified = await self._probe_modified()
+        res = await self._request("GET", self._values_url(RANGE_ROWS))
+        self._sheet_modified = modified
+        self._set_rows(res.get("values", []), now)
+        return self._rows_cache
+
+    async def columns(self, *letters: str) -> dict[str, list]:
+        """{letter: values from row 2 down} for just these columns; treat the lists as read-only.
+
+        A column ends at its last non-empty cell. While the rows snapshot is
+        fresh the values come from it; otherwise the stale columns are read
+        with one values:batchGet and cached next to it, our writes included.
+        """
+        letters = tuple(dict.fromkeys(letter.upper() for letter in letters))
+        now = time.time()
+        if self._rows_cache is not None and (now - self._rows_cache_ts) < self._rows_cache_ttl:
+            self._cache_stats["hits"] += 1
+            return {letter: self._column_from_rows(letter) for letter in letters}
+
+        stale = [
+            letter for letter in letters
+            if letter not in self._columns_cache or (now - self._columns_ts.get(letter, 0.0)) >= self._rows_cache_ttl
+        ]
+        if not stale:
+            self._cache_stats["hits"] += 1
+            return {letter: self._columns_cache[letter] for letter in letters}
+
+        self._cache_stats["column_fetches"] += 1
+        try:
+            res = await self._request(
+                "GET",
+                f"{SHEETS_API}/{self.sid}/values:batchGet",
+                params=[("ranges", f"{self.sheet_ref}!{letter}2:{letter}") for letter in stale]
+                + [("majorDimension", "COLUMNS")],
+            )
+        except Exception as e:
+            # Google is unreachable: answer from what we have rather than fail the handler.
+            if not all(letter in self._columns_cache or self._rows_cache is not None for letter in letters):
+                raise
+            print(f"SHEETS_STALE_COLUMNS sid={self.sid} columns={''.join(stale)} error={e!r}")
+            return {
+                letter: self._columns_cache[letter] if letter in self._columns_cache else self._column_from_rows(letter)
+                for letter in letters
+            }
+        for letter, value_range in zip(stale, res.get("valueRanges", [])):
+            values = value_range.get("values") or [[]]
+            self._columns_cache[letter] = values[0]
+            self._columns_ts[letter] = now
+            if letter == UID_COL_LETTER:
+                self._index_uids(enumerate(values[0], start=2))
+
+        for (row, col), val in self._unsent_writes():
+            if col in stale:
+                self._patch_cell(row, col, val)
+        return {letter: self._columns_cache[letter] for letter in letters}
+
+    def _column_from_rows(self, letter: str) -> list:
+        c = self._col_index(letter)
+        column = [r[c] if len(r) > c else "" for r in self._rows_cache]
+        while column and column[-1] == "":
+            column.pop()
+        return column
+
+    async def _probe_modified(self) -> Optional[str]:
+        """Drive's modifiedTime for the spreadsheet, or None when it cannot be read."""
+        if not self._probe_enabled:
+            return None
+        self._cache_stats["probes"] += 1
+        try:
+            meta = await self._request(
+                "GET",
+                f"{DRIVE_FILES_API}/{self.sid}",
+                params={"fields": "modifiedTime", "supportsAllDrives": "true"},
+            )
+        except GoogleApiError as e:
+            # Drive API disabled or no access to the file: plain refetches from now on.
+            print(f"SHEETS_PROBE_DISABLED sid={self.sid} status={e.status}")
+            self._probe_enabled = False
+            return None
+        return meta.get("modifiedTime")
+
+    def _set_rows(self, rows: list, fetched_at: float):
+        self._rows_cache = rows
+        self._rows_cache_ts = fetched_at
+        self._rows_fetched_ts = fetched_at
+        self._name_index = None
+        # The new snapshot is fresher than any column read on its own.
+        self._columns_cache = {}
+        self._columns_ts = {}
+        self._index_uids((row_num, r[UID_INDEX]) for row_num, r in enumerate(rows, start=2) if len(r) > UID_INDEX)
+
+        # Writes queued or being sent while the fetch was in flight may not be in its result yet.
+        for (row, col), val in self._unsent_writes():
+            self._patch_cell(row, col, val)
+
+    def _unsent_writes(self) -> list:
+        """Writes Google has not confirmed yet, oldest first."""
+        return list(self._sending_writes.items()) + list(self._pending_writes.items())
+
+    def _index_uids(self, cells):
+        """Rebuild the UID index from (row number, column J value) pairs."""
+        index: dict[str, list[int]] = {}
+        for row_num, value in cells:
+            uid = normalize_uid_value(value)
+            if uid:
+                index.setdefault(uid, []).append(row_num)
+        self._uid_rows = index
+        for uid, uid_rows in index.items():
+            if len(uid_rows) > 1:
+                print(f"SHEETS_DUPLICATE_UID sid={self.sid} uid={uid} rows={uid_rows}")
+
+    def _cached_row(self, row: int) -> list:
+        rows = self._rows_cache
+        while len(rows) < row - 1:
+            rows.append([])
+        return rows[row - 2]
+
+    def _patch_cell(self, row: int, col: str, val):
+        column = self._columns_cache.get(col)
+        if self._rows_cache is None and column is None:
+            return
+        self._cache_stats["patches"] += 1
+        val = val if isinstance(val, str) else str(val)
+        old = None
+
+        if column is not None:
+            while len(column) < row - 1:
+                column.append("")
+            old = column[row - 2]
+            column[row - 2] = val
+
+        c = self._col_index(col)
+        if self._rows_cache is not None:
+            r = self._cached_row(row)
+            while len(r) <= c:
+                r.append("")
+            old = r[c]
+            names = self._name_index if c in (0, 1) else None
+            if names is not None:
+                names.discard(row, r)
+            r[c] = val
+            if names is not None:
+                names.add(row, r)
+
+        if c == UID_INDEX:
+            self._reindex_uid(row, old, val)
+
+    def _reindex_uid(self, row: int, old, new):
+        old_uid = normalize_uid_value(old)
+        if old_uid in self._uid_rows and row in self._uid_rows[old_uid]:
+            self._uid_rows[old_uid].remove(row)
+            if not self._uid_rows[old_uid]:
+                del self._uid_rows[old_uid]
+
+        new_uid = normalize_uid_value(new)
+        if new_uid:
+            uid_rows = self._uid_rows.setdefault(new_uid, [])
+            uid_rows.append(row)
+            uid_rows.sort()
+            if len(uid_rows) > 1:
+                print(f"SHEETS_DUPLICATE_UID sid={self.sid} uid={new_uid} rows={uid_rows}")
+
+    def duplicate_uids(self) -> dict[str, list[int]]:
+        """UIDs that appear in more than one row of the current snapshot."""
+        return {uid: list(rows) for uid, rows in self._uid_rows.items() if len(rows) > 1}
 
     def write(self, row: int, col: str, val):
-        req = self.sheets.spreadsheets().values().update(
-            spreadsheetId=self.sid,
-            range=f"{self.sheet_ref}!{col}{row}",
-            valueInputOption="RAW",
-            body={"values": [[val]]},
-        )
-        self._exec(req)
-        self._drop_cache()
+        """Queue a cell write; it is sent with the next flush() and visible in rows() right away."""
+        col = col.upper()
+        self._pending_writes[(row, col)] = val
+        self._pending_priority = min(self._pending_priority, _priority.get())
+        self._patch_cell(row, col, val)
+        self._schedule_flush()
 
-    def get_cell(self, cell: str) -> str:
-        req = self.sheets.spreadsheets().values().get(
-            spreadsheetId=self.sid,
-            range=f"{self.sheet_ref}!{cell}",
-        )
-        res = self._exec(req)
+    def _schedule_flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Outside the bot loop writes wait for an explicit flush() or the next read.
+            return
+        self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Writes made while a batch is in flight see this task running and
+        # schedule nothing, so keep going until the buffer is empty.
+        while True:
+            await asyncio.sleep(WRITE_BUFFER_DELAY)
+            try:
+                await self.flush()
+            except Exception:
+                print(f"SHEETS_FLUSH_FAILED sid={self.sid} pending={len(self._pending_writes)}")
+                traceback.print_exc()
+                return
+            if not self._pending_writes:
+                return
+
+    async def flush(self) -> int:
+        """Send all queued cell writes as one values:batchUpdate; returns the cells written."""
+        # One flush at a time, so batches reach Google in the order they were queued.
+        async with self._flush_lock:
+            if not self._pending_writes:
+                return 0
+
+            pending, self._pending_writes = self._pending_writes, {}
+            self._sending_writes = pending
+            # The shared timer task carries the priority of whoever opened the
+            # buffer; an interactive write that joined it must not wait as bulk.
+            priority = min(self._pending_priority, _priority.get())
+            self._pending_priority = PRIORITY_BULK
+            body = {
+                "valueInputOption": "RAW",
+                "data": [
+                    {"range": f"{self.sheet_ref}!{col}{row}", "values": [[val]]}
+                    for (row, col), val in pending.items()
+                ],
+            }
+            try:
+                with request_priority(priority):
+                    await self._request("POST", f"{SHEETS_API}/{self.sid}/values:batchUpdate", body=body)
+            except BaseException:
+                # Writes queued meanwhile are newer and must win.
+                pending.update(self._pending_writes)
+                self._pending_writes = pending
+                self._pending_priority = min(self._pending_priority, priority)
+                # The snapshot shows these writes, and they are queued again, so it
+                # stays usable while Google is down; refetch when it is reachable.
+                self.invalidate()
+                raise
+            finally:
+                self._sending_writes = {}
+            return len(pending)
+
+    async def get_cell(self, cell: str) -> str:
+        await self.flush()
+        res = await self._request("GET", self._values_url(cell))
         vals = res.get("values", [])
         return vals[0][0] if vals and vals[0] else ""
 
+    async def read_row(self, row: int) -> list[str]:
+        """Cells A..K of one row, queued writes included: from a fresh snapshot, else one GET.
+
+        When the GET fails, a stale snapshot is used if there is one.
+        """
+        if self._rows_cache is not None and (time.time() - self._rows_cache_ts) < self._rows_cache_ttl:
+            self._cache_stats["hits"] += 1
+            return self._cached_cells(row)
+
+        try:
+            res = await self._request("GET", self._values_url(f"A{row}:K{row}"))
+        except Exception as e:
+            if self._rows_cache is None:
+                raise
+            print(f"SHEETS_STALE_ROW sid={self.sid} row={row} error={e!r}")
+            return self._cached_cells(row)
+        vals = res.get("values", [])
+        cells = [str(v) for v in (vals[0] if vals else [])] + [""] * TOTAL_COLS
+        for (write_row, col), val in self._unsent_writes():
+            if write_row == row:
+                cells[self._col_index(col)] = val if isinstance(val, str) else str(val)
+        return cells[:TOTAL_COLS]
+
+    def _cached_cells(self, row: int) -> list[str]:
+        cells = self._rows_cache[row - 2] if 0 <= row - 2 < len(self._rows_cache) else []
+        return [str(v) for v in cells] + [""] * (TOTAL_COLS - len(cells))
+
     def _col_index(self, col_letter: str) -> int:
         return ord(col_letter.upper()) - ord("A")
 
-    def paint_row(self, row: int, color: dict):
-        req = self.sheets.spreadsheets().batchUpdate(
-            spreadsheetId=self.sid,
-            body={"requests": [{
-                "repeatCell": {
-                    "range": {
-                        "sheetId": self.sheet_id,
-                        "startRowIndex": row - 1,
-                        "endRowIndex": row,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": TOTAL_COLS,
-                    },
-                    "cell": {"userEnteredFormat": {"backgroundColor": color}},
-                    "fields": "userEnteredFormat.backgroundColor",
-                }
-            }]}
-        )
-        self._exec(req)
-
-    def clear_row_background(self, row: int):
-        req = self.sheets.spreadsheets().batchUpdate(
-            spreadsheetId=self.sid,
-            body={"requests": [{
-                "repeatCell": {
-                    "range": {
-                        "sheetId": self.sheet_id,
-                        "startRowIndex": row - 1,
-                        "endRowIndex": row,
-                        "startColumnIndex": 0,
-                        "endColumnIndex": TOTAL_COLS,
-                    },
-                    "cell": {"userEnteredFormat": {}},
-                    "fields": "userEnteredFormat.backgroundColor",
-                }
-            }]}
-        )
-        self._exec(req)
+    def formatting(self) -> "SheetFormatBatch":
+        """Collect row/cell painting and send it with as few batchUpdate calls as possible."""
+        return SheetFormatBatch(self)
+
+    async def paint_row(self, row: int, color: dict):
+        async with self.formatting() as batch:
+            batch.paint_row(row, color)
 
-    def paint_cell(self, row: int, col_letter: str, color: dict):
-        c = self._col_index(col_letter)
-        req = self.sheets.spreadsheets().batchUpdate(
-            spreadsheetId=self.sid,
-            body={"requests": [{
-                "repeatCell": {
-                    "range": {
-                        "sheetId": self.sheet_id,
-                        "startRowIndex": row - 1,
-                        "endRowIndex": row,
-                        "startColumnIndex": c,
-                        "endColumnIndex": c + 1
-                    },
-                    "cell": {"userEnteredFormat": {"backgroundColor": color}},
-                    "fields": "userEnteredFormat.backgroundColor"
-                }
-            }]}
-        )
-        self._exec(req)
+    async def clear_row_background(self, row: int):
+        async with self.formatting() as batch:
+            batch.clear_row_background(row)
 
-    def export_pdf(self) -> str:
-        import requests
+    async def paint_cell(self, row: int, col_letter: str, color: dict):
+        async with self.formatting() as batch:
+            batch.paint_cell(row, col_letter, color)
 
-        token = self.sheets._http.credentials.token
+    async def export_pdf(self) -> str:
         params = {
             "format": "pdf",
             "portrait": "true",
@@ -279,127 +1062,179 @@ class Sheets:
             "pagenumbers": "false",
             "gridlines": "false",
             "fzr": "false",
-            "gid": str(self.sheet_id),
-            "range": export_range_for_rows(self.rows()),
+            "range": export_range_for_rows(await self.rows()),
         }
-        url = f"https://docs.google.com/spreadsheets/d/{self.sid}/export?{urlencode(params)}"
+        await self.get_sheet_id()
 
-        headers = {
-            "Authorization": f"Bearer {token}"
-        }
+        async def download():
+            params["gid"] = str(self.sheet_id)
+            url = f"{EXPORT_URL.format(sid=self.sid)}?{urlencode(params)}"
+            return await self._request("GET", url, raw=True)
 
-        r = requests.get(url, headers=headers)
-        r.raise_for_status()
+        content = await self._with_verified_sheet_id(download)
 
         out_dir = os.path.join(BASE_DIR, "out")
         os.makedirs(out_dir, exist_ok=True)
         pdf_path = os.path.join(out_dir, f"sheet_{uuid.uuid4().hex}.pdf")
 
-        with open(pdf_path, "wb") as f:
-            f.write(r.content)
-
+        await self.bulkhead.run_blocking(_write_bytes, pdf_path, content)
         return pdf_path
 
-    def find_row_by_uid(self, uid: int) -> Optional[int]:
+    async def find_row_by_uid(self, uid: int) -> Optional[int]:
         target_uid = normalize_uid_value(uid)
         if not target_uid:
             return None
 
-        rows = self.rows()
-        for idx, r in enumerate(rows, start=2):
-            if len(r) <= UID_INDEX:
-                continue
-            if normalize_uid_value(r[UID_INDEX]) == target_uid:
-                return idx
-        return None
+        await self.columns(UID_COL_LETTER)
+        uid_rows = self._uid_rows.get(target_uid)
+        if not uid_rows:
+            return None
+        if len(uid_rows) > 1:
+            print(f"SHEETS_DUPLICATE_UID sid={self.sid} uid={target_uid} rows={uid_rows} using={uid_rows[0]}")
+        return uid_rows[0]
 
-    def find_rows_by_surname(self, surname: str) -> List[int]:
-        surname = _norm(surname)
-        if not surname:
-            return []
+    async def name_index(self):
+        """enrollment.NameIndex for the current snapshot, kept up to date with our writes to A and B."""
+        _rows, names = await self.rows_with_names()
+        return names
 
-        rows = self.rows()
-        found: List[int] = []
+    async def rows_with_names(self):
+        """(rows(), name_index()) taken from the same snapshot, with no await in between."""
+        rows = await self.rows()
+        if self._name_index is None:
+            from enrollment import NameIndex
 
-        for idx, r in enumerate(rows, start=2):
-            a = _norm(str(r[0]) if len(r) > 0 else "")
+            self._name_index = NameIndex(rows)
+        return rows, self._name_index
 
-            # новый формат: A == фамилия
-            if a == surname:
-                found.append(idx)
-                continue
+    async def find_rows_by_surname(self, surname: str) -> List[int]:
+        # A == фамилия, или старые строки, где в A было "Фамилия Имя"
+        return (await self.name_index()).rows_by_surname(surname)
 
-            # страховка на случай старых строк, где в A было "Фамилия Имя"
-            if a.split(" ", 1)[0] == surname:
-                found.append(idx)
+    async def find_row_by_surname_name(self, surname: str, name: str) -> Optional[int]:
+        return (await self.name_index()).row_by_surname_name(surname, name)
+
+    def set_uid(self, row: int, uid: int):
+        self.write(row, UID_COL_LETTER, str(uid))
 
-        return found
+    async def append_rows(self, new_rows: list[list]) -> list[int]:
+        """Append rows with a single values:append; returns their row numbers in order."""
+        if not new_rows:
+            return []
 
-    def find_row_by_surname_name(self, surname: str, name: str) -> Optional[int]:
-        surname = _norm(surname)
-        name = _norm(name)
-        if not surname:
-            return None
-        rows = self.rows()
-        for idx, r in enumerate(rows, start=2):
-            a = str(r[0]).strip().lower()
-            b = str(r[1]).strip().lower() if len(r) > 1 else ""
-            if a == surname and (not name or b == name):
-                return idx
+        await self.flush()
+        res = await self._request(
+            "POST",
+            self._values_url("A:K", ":append"),
+            params={"valueInputOption": "RAW", "insertDataOption": "INSERT_ROWS"},
+            body={"values": new_rows},
+        )
+        updated_range = res.get("updates", {}).get("updatedRange", "")
+        m = re.search(r"!(?:A)?(\d+):", updated_range)
+        if not m:
+            self._drop_cache()
+            last = len(await self.rows()) + 1
+            return list(range(last - len(new_rows) + 1, last + 1))
 
-        return None
+        first = int(m.group(1))
+        if self._rows_cache is None or first != len(self._rows_cache) + 2:
+            # INSERT_ROWS went in above a blank row and shifted everything below
+            # it, or we have no snapshot to extend: the cached positions are wrong.
+            self._drop_cache()
+            return list(range(first, first + len(new_rows)))
 
-    def set_uid(self, row: int, uid: int):
-        self.write(row, UID_COL_LETTER, str(uid))
+        for row, new_row in enumerate(new_rows, start=first):
+            for c, val in enumerate(new_row):
+                if val:
+                    self._patch_cell(row, _column_letter(c + 1), val)
+        return list(range(first, first + len(new_rows)))
 
-    def append_user(self, surname: str, name: str, uid: int) -> int:
-        full_name = (surname or "").strip()
-        if name:
-            full_name = f"{full_name} {name.strip()}"
+    async def _append_row(self, new_row: list) -> int:
+        return (await self.append_rows([new_row]))[0]
 
+    async def append_user(self, surname: str, name: str, uid: int) -> int:
         # A..K (11 колонок)
         new_row = [""] * TOTAL_COLS
         new_row[0] = surname or ""  # A
         new_row[1] = name or ""  # B
         new_row[9] = str(uid)  # J
+        return await self._append_row(new_row)
 
-        req = self.sheets.spreadsheets().values().append(
-            spreadsheetId=self.sid,
-            range=f"{self.sheet_ref}!A:K",
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body={"values": [new_row]},
-        )
-        res = self._exec(req)
-        self._drop_cache()
+    async def append_start_user(self, full_name: str, start_date: str, uid: int) -> int:
+        return await self._append_row(start_user_row(full_name, start_date, uid))
 
-        updated_range = res.get("updates", {}).get("updatedRange", "")
-        m = re.search(r"!(?:A)?(\d+):", updated_range)
-        if m:
-            return int(m.group(1))
-
-        return len(self.rows()) + 1
-
-    def append_start_user(self, full_name: str, start_date: str, uid: int) -> int:
-        new_row = [""] * TOTAL_COLS
-        new_row[0] = (full_name or "").strip()  # A
-        new_row[8] = (start_date or "").strip()  # I
-        new_row[9] = str(uid)  # J
-
-        req = self.sheets.spreadsheets().values().append(
-            spreadsheetId=self.sid,
-            range=f"{self.sheet_ref}!A:K",
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body={"values": [new_row]},
-        )
-        res = self._exec(req)
-        self._drop_cache()
 
-        updated_range = res.get("updates", {}).get("updatedRange", "")
-        m = re.search(r"!(?:A)?(\d+):", updated_range)
-        if m:
-            return int(m.group(1))
+class SheetFormatBatch:
+    """repeatCell requests for one sheet, sent on commit() or when the ``async with`` block ends."""
 
-        return len(self.rows()) + 1
+    def __init__(self, sheets: Sheets):
+        self.sheets = sheets
+        self.requests: list[dict] = []
+
+    async def __aenter__(self) -> "SheetFormatBatch":
+        await self.sheets.get_sheet_id()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        return False
+
+    def paint_row(self, row: int, color: dict):
+        self._add(row, 0, TOTAL_COLS, {"backgroundColor": color})
+
+    def clear_row_background(self, row: int):
+        self._add(row, 0, TOTAL_COLS, {})
+
+    def paint_cell(self, row: int, col_letter: str, color: dict):
+        c = self.sheets._col_index(col_letter)
+        self._add(row, c, c + 1, {"backgroundColor": color})
+
+    def _add(self, row: int, start_col: int, end_col: int, cell_format: dict):
+        if self.requests:
+            # Соседние строки с тем же цветом склеиваем в один диапазон.
+            last = self.requests[-1]["repeatCell"]
+            rng = last["range"]
+            if (
+                rng["endRowIndex"] == row - 1
+                and rng["startColumnIndex"] == start_col
+                and rng["endColumnIndex"] == end_col
+                and last["cell"]["userEnteredFormat"] == cell_format
+            ):
+                rng["endRowIndex"] = row
+                return
+
+        self.requests.append({
+            "repeatCell": {
+                "range": {
+                    "sheetId": self.sheets.sheet_id,
+                    "startRowIndex": row - 1,
+                    "endRowIndex": row,
+                    "startColumnIndex": start_col,
+                    "endColumnIndex": end_col,
+                },
+                "cell": {"userEnteredFormat": cell_format},
+                "fields": "userEnteredFormat.backgroundColor",
+            }
+        })
+
+    async def commit(self) -> int:
+        """Send the collected requests; returns the number of batchUpdate calls made."""
+        requests, self.requests = self.requests, []
+        calls = 0
+        for start in range(0, len(requests), FORMAT_BATCH_MAX_REQUESTS):
+            chunk = requests[start:start + FORMAT_BATCH_MAX_REQUESTS]
+
+            async def send(chunk=chunk):
+                # The id is filled in at send time so a refreshed one reaches the retry.
+                for request in chunk:
+                    request["repeatCell"]["range"]["sheetId"] = self.sheets.sheet_id
+                await self.sheets._request(
+                    "POST",
+                    f"{SHEETS_API}/{self.sheets.sid}:batchUpdate",
+                    body={"requests": chunk},
+                )
 
+            await self.sheets._with_verified_sheet_id(send)
+            calls += 1
+        return calls
@@ -1,11 +1,45 @@
+import atexit
+import heapq
 import json
 import os
 import re
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import contextmanager
 from datetime import date
-from typing import Dict, Optional, Set, Tuple
+from urllib.parse import quote, unquote
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATE_PATH = os.path.join(BASE_DIR, "state.json")
+STATE_DB_PATH = os.path.join(BASE_DIR, "state.sqlite3")
+STATE_SHARDS_DIR = os.path.join(BASE_DIR, "state.d")
+
+# "json" keeps everything in STATE_PATH, "sharded" keeps one file per chat
+# in STATE_SHARDS_DIR, "sqlite" keeps rows in STATE_DB_PATH.
+STATE_BACKEND = "json"
+
+# Mutations are kept in memory and written out at most once per window.
+FLUSH_DELAY = 1.0
+
+# The JSON journal is folded into a fresh state.json once it grows past
+# this size or age.
+JOURNAL_MAX_BYTES = 1024 * 1024
+JOURNAL_MAX_AGE = 60 * 60
+
+# Set when several bot processes share one state: changes are then written
+# through under an fcntl lock and each process picks up the others' writes
+# before reading. POSIX only.
+STATE_SHARED = False
+
+SET_SECTIONS = ("active", "excused")
+
+_lock = threading.RLock()
+_switch_lock = threading.Lock()
+_store = None
+_write_stats = {"changes": 0, "elided_writes": 0, "flushes": 0}
 
 
 def _new_group_state() -> dict:
@@ -20,19 +54,503 @@ def _new_group_state() -> dict:
     }
 
 
-def _load_all() -> dict:
-    if not os.path.exists(STATE_PATH):
+def _read_state_file(path: str) -> dict:
+    if not os.path.exists(path):
         return {}
-    with open(STATE_PATH, "r", encoding="utf-8") as f:
+    with open(path, "r", encoding="utf-8") as f:
         try:
-            return json.load(f)
+            data = json.load(f)
         except Exception:
-            return {}
+            data = None
+
+    if isinstance(data, dict):
+        return data
+
+    # Never start from an empty state silently: keep the broken file for a manual look.
+    broken_path = f"{path}.corrupt-{int(time.time())}"
+    os.replace(path, broken_path)
+    print(f"STATE_CORRUPT path={path} moved_to={broken_path}")
+    return {}
+
+
+def _file_id(path: str):
+    # os.replace gives the new snapshot a new inode, so another process's
+    # compaction is visible even when size and mtime happen to match.
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _write_state_file(path: str, chunks: Iterable[str]):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".state-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class _FileLock:
+    """Advisory fcntl lock on a side file: shared for readers, exclusive for writers."""
+
+    def __init__(self, path: str):
+        import fcntl  # POSIX only, so it is not needed unless shared mode is on.
+
+        self.fcntl = fcntl
+        self.file = open(path, "a+")
+
+    @contextmanager
+    def __call__(self, exclusive: bool):
+        self.fcntl.flock(self.file, self.fcntl.LOCK_EX if exclusive else self.fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            self.fcntl.flock(self.file, self.fcntl.LOCK_UN)
+
+    def close(self):
+        self.file.close()
+
+
+@contextmanager
+def _no_lock(exclusive: bool):
+    yield
+
+
+class _JsonBackend:
+    """state.json snapshot plus an append-only journal of changes made since it was written."""
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compacted_at = time.monotonic()
+        # How far into the journal this process has read, and which snapshot
+        # file that offset belongs to; other processes' appends start here.
+        self.journal_offset = 0
+        self.snapshot_id = None
+        self.file_lock = _FileLock(path + ".lock") if shared else None
+        self.locked = self.file_lock or _no_lock
+
+    def load(self) -> dict:
+        data = _read_state_file(self.path)
+        self.snapshot_id = _file_id(self.path)
+        self.journal_offset = 0
+        if not os.path.exists(self.journal_path):
+            return data
+
+        for change in self._read_journal():
+            try:
+                _apply_change(data, change)
+            except (TypeError, ValueError):
+                print(f"STATE_JOURNAL_SKIP path={self.journal_path} change={change!r}")
+
+        # Drop a torn tail left by a crash mid-append, so new lines start cleanly.
+        if os.path.getsize(self.journal_path) > self.journal_offset:
+            os.truncate(self.journal_path, self.journal_offset)
+        return data
+
+    def _read_journal(self) -> list:
+        changes = []
+        with open(self.journal_path, "rb") as f:
+            f.seek(self.journal_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    changes.append(json.loads(line))
+                except ValueError:
+                    break
+                self.journal_offset += len(line)
+        return changes
+
+    def poll(self) -> Tuple[Optional[dict], list]:
+        """What other processes wrote since the last look.
+
+        Returns chat groups to replace wholesale (after a compaction) and
+        journal changes to apply on top.
+        """
+        if _file_id(self.path) != self.snapshot_id:
+            return self.load(), []
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            journal_size = 0
+        if journal_size < self.journal_offset:
+            return self.load(), []
+        if journal_size == self.journal_offset:
+            return None, []
+        return None, self._read_journal()
+
+    def write(self, changes: list, snapshot: Callable[[], dict]):
+        lines = "".join(
+            json.dumps(change, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for change in changes
+        )
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+            journal_size = f.tell()
+        self.journal_offset = journal_size
+
+        if (
+            journal_size >= JOURNAL_MAX_BYTES
+            or time.monotonic() - self.compacted_at >= JOURNAL_MAX_AGE
+        ):
+            self.compact(snapshot())
+
+    def compact(self, data: dict):
+        # iterencode is pure Python, so the event loop keeps getting the GIL
+        # while a large snapshot is encoded on the writer thread.
+        _write_state_file(self.path, json.JSONEncoder(ensure_ascii=False, indent=2).iterencode(data))
+        # Replaying changes on top of a snapshot that already has them is harmless,
+        # so a crash between these two steps loses nothing.
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+        self.snapshot_id = _file_id(self.path)
+        self.journal_offset = 0
+        self.compacted_at = time.monotonic()
+
+    def close(self):
+        if self.file_lock is not None:
+            self.file_lock.close()
+
+
+class _ShardedJsonBackend:
+    """One snapshot and journal per chat, so a write only touches the files of its chat."""
+
+    def __init__(self, directory: str, shared: bool = False):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.shards: Dict[str, _JsonBackend] = {}
+        self.file_lock = _FileLock(os.path.join(directory, ".lock")) if shared else None
+        self.locked = self.file_lock or _no_lock
+
+    def _shard(self, chat_key: str) -> _JsonBackend:
+        # Created on a chat's first write; the files appear with its first flush.
+        shard = self.shards.get(chat_key)
+        if shard is None:
+            shard = _JsonBackend(_shard_path(self.directory, chat_key))
+            self.shards[chat_key] = shard
+        return shard
+
+    def _chat_keys_on_disk(self) -> Set[str]:
+        keys = set()
+        for name in os.listdir(self.directory):
+            if name.endswith(".json.journal"):
+                name = name[: -len(".journal")]
+            if name.endswith(".json"):
+                keys.add(unquote(name[: -len(".json")]))
+        return keys
+
+    def _load_shard(self, chat_key: str) -> dict:
+        group = self._shard(chat_key).load().get(chat_key)
+        return group if isinstance(group, dict) else _new_group_state()
+
+    def load(self) -> dict:
+        self.shards = {}
+        return {chat_key: self._load_shard(chat_key) for chat_key in self._chat_keys_on_disk()}
+
+    def poll(self) -> Tuple[Optional[dict], list]:
+        reloaded: dict = {}
+        changes: list = []
+        for chat_key in self._chat_keys_on_disk():
+            if chat_key not in self.shards:
+                reloaded[chat_key] = self._load_shard(chat_key)
+                continue
+            shard_data, shard_changes = self.shards[chat_key].poll()
+            if shard_data is not None:
+                reloaded[chat_key] = shard_data.get(chat_key) or _new_group_state()
+            changes.extend(shard_changes)
+        return reloaded or None, changes
+
+    def write(self, changes: list, snapshot: Callable[..., dict]):
+        by_chat: Dict[str, list] = {}
+        for change in changes:
+            by_chat.setdefault(change[1], []).append(change)
+        for chat_key, chat_changes in by_chat.items():
+            self._shard(chat_key).write(chat_changes, lambda chat_key=chat_key: snapshot(chat_key))
+
+    def close(self):
+        if self.file_lock is not None:
+            self.file_lock.close()
+
+
+def _shard_path(directory: str, chat_key: str) -> str:
+    return os.path.join(directory, quote(chat_key, safe="-") + ".json")
+
+
+def split_state(data: dict, shards_dir: str) -> int:
+    """Write each chat of a combined state document to its own shard; returns the chats written."""
+    os.makedirs(shards_dir, exist_ok=True)
+    count = 0
+    for chat_key, group in (data or {}).items():
+        if not isinstance(group, dict):
+            continue
+        chat_key = str(chat_key)
+        _write_state_file(
+            _shard_path(shards_dir, chat_key),
+            json.JSONEncoder(ensure_ascii=False, indent=2).iterencode({chat_key: group}),
+        )
+        count += 1
+    return count
+
+
+def split_state_file(json_path: str, shards_dir: str) -> int:
+    """Split state.json (with its journal replayed) into per-chat shards."""
+    return split_state(_JsonBackend(json_path).load(), shards_dir)
+
+
+def _make_backend(kind: str, path: str, shared: bool = False):
+    if kind == "json":
+        return _JsonBackend(path, shared)
+    if kind == "sqlite":
+        from state_sqlite import SqliteBackend, migrate_state
+
+        if not os.path.exists(path) and os.path.exists(STATE_PATH):
+            migrated = migrate_state(_JsonBackend(STATE_PATH).load(), path)
+            print(f"STATE_MIGRATED rows={migrated} from={STATE_PATH} to={path}")
+        return SqliteBackend(path, shared)
+    if kind == "sharded":
+        if not os.path.exists(path) and os.path.exists(STATE_PATH):
+            migrated = split_state_file(STATE_PATH, path)
+            print(f"STATE_MIGRATED chats={migrated} from={STATE_PATH} to={path}")
+        return _ShardedJsonBackend(path, shared)
+    raise ValueError(f"Unknown STATE_BACKEND: {kind!r}")
+
+
+def _backend_target() -> Tuple[str, str, bool]:
+    if STATE_BACKEND == "sqlite":
+        return STATE_BACKEND, STATE_DB_PATH, STATE_SHARED
+    if STATE_BACKEND == "sharded":
+        return STATE_BACKEND, STATE_SHARDS_DIR, STATE_SHARED
+    return STATE_BACKEND, STATE_PATH, STATE_SHARED
+
+
+class _StateWriter:
+    """The single thread that hands recorded changes to the backend."""
+
+    def __init__(self, store: "_Store"):
+        self.store = store
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="state-writer", daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            # Collect one window's worth of changes before writing.
+            if self.stopping.wait(FLUSH_DELAY):
+                return
+            self.wakeup.clear()
+            try:
+                self.store.flush()
+            except Exception:
+                print(f"STATE_FLUSH_FAILED target={self.store.target}")
+                traceback.print_exc()
+                self.wakeup.set()
+
+
+class _Store:
+    def __init__(self, kind: str, path: str, shared: bool = False):
+        self.target = (kind, path, shared)
+        self.shared = shared
+        self.backend = _make_backend(kind, path, shared)
+        with self.backend.locked(exclusive=True):
+            self.data = self.backend.load()
+        self.pending: list = []
+        self.expiry: Dict[Tuple[str, str], list] = {}
+        self.flush_lock = threading.Lock()
+        # Locking, fsync and compaction happen on this thread, never on the event loop.
+        self.writer = _StateWriter(self)
+
+    def apply(self, changes: list):
+        for change in changes:
+            _apply_change(self.data, change)
+            action, chat_key, section, key, value = change
+            heap = self.expiry.get((chat_key, section))
+            if action == "put" and heap is not None:
+                _push_expiry(heap, section, key, value)
+
+    def expiry_heap(self, chat_key: str, section: str) -> list:
+        """Min-heap of (due_key, uid_key, raw_until) for one dated section, built on first use.
+
+        Entries are never removed on overwrite or delete; stale ones are
+        recognised on pop because raw_until no longer matches the state.
+        """
+        heap = self.expiry.get((chat_key, section))
+        if heap is None:
+            heap = []
+            entries = _section(_get_group(self.data, chat_key), section)
+            for key, entry in entries.items():
+                _push_expiry(heap, section, key, entry)
+            self.expiry[(chat_key, section)] = heap
+        return heap
+
+    def _catch_up(self, writing: list = ()):
+        # Caller holds _lock and the backend lock.
+        reloaded, changes = self.backend.poll()
+        if reloaded is not None:
+            self.data.update(reloaded)
+            self.expiry = {key: heap for key, heap in self.expiry.items() if key[0] not in reloaded}
+        self.apply(changes)
+        # Our changes not written yet go after theirs in the journal; keep memory in that order.
+        self.apply(list(writing) + self.pending)
+
+    def sync(self):
+        """Pick up what other processes committed; a no-op unless the store is shared."""
+        if not self.shared:
+            return
+        # The writer thread catches up itself before it writes; rather than wait
+        # for its file lock and fsync here, on the event loop, skip this round.
+        # The flush lock also keeps the two threads off the backend at once.
+        if not self.flush_lock.acquire(blocking=False):
+            return
+        try:
+            with self.backend.locked(exclusive=False):
+                with _lock:
+                    self._catch_up()
+        finally:
+            self.flush_lock.release()
+
+    def record(self, changes: list):
+        if not changes:
+            return
+        with _lock:
+            _write_stats["changes"] += len(changes)
+            self.pending.extend(changes)
+        self.writer.notify()
+
+    def snapshot(self, chat_key: str | None = None) -> dict:
+        with _lock:
+            if chat_key is None:
+                return _copy_state(self.data)
+            return _copy_state({chat_key: self.data.get(chat_key, {})})
+
+    def flush(self):
+        # The state lock is held only to take the pending batch; the backend
+        # does its I/O without blocking readers and mutators.
+        with self.flush_lock:
+            with _lock:
+                changes, self.pending = self.pending, []
+            if not changes:
+                return
+            try:
+                with self.backend.locked(exclusive=True):
+                    if self.shared:
+                        # Other processes may have committed since these changes
+                        # were made: take theirs first and replay ours on top, so
+                        # memory ends up in the same order as the journal.
+                        with _lock:
+                            self._catch_up(changes)
+                    self.backend.write(changes, self.snapshot)
+            except BaseException:
+                with _lock:
+                    self.pending[:0] = changes
+                raise
+            _write_stats["flushes"] += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.stop()
+        self.flush()
+        with self.flush_lock:
+            self.backend.close()
+
+
+def _copy_state(data: dict) -> dict:
+    # Entry values are replaced on every put, never edited in place, so
+    # copying the containers is enough for a consistent snapshot.
+    return {
+        chat_key: {
+            section: list(values) if isinstance(values, list) else dict(values) if isinstance(values, dict) else values
+            for section, values in group.items()
+        } if isinstance(group, dict) else group
+        for chat_key, group in data.items()
+    }
+
+
+def _current_store() -> _Store:
+    global _store
+    store = _store
+    target = _backend_target()
+    if store is not None and store.target == target:
+        return store
+
+    # Never called with _lock held: closing waits for the writer thread,
+    # which needs _lock to take its snapshot.
+    with _switch_lock:
+        if _store is not None and _store.target != target:
+            old, _store = _store, None
+            old.close()
+        if _store is None:
+            _store = _Store(*target)
+        return _store
+
+
+def _load_all() -> dict:
+    store = _current_store()
+    store.sync()
+    return store.data
+
+
+def configure(backend: str | None = None, shared: bool | None = None):
+    """Select the persistence backend ("json", "sharded" or "sqlite") and load the state.
+
+    ``shared`` turns on cross-process locking for bots that run several
+    processes against the same state files.
+    """
+    global STATE_BACKEND, STATE_SHARED
+    if backend:
+        STATE_BACKEND = backend
+    if shared is not None:
+        STATE_SHARED = shared
+    _current_store()
+
 
+def get_write_stats() -> Dict[str, int]:
+    """Counters of recorded changes, writes skipped as no-ops and backend flushes."""
+    with _lock:
+        return dict(_write_stats)
 
-def _save_all(data: dict):
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+
+def flush():
+    """Write pending in-memory changes to the backend right away."""
+    store = _store
+    if store is not None:
+        store.flush()
+
+
+def close():
+    """Flush pending changes and drop the in-memory copy of the state."""
+    global _store
+    with _switch_lock:
+        store, _store = _store, None
+    if store is not None:
+        store.close()
+
+
+atexit.register(flush)
 
 
 def _get_group(data: dict, chat_id: int) -> dict:
@@ -51,43 +569,272 @@ def _get_group(data: dict, chat_id: int) -> dict:
     return data[key]
 
 
+def _section(group: dict, name: str) -> dict:
+    entries = group.get(name)
+    if not isinstance(entries, dict):
+        entries = {}
+        group[name] = entries
+    return entries
+
+
+def _manual_green_until(entry) -> str:
+    if isinstance(entry, dict):
+        return str(entry.get("until", "") or "").strip()
+    return str(entry or "").strip()
+
+
+def _entry_until(section: str, entry) -> str:
+    if section == "manual_green":
+        return _manual_green_until(entry)
+    return str(entry or "").strip()
+
+
+def _push_expiry(heap: list, section: str, key: str, entry):
+    until = _entry_until(section, entry)
+    if not until and section == "manual_green":
+        return
+    try:
+        due_key = date.fromisoformat(until).isoformat()
+    except Exception:
+        # Unparseable dates sort first so the next cleanup drops them.
+        due_key = ""
+    heapq.heappush(heap, (due_key, key, until))
+
+
+# A change is [action, chat_key, section, uid_key, value]:
+#   "put"    stores value under uid_key (set sections ignore value),
+#   "del"    removes uid_key,
+#   "expire" drops dated entries whose date is before value (an ISO date).
+def _put(chat_id: int, section: str, uid, value=None) -> list:
+    return ["put", str(chat_id), section, str(uid), value]
+
+
+def _del(chat_id: int, section: str, uid) -> list:
+    return ["del", str(chat_id), section, str(uid), None]
+
+
+def _expire(chat_id: int, section: str, before: date) -> list:
+    return ["expire", str(chat_id), section, None, before.isoformat()]
+
+
+def _apply_change(data: dict, change: list):
+    action, chat_key, section, key, value = change
+    group = _get_group(data, chat_key)
+
+    if section in SET_SECTIONS:
+        uid = int(key)
+        values = [int(v) for v in group.get(section, [])]
+        if action == "put" and uid not in values:
+            values.append(uid)
+        elif action == "del":
+            values = [v for v in values if v != uid]
+        group[section] = values
+        return
+
+    entries = _section(group, section)
+    if action == "put":
+        entries[key] = value
+    elif action == "del":
+        entries.pop(key, None)
+    elif action == "expire":
+        for uid, entry in list(entries.items()):
+            until = _entry_until(section, entry)
+            if until and until < value:
+                del entries[uid]
+
+
 def get_sets(chat_id: int) -> Tuple[Set[int], Set[int], Dict[str, str], Dict[str, str]]:
     data = _load_all()
-    group = _get_group(data, chat_id)
-    excused = set(map(int, group.get("excused", [])))
-    active = set(map(int, group.get("active", [])))
-    mentions = group.get("mentions", {})
-    excused_until = group.get("excused_until", {})
+    with _lock:
+        group = _get_group(data, chat_id)
+        excused = set(map(int, group.get("excused", [])))
+        active = set(map(int, group.get("active", [])))
+        mentions = dict(group.get("mentions", {}))
+        excused_until = dict(group.get("excused_until", {}))
     return excused, active, mentions, excused_until
 
 
+class StateTransaction:
+    """Batches state mutations for one chat into a single flush.
+
+    Changes are applied to the in-memory state as soon as a method is
+    called, so reads inside the block see them; they are handed to the
+    backend once, when the outermost ``with`` exits.
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.changes: list = []
+        self._store: _Store | None = None
+        self._depth = 0
+
+    def __enter__(self) -> "StateTransaction":
+        if self._depth == 0:
+            self._store = _current_store()
+            self._store.sync()
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0:
+            store, changes = self._store, self.changes
+            self.changes = []
+            self._store = None
+            # Memory is already updated, so the changes are recorded even on error.
+            store.record(changes)
+        return False
+
+    def _group(self) -> dict:
+        # Caller holds _lock. Looked up every time: a sync() during an await in
+        # the block may have replaced the group with one reloaded from disk.
+        return _get_group(self._store.data, self.chat_id)
+
+    def _apply(self, changes: list):
+        if not changes:
+            return
+        with _lock:
+            self._store.apply(changes)
+            self.changes.extend(changes)
+
+    def _put_if_changed(self, section: str, uid: int, value):
+        with _lock:
+            if _section(self._group(), section).get(str(uid)) == value:
+                _write_stats["elided_writes"] += 1
+                return
+            self._apply([_put(self.chat_id, section, uid, value)])
+
+    def save_mention(self, uid: int, mention: str):
+        self._put_if_changed("mentions", uid, mention)
+
+    def save_user(self, uid: int, username: str | None, full_name: str | None):
+        self._put_if_changed("users", uid, {
+            "username": (username or "").strip(),
+            "full_name": (full_name or "").strip(),
+        })
+
+    def save_start_candidate(
+        self,
+        uid: int,
+        full_name: str,
+        start_date_iso: str,
+        raw_text: str,
+        message_date_iso: str,
+    ):
+        self._apply([_put(self.chat_id, "start_candidates", uid, {
+            "full_name": (full_name or "").strip(),
+            "start_date": (start_date_iso or "").strip(),
+            "raw_text": (raw_text or "").strip(),
+            "message_date": (message_date_iso or "").strip(),
+        })])
+
+    def mark_start_candidate_imported(self, uid: int, imported_at_iso: str):
+        with _lock:
+            candidate = _section(self._group(), "start_candidates").get(str(uid))
+            if not isinstance(candidate, dict):
+                return
+            self._apply([_put(self.chat_id, "start_candidates", uid, {**candidate, "imported_at": imported_at_iso})])
+
+    def set_manual_green(self, uid: int, until_iso: str = ""):
+        self._apply([_put(self.chat_id, "manual_green", uid, {"until": (until_iso or "").strip()})])
+
+    def remove_manual_green(self, uid: int):
+        with _lock:
+            if str(uid) in _section(self._group(), "manual_green"):
+                self._apply([_del(self.chat_id, "manual_green", uid)])
+
+    def cleanup_expired_manual_green(self, today: date | None = None) -> list[int]:
+        expired: list[int] = []
+        for key in self._cleanup_expired("manual_green", today or date.today()):
+            _append_int(expired, key)
+        return expired
+
+    def cleanup_expired_excused_until(self, today: date | None = None):
+        self._cleanup_expired("excused_until", today or date.today())
+
+    def _cleanup_expired(self, section: str, today: date) -> list[str]:
+        with _lock:
+            entries = _section(self._group(), section)
+            heap = self._store.expiry_heap(str(self.chat_id), section)
+            today_iso = today.isoformat()
+
+            removals = []
+            stray = []
+            expired_keys: list[str] = []
+            while heap and heap[0][0] < today_iso:
+                due_key, key, until = heapq.heappop(heap)
+                if key not in entries or _entry_until(section, entries[key]) != until or key in expired_keys:
+                    continue
+                expired_keys.append(key)
+                removals.append(_del(self.chat_id, section, key))
+                # Empty and unparseable dates are skipped by the expire range delete.
+                if not until or due_key != until:
+                    stray.append(removals[-1])
+
+            if not removals:
+                return []
+
+            # Memory drops just the due keys; backends get one range delete plus
+            # explicit deletes for values the date comparison would not catch.
+            self._store.apply(removals)
+            if len(stray) < len(removals):
+                stray.append(_expire(self.chat_id, section, today))
+            self.changes.extend(stray)
+
+        return expired_keys
+
+    def mark_excused(self, uid: int):
+        self._apply([_put(self.chat_id, "excused", uid)])
+
+    def mark_active(self, uid: int):
+        with _lock:
+            changes = []
+            if uid not in set(map(int, self._group().get("active", []))):
+                changes.append(_put(self.chat_id, "active", uid))
+            changes.extend(self._clear_excused_changes(uid))
+            self._apply(changes)
+
+    def remove_excused(self, uid: int):
+        with _lock:
+            self._apply(self._clear_excused_changes(uid))
+
+    def set_excused_until(self, uid: int, until_iso: str):
+        self._apply([_put(self.chat_id, "excused_until", uid, until_iso)])
+
+    def _clear_excused_changes(self, uid: int) -> list:
+        changes = []
+        if uid in set(map(int, self._group().get("excused", []))):
+            changes.append(_del(self.chat_id, "excused", uid))
+        if str(uid) in _section(self._group(), "excused_until"):
+            changes.append(_del(self.chat_id, "excused_until", uid))
+        return changes
+
+
+def transaction(chat_id: int) -> StateTransaction:
+    return StateTransaction(chat_id)
+
+
 def save_mention(chat_id: int, uid: int, mention: str):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    group["mentions"][str(uid)] = mention
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.save_mention(uid, mention)
 
 
 def save_user(chat_id: int, uid: int, username: str | None, full_name: str | None):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    group["users"][str(uid)] = {
-        "username": (username or "").strip(),
-        "full_name": (full_name or "").strip(),
-    }
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.save_user(uid, username, full_name)
 
 
 def get_users(chat_id: int) -> Dict[str, Dict[str, str]]:
     data = _load_all()
-    group = _get_group(data, chat_id)
-    users = group.get("users", {})
-    users = users if isinstance(users, dict) else {}
+    with _lock:
+        group = _get_group(data, chat_id)
+        users = group.get("users", {})
+        users = {uid: dict(info) for uid, info in users.items()} if isinstance(users, dict) else {}
 
-    mentions = group.get("mentions", {})
-    if isinstance(mentions, dict):
-        for uid in mentions:
-            users.setdefault(str(uid), {"username": "", "full_name": ""})
+        mentions = group.get("mentions", {})
+        if isinstance(mentions, dict):
+            for uid in mentions:
+                users.setdefault(str(uid), {"username": "", "full_name": ""})
 
     return users
 
@@ -100,78 +847,51 @@ def save_start_candidate(
     raw_text: str,
     message_date_iso: str,
 ):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    candidates = group.get("start_candidates", {})
-    candidates[str(uid)] = {
-        "full_name": (full_name or "").strip(),
-        "start_date": (start_date_iso or "").strip(),
-        "raw_text": (raw_text or "").strip(),
-        "message_date": (message_date_iso or "").strip(),
-    }
-    group["start_candidates"] = candidates
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.save_start_candidate(uid, full_name, start_date_iso, raw_text, message_date_iso)
 
 
 def get_start_candidates(chat_id: int) -> Dict[str, Dict[str, str]]:
     data = _load_all()
-    group = _get_group(data, chat_id)
-    candidates = group.get("start_candidates", {})
-    return candidates if isinstance(candidates, dict) else {}
+    with _lock:
+        group = _get_group(data, chat_id)
+        candidates = group.get("start_candidates", {})
+        if not isinstance(candidates, dict):
+            return {}
+        return {
+            uid: dict(candidate) if isinstance(candidate, dict) else candidate
+            for uid, candidate in candidates.items()
+        }
 
 
 def mark_start_candidate_imported(chat_id: int, uid: int, imported_at_iso: str):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    candidates = group.get("start_candidates", {})
-    candidate = candidates.get(str(uid))
-    if not isinstance(candidate, dict):
-        return
-    candidate["imported_at"] = imported_at_iso
-    candidates[str(uid)] = candidate
-    group["start_candidates"] = candidates
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.mark_start_candidate_imported(uid, imported_at_iso)
 
 
 def get_manual_green(chat_id: int) -> Dict[str, Dict[str, str]]:
     data = _load_all()
-    group = _get_group(data, chat_id)
-    entries = group.get("manual_green", {})
-    if not isinstance(entries, dict):
-        return {}
+    with _lock:
+        group = _get_group(data, chat_id)
+        entries = group.get("manual_green", {})
+        if not isinstance(entries, dict):
+            return {}
 
-    result: Dict[str, Dict[str, str]] = {}
-    for uid, entry in entries.items():
-        if isinstance(entry, dict):
-            until = str(entry.get("until", "") or "").strip()
-        else:
-            until = str(entry or "").strip()
-        result[str(uid)] = {"until": until}
+        result: Dict[str, Dict[str, str]] = {}
+        for uid, entry in entries.items():
+            result[str(uid)] = {"until": _manual_green_until(entry)}
 
     return result
 
 
 def set_manual_green(chat_id: int, uid: int, until_iso: str = ""):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    entries = group.get("manual_green", {})
-    if not isinstance(entries, dict):
-        entries = {}
-    entries[str(uid)] = {"until": (until_iso or "").strip()}
-    group["manual_green"] = entries
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.set_manual_green(uid, until_iso)
 
 
 def remove_manual_green(chat_id: int, uid: int):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    entries = group.get("manual_green", {})
-    if not isinstance(entries, dict):
-        return
-    if str(uid) in entries:
-        del entries[str(uid)]
-        group["manual_green"] = entries
-        _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.remove_manual_green(uid)
 
 
 def is_manual_green_today(chat_id: int, uid: int, today: date | None = None) -> bool:
@@ -191,45 +911,8 @@ def is_manual_green_today(chat_id: int, uid: int, today: date | None = None) ->
 
 
 def cleanup_expired_manual_green(chat_id: int, today: date | None = None) -> list[int]:
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    entries = group.get("manual_green", {})
-    if not isinstance(entries, dict):
-        group["manual_green"] = {}
-        _save_all(data)
-        return []
-
-    current_day = today or date.today()
-    expired: list[int] = []
-    changed = False
-
-    for key, entry in list(entries.items()):
-        if isinstance(entry, dict):
-            until = str(entry.get("until", "") or "").strip()
-        else:
-            until = str(entry or "").strip()
-
-        if not until:
-            continue
-
-        try:
-            parsed = date.fromisoformat(until)
-        except Exception:
-            del entries[key]
-            changed = True
-            _append_int(expired, key)
-            continue
-
-        if parsed < current_day:
-            del entries[key]
-            changed = True
-            _append_int(expired, key)
-
-    if changed:
-        group["manual_green"] = entries
-        _save_all(data)
-
-    return expired
+    with transaction(chat_id) as tx:
+        return tx.cleanup_expired_manual_green(today)
 
 
 def _append_int(values: list[int], raw_value: str):
@@ -240,53 +923,23 @@ def _append_int(values: list[int], raw_value: str):
 
 
 def mark_excused(chat_id: int, uid: int):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    excused = set(map(int, group.get("excused", [])))
-    excused.add(uid)
-    group["excused"] = list(excused)
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.mark_excused(uid)
 
 
 def mark_active(chat_id: int, uid: int):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-
-    active = set(map(int, group.get("active", [])))
-    active.add(uid)
-    group["active"] = list(active)
-
-    excused = set(map(int, group.get("excused", [])))
-    if uid in excused:
-        excused.discard(uid)
-        group["excused"] = list(excused)
-
-    if str(uid) in group.get("excused_until", {}):
-        del group["excused_until"][str(uid)]
-
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.mark_active(uid)
 
 
 def remove_excused(chat_id: int, uid: int):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-
-    excused = set(map(int, group.get("excused", [])))
-    if uid in excused:
-        excused.discard(uid)
-        group["excused"] = list(excused)
-
-    if str(uid) in group.get("excused_until", {}):
-        del group["excused_until"][str(uid)]
-
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.remove_excused(uid)
 
 
 def set_excused_until(chat_id: int, uid: int, until_iso: str):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-    group["excused_until"][str(uid)] = until_iso
-    _save_all(data)
+    with transaction(chat_id) as tx:
+        tx.set_excused_until(uid, until_iso)
 
 
 def is_excused_today(chat_id: int, uid: int) -> bool:
@@ -306,27 +959,9 @@ def is_excused_today(chat_id: int, uid: int) -> bool:
         return False
 
 
-def cleanup_expired_excused_until(chat_id: int):
-    data = _load_all()
-    group = _get_group(data, chat_id)
-
-    excused_until = group.get("excused_until", {})
-    today = date.today()
-
-    changed = False
-    for key, value in list(excused_until.items()):
-        try:
-            parsed = date.fromisoformat(value)
-            if parsed < today:
-                del excused_until[key]
-                changed = True
-        except Exception:
-            del excused_until[key]
-            changed = True
-
-    if changed:
-        group["excused_until"] = excused_until
-        _save_all(data)
+def cleanup_expired_excused_until(chat_id: int, today: date | None = None):
+    with transaction(chat_id) as tx:
+        tx.cleanup_expired_excused_until(today)
 
 
 MONTHS = {
@@ -0,0 +1,353 @@
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import uuid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS active (
+    chat_id TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    PRIMARY KEY (chat_id, uid)
+);
+CREATE TABLE IF NOT EXISTS excused (
+    chat_id TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    PRIMARY KEY (chat_id, uid)
+);
+CREATE TABLE IF NOT EXISTS excused_until (
+    chat_id TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    until_date TEXT NOT NULL,
+    PRIMARY KEY (chat_id, uid)
+);
+CREATE INDEX IF NOT EXISTS idx_excused_until_date ON excused_until (chat_id, until_date);
+CREATE TABLE IF NOT EXISTS mentions (
+    chat_id TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    mention TEXT NOT NULL,
+    PRIMARY KEY (chat_id, uid)
+);
+CREATE TABLE IF NOT EXISTS users (
+    chat_id TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    username TEXT NOT NULL DEFAULT '',
+    full_name TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (chat_id, uid)
+);
+CREATE TABLE IF NOT EXISTS start_candidates (
+    chat_id TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    full_name TEXT NOT NULL DEFAULT '',
+    start_date TEXT NOT NULL DEFAULT '',
+    raw_text TEXT NOT NULL DEFAULT '',
+    message_date TEXT NOT NULL DEFAULT '',
+    imported_at TEXT,
+    PRIMARY KEY (chat_id, uid)
+);
+CREATE INDEX IF NOT EXISTS idx_start_candidates_date ON start_candidates (chat_id, message_date);
+CREATE TABLE IF NOT EXISTS manual_green (
+    chat_id TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    until_date TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (chat_id, uid)
+);
+CREATE INDEX IF NOT EXISTS idx_manual_green_date ON manual_green (chat_id, until_date);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    section TEXT NOT NULL,
+    uid TEXT,
+    until_date TEXT
+);
+"""
+
+SET_SECTIONS = ("active", "excused")
+CANDIDATE_FIELDS = ("full_name", "start_date", "raw_text", "message_date")
+# Rows of the shared-mode change log kept for processes that are behind;
+# one that falls further back than this reloads everything.
+CHANGES_KEEP = 10000
+
+
+def _empty_group() -> dict:
+    return {
+        "active": [],
+        "excused": [],
+        "mentions": {},
+        "excused_until": {},
+        "users": {},
+        "start_candidates": {},
+        "manual_green": {},
+    }
+
+
+def _manual_green_until(entry) -> str:
+    if isinstance(entry, dict):
+        return str(entry.get("until", "") or "").strip()
+    return str(entry or "").strip()
+
+
+def _candidate(row) -> dict:
+    candidate = dict(zip(CANDIDATE_FIELDS, row[:4]))
+    if row[4] is not None:
+        candidate["imported_at"] = row[4]
+    return candidate
+
+
+class SqliteBackend:
+    """Keeps the bot state as one row per (chat_id, uid) in every section table.
+
+    In shared mode every write also logs the touched (chat_id, section, uid)
+    to the changes table, so poll() re-reads only those rows instead of the
+    whole database.
+    """
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.shared = shared
+        self.token = uuid.uuid4().hex
+        self.last_seq = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        if shared:
+            self.conn.execute("PRAGMA busy_timeout=10000")
+        self.conn.executescript(SCHEMA)
+        self.data_version = None
+
+    @property
+    def origin(self) -> str:
+        # Tells this process's own log rows apart from the others'; the pid
+        # keeps forked workers that inherited this object apart too.
+        return f"{os.getpid()}:{self.token}"
+
+    def close(self):
+        self.conn.close()
+
+    def locked(self, exclusive: bool):
+        # SQLite already lets readers run alongside one writer; row-level
+        # upserts never overwrite another process's unrelated rows.
+        return contextlib.nullcontext()
+
+    def poll(self):
+        """Changes other connections committed since the last look, re-read row by row."""
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.data_version:
+            return None, []
+        self.data_version = version
+
+        logged = self.conn.execute(
+            "SELECT seq, origin, chat_id, section, uid, until_date FROM changes WHERE seq > ? ORDER BY seq",
+            (self.last_seq,),
+        ).fetchall()
+        if not logged:
+            return None, []
+        if logged[0][0] != self.last_seq + 1:
+            # The rows we missed were pruned already.
+            return self.load(), []
+        self.last_seq = logged[-1][0]
+
+        # A row touched several times is re-read once, at its last position,
+        # so it still lands after any expire that came before it.
+        last_touch = {}
+        for n, (_seq, _origin, chat_id, section, uid, _until) in enumerate(logged):
+            if uid is not None:
+                last_touch[(chat_id, section, uid)] = n
+
+        changes = []
+        for n, (_seq, origin, chat_id, section, uid, until) in enumerate(logged):
+            if origin == self.origin:
+                continue
+            if uid is None:
+                changes.append(["expire", chat_id, section, None, until])
+            elif last_touch[(chat_id, section, uid)] == n:
+                changes.append(self._read_row(chat_id, section, uid))
+        return None, changes
+
+    def _read_row(self, chat_id: str, section: str, uid: str) -> list:
+        """The row's current value as a put, or a del when it is gone."""
+        where = "WHERE chat_id = ? AND uid = ?"
+        if section in SET_SECTIONS:
+            row = self.conn.execute(f"SELECT 1 FROM {section} {where}", (chat_id, uid)).fetchone()
+            value = None
+        elif section in ("excused_until", "mentions"):
+            column = "until_date" if section == "excused_until" else "mention"
+            row = self.conn.execute(f"SELECT {column} FROM {section} {where}", (chat_id, uid)).fetchone()
+            value = row and row[0]
+        elif section == "users":
+            row = self.conn.execute(f"SELECT username, full_name FROM users {where}", (chat_id, uid)).fetchone()
+            value = row and {"username": row[0], "full_name": row[1]}
+        elif section == "start_candidates":
+            row = self.conn.execute(
+                "SELECT full_name, start_date, raw_text, message_date, imported_at "
+                f"FROM start_candidates {where}",
+                (chat_id, uid),
+            ).fetchone()
+            value = row and _candidate(row)
+        elif section == "manual_green":
+            row = self.conn.execute(f"SELECT until_date FROM manual_green {where}", (chat_id, uid)).fetchone()
+            value = row and {"until": row[0]}
+        else:
+            raise ValueError(f"Unknown state section: {section}")
+
+        if row is None:
+            return ["del", chat_id, section, uid, None]
+        return ["put", chat_id, section, uid, value]
+
+    def load(self) -> dict:
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        # Taken before the tables: anything committed in between is re-read by the next poll.
+        self.last_seq = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0]
+        data: dict = {}
+
+        def group(chat_id: str) -> dict:
+            return data.setdefault(chat_id, _empty_group())
+
+        for section in SET_SECTIONS:
+            for chat_id, uid in self.conn.execute(f"SELECT chat_id, uid FROM {section}"):
+                try:
+                    group(chat_id)[section].append(int(uid))
+                except ValueError:
+                    continue
+
+        for chat_id, uid, until in self.conn.execute("SELECT chat_id, uid, until_date FROM excused_until"):
+            group(chat_id)["excused_until"][uid] = until
+
+        for chat_id, uid, mention in self.conn.execute("SELECT chat_id, uid, mention FROM mentions"):
+            group(chat_id)["mentions"][uid] = mention
+
+        for chat_id, uid, username, full_name in self.conn.execute(
+            "SELECT chat_id, uid, username, full_name FROM users"
+        ):
+            group(chat_id)["users"][uid] = {"username": username, "full_name": full_name}
+
+        for row in self.conn.execute(
+            "SELECT chat_id, uid, full_name, start_date, raw_text, message_date, imported_at FROM start_candidates"
+        ):
+            group(row[0])["start_candidates"][row[1]] = _candidate(row[2:])
+
+        for chat_id, uid, until in self.conn.execute("SELECT chat_id, uid, until_date FROM manual_green"):
+            group(chat_id)["manual_green"][uid] = {"until": until}
+
+        return data
+
+    def write(self, changes: list, snapshot=None):
+        if not changes:
+            return
+        with self.conn:
+            for change in changes:
+                self._apply(change)
+            if self.shared:
+                self._log(changes)
+
+    def _log(self, changes: list):
+        # Nobody else logged since our last look: our own rows need no re-read later.
+        caught_up = self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()[0] == self.last_seq
+        self.conn.executemany(
+            "INSERT INTO changes (origin, chat_id, section, uid, until_date) VALUES (?, ?, ?, ?, ?)",
+            [
+                (self.origin, chat_id, section, key, value if action == "expire" else None)
+                for action, chat_id, section, key, value in changes
+            ],
+        )
+        last_seq = self.conn.execute("SELECT MAX(seq) FROM changes").fetchone()[0]
+        if caught_up:
+            self.last_seq = last_seq
+        self.conn.execute("DELETE FROM changes WHERE seq <= ?", (last_seq - CHANGES_KEEP,))
+
+    def _apply(self, change: list):
+        action, chat_id, section, key, value = change
+
+        if action == "expire":
+            # ISO dates compare correctly as strings, so this is a range scan on the date index.
+            self.conn.execute(
+                f"DELETE FROM {section} WHERE chat_id = ? AND until_date != '' AND until_date < ?",
+                (chat_id, value),
+            )
+            return
+
+        if action == "del":
+            self.conn.execute(f"DELETE FROM {section} WHERE chat_id = ? AND uid = ?", (chat_id, key))
+            return
+
+        if section in SET_SECTIONS:
+            self.conn.execute(f"INSERT OR IGNORE INTO {section} (chat_id, uid) VALUES (?, ?)", (chat_id, key))
+        elif section == "excused_until":
+            self.conn.execute(
+                "INSERT OR REPLACE INTO excused_until (chat_id, uid, until_date) VALUES (?, ?, ?)",
+                (chat_id, key, str(value or "")),
+            )
+        elif section == "mentions":
+            self.conn.execute(
+                "INSERT OR REPLACE INTO mentions (chat_id, uid, mention) VALUES (?, ?, ?)",
+                (chat_id, key, str(value or "")),
+            )
+        elif section == "users":
+            value = value if isinstance(value, dict) else {}
+            self.conn.execute(
+                "INSERT OR REPLACE INTO users (chat_id, uid, username, full_name) VALUES (?, ?, ?, ?)",
+                (chat_id, key, value.get("username", ""), value.get("full_name", "")),
+            )
+        elif section == "start_candidates":
+            value = value if isinstance(value, dict) else {}
+            self.conn.execute(
+                "INSERT OR REPLACE INTO start_candidates "
+                "(chat_id, uid, full_name, start_date, raw_text, message_date, imported_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    chat_id,
+                    key,
+                    *(str(value.get(field, "") or "") for field in CANDIDATE_FIELDS),
+                    value.get("imported_at"),
+                ),
+            )
+        elif section == "manual_green":
+            self.conn.execute(
+                "INSERT OR REPLACE INTO manual_green (chat_id, uid, until_date) VALUES (?, ?, ?)",
+                (chat_id, key, _manual_green_until(value)),
+            )
+        else:
+            raise ValueError(f"Unknown state section: {section}")
+
+
+def group_changes(chat_id: str, group: dict) -> list:
+    changes = []
+    for section in SET_SECTIONS:
+        for uid in group.get(section, []) or []:
+            changes.append(["put", chat_id, section, str(uid), None])
+    for section in ("excused_until", "mentions", "users", "start_candidates", "manual_green"):
+        entries = group.get(section, {})
+        if not isinstance(entries, dict):
+            continue
+        for uid, value in entries.items():
+            changes.append(["put", chat_id, section, str(uid), value])
+    return changes
+
+
+def migrate_state(data: dict, db_path: str) -> int:
+    """Copy a state document in the state.json layout into the database; returns the rows written."""
+    changes = []
+    for chat_id, group in (data or {}).items():
+        if isinstance(group, dict):
+            changes.extend(group_changes(str(chat_id), group))
+
+    backend = SqliteBackend(db_path)
+    try:
+        backend.write(changes)
+    finally:
+        backend.close()
+    return len(changes)
+
+
+def migrate_json_state(json_path: str, db_path: str) -> int:
+    with open(json_path, "r", encoding="utf-8") as f:
+        return migrate_state(json.load(f), db_path)
+
+
+if __name__ == "__main__":
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(base_dir, "state.json")
+    target = sys.argv[2] if len(sys.argv) > 2 else os.path.join(base_dir, "state.sqlite3")
+    print(f"Migrated {migrate_json_state(source, target)} rows from {source} to {target}")
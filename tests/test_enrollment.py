@@ -5,6 +5,7 @@ from datetime import date
 sys.path.insert(0, r"C:\NutritionBot\src")
 
 from enrollment import (
+    NameIndex,
     existing_uids_from_rows,
     find_row_by_candidate_name,
     names_match,
@@ -57,5 +58,38 @@ class EnrollmentTests(unittest.TestCase):
         self.assertEqual(find_row_by_candidate_name(rows, "Елена Самохина"), (3, ""))
 
 
+    def test_name_index_lookups(self):
+        index = NameIndex([
+            ["Дежнева", "Марина"],
+            ["Самохина Елена"],
+            [""],
+            ["Дежнева", "Анна", "", "", "", "", "", "", "", "55"],
+        ])
+
+        self.assertEqual(index.rows_by_surname("  ДЕЖНЕВА "), [2, 5])
+        self.assertEqual(index.rows_by_surname("Самохина"), [3])
+        self.assertEqual(index.rows_by_surname("Самохина Елена"), [3])
+        self.assertEqual(index.row_by_surname_name("Дежнева", "Анна"), 5)
+        self.assertEqual(index.row_by_surname_name("Дежнева", ""), 2)
+        self.assertEqual(index.row_by_fio("дежнева анна"), 2)
+        self.assertEqual(index.row_by_fio("Самохина Елена"), 3)
+        self.assertIsNone(index.row_by_fio(""))
+        self.assertEqual(index.row_by_name("Елена Самохина"), 3)
+        self.assertIsNone(index.row_by_name("Дежнева"))
+
+    def test_name_index_follows_row_changes(self):
+        rows = [["Дежнева Марина"]]
+        index = NameIndex(rows)
+
+        index.discard(2, rows[0])
+        rows[0] = ["Самохина Елена"]
+        index.add(2, rows[0])
+        index.add(3, ["Марина Дежнева", "", "", "", "", "", "", "", "", "7"])
+
+        self.assertEqual(index.row_by_name("Елена Самохина"), 2)
+        self.assertEqual(index.row_by_name("Дежнева Марина"), 3)
+        self.assertEqual(index.rows_by_surname("Дежнева"), [])
+
+
 if __name__ == "__main__":
     unittest.main()
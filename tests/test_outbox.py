@@ -0,0 +1,169 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import asynccontextmanager
+from unittest.mock import patch
+
+sys.path.insert(0, r"C:\NutritionBot\src")
+
+import outbox
+from outbox import SheetOutbox
+
+
+class FakeFormat:
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def paint_row(self, row, color):
+        self.sheets.painted.append(("paint_row", row, color))
+
+    def paint_cell(self, row, col, color):
+        self.sheets.painted.append(("paint_cell", row, col, color))
+
+    def clear_row_background(self, row):
+        self.sheets.painted.append(("clear_row", row))
+
+
+class FakeSheets:
+    """Records buffered writes, flushes and paints the way Sheets would send them."""
+
+    def __init__(self):
+        self.buffer = {}
+        self.sent = []
+        self.painted = []
+        self.fail = 0
+
+    def write(self, row, col, val):
+        self.buffer[(row, col)] = val
+
+    async def flush(self):
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError("Google is down")
+        self.sent.append(dict(self.buffer))
+        self.buffer.clear()
+
+    @asynccontextmanager
+    async def formatting(self):
+        yield FakeFormat(self)
+
+
+class SheetOutboxTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "sheets_outbox.jsonl")
+        self.sheets = {-100: FakeSheets(), -200: FakeSheets()}
+
+    def open_outbox(self) -> SheetOutbox:
+        box = SheetOutbox(self.path, self.sheets.__getitem__)
+        self.addAsyncCleanup(box.stop)
+        return box
+
+    async def test_enqueue_journals_and_buffers_without_sending(self):
+        box = self.open_outbox()
+
+        self.assertTrue(box.enqueue(-100, "-100:1", [["write", 5, "B", 80.2], ["write", 5, "F", "+"]]))
+
+        self.assertEqual(self.sheets[-100].buffer, {(5, "B"): 80.2, (5, "F"): "+"})
+        self.assertEqual(self.sheets[-100].sent, [])
+        await box.journaled()
+        with open(self.path, encoding="utf-8") as f:
+            self.assertEqual(json.loads(f.readline())[:3], ["put", "-100:1", -100])
+
+    async def test_same_message_is_written_once(self):
+        box = self.open_outbox()
+        box.enqueue(-100, "-100:1", [["write", 5, "F", "+"]])
+        await box.drain()
+
+        self.assertFalse(box.enqueue(-100, "-100:1", [["write", 5, "F", "+"]]))
+        self.assertEqual(box.stats["duplicates"], 1)
+        self.assertEqual(self.sheets[-100].buffer, {})
+
+    async def test_drain_batches_per_chat_and_paints_after_writes(self):
+        box = self.open_outbox()
+        box.enqueue(-100, "-100:1", [["write", 5, "B", 80.2]])
+        box.enqueue(-100, "-100:2", [["write", 6, "I", "31.05"], ["paint_row", 6, {"green": 1}]])
+        box.enqueue(-200, "-200:1", [["write", 2, "D", "+"]])
+
+        self.assertEqual(await box.drain(), 3)
+
+        self.assertEqual(self.sheets[-100].sent, [{(5, "B"): 80.2, (6, "I"): "31.05"}])
+        self.assertEqual(self.sheets[-100].painted, [("paint_row", 6, {"green": 1})])
+        self.assertEqual(self.sheets[-200].sent, [{(2, "D"): "+"}])
+        self.assertEqual(box.pending, {})
+
+    async def test_unsent_entries_survive_restart(self):
+        box = self.open_outbox()
+        box.enqueue(-100, "-100:1", [["write", 5, "B", 80.2]])
+        box.enqueue(-200, "-200:1", [["write", 2, "D", "+"]])
+        self.sheets[-100].fail = 2
+        with self.assertRaises(ConnectionError):
+            await box.drain()
+        # Shutdown tries once more and fails too.
+        await box.stop()
+
+        # A fresh process: the buffer that held the write is gone.
+        self.sheets[-100] = FakeSheets()
+        restarted = self.open_outbox()
+
+        self.assertEqual(list(restarted.pending), ["-100:1"])
+        self.assertFalse(restarted.enqueue(-200, "-200:1", [["write", 2, "D", "+"]]))
+        self.assertEqual(await restarted.drain(), 1)
+        self.assertEqual(self.sheets[-100].sent, [{(5, "B"): 80.2}])
+
+    async def test_write_after_restart_wins_over_replayed_one(self):
+        box = self.open_outbox()
+        box.enqueue(-100, "-100:1", [["write", 5, "B", 80.2]])
+        self.sheets[-100].fail = 2
+        with self.assertRaises(ConnectionError):
+            await box.drain()
+        await box.stop()
+
+        self.sheets[-100] = FakeSheets()
+        restarted = self.open_outbox()
+        # The replayed write is buffered before any handler gets to run.
+        self.assertEqual(self.sheets[-100].buffer, {(5, "B"): 80.2})
+        restarted.enqueue(-100, "-100:2", [["write", 5, "B", 79.9]])
+
+        self.assertEqual(await restarted.drain(), 2)
+        self.assertEqual(self.sheets[-100].sent, [{(5, "B"): 79.9}])
+
+    async def test_worker_retries_until_google_accepts(self):
+        box = self.open_outbox()
+        self.sheets[-100].fail = 2
+        with patch.object(outbox, "OUTBOX_BATCH_DELAY", 0), patch.object(outbox, "OUTBOX_RETRY_MAX", 0.01):
+            worker = asyncio.create_task(box.run())
+            box.enqueue(-100, "-100:1", [["write", 5, "F", "+"]])
+            for _ in range(100):
+                if not box.pending:
+                    break
+                await asyncio.sleep(0.01)
+            worker.cancel()
+
+        self.assertEqual(box.pending, {})
+        self.assertEqual(box.stats["retries"], 2)
+        self.assertEqual(self.sheets[-100].sent, [{(5, "F"): "+"}])
+
+    async def test_compaction_keeps_pending_and_recent_keys(self):
+        box = self.open_outbox()
+        with patch.object(outbox, "OUTBOX_COMPACT_BYTES", 1), patch.object(outbox, "OUTBOX_KEEP_DONE", 2):
+            for n in range(4):
+                box.enqueue(-100, f"-100:{n}", [["write", 2, "B", n]])
+                await box.drain()
+            box.enqueue(-200, "-200:1", [["write", 2, "D", "+"]])
+            self.sheets[-200].fail = 1
+            with self.assertRaises(ConnectionError):
+                await box.drain()
+
+        with open(self.path, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[:2], [["done", "-100:2"], ["done", "-100:3"]])
+        self.assertEqual(records[2][:2], ["put", "-200:1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,10 @@
 import sys
 import unittest
+from datetime import date
 
 sys.path.insert(0, r"C:\NutritionBot\src")
 
-from report_status import red_report_uids, report_row_status
+from report_status import DayStatusSnapshot, red_report_uids, report_row_status
 
 
 def make_row(uid, breakfast="", snack1="", lunch="", snack2="", dinner=""):
@@ -64,6 +65,37 @@ class ReportStatusTests(unittest.TestCase):
         self.assertEqual(red_report_uids(rows, lambda uid: False), [100, 200])
         self.assertEqual(red_report_uids(rows, lambda uid: False, lambda uid: uid == 200), [100])
 
+    def test_day_snapshot_resolves_excusals_and_manual_green_for_day(self):
+        snapshot = DayStatusSnapshot.from_state(
+            date(2026, 5, 15),
+            excused={100},
+            excused_until={"200": "2026-05-15", "300": "2026-05-14", "301": "bad"},
+            manual_green={"400": {"until": ""}, "500": {"until": "2026-05-16"}, "600": {"until": "2026-05-01"}},
+        )
+
+        self.assertEqual(snapshot.excused, frozenset({100, 200}))
+        self.assertEqual(snapshot.manual_green, frozenset({400, 500}))
+
+    def test_snapshot_fast_path_matches_callbacks(self):
+        rows = [
+            make_row(100),
+            make_row(200),
+            make_row(300, breakfast="+"),
+            make_row(400),
+        ]
+        snapshot = DayStatusSnapshot(
+            day=date(2026, 5, 15),
+            excused=frozenset({200}),
+            manual_green=frozenset({300}),
+        )
+
+        self.assertEqual(
+            red_report_uids(rows, snapshot=snapshot),
+            red_report_uids(rows, lambda uid: uid == 200, lambda uid: uid == 300),
+        )
+        self.assertEqual(red_report_uids(rows, snapshot=snapshot), [100, 400])
+        self.assertTrue(report_row_status(rows[2], snapshot=snapshot).force_green)
+
 
 if __name__ == "__main__":
     unittest.main()
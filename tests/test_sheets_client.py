@@ -0,0 +1,690 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+sys.path.insert(0, r"C:\NutritionBot\src")
+
+import sheets
+
+META = {"sheets": [{"properties": {"title": "Sheet1", "sheetId": 7}}]}
+
+
+class FakeGoogle:
+    """Stands in for Sheets._send: records every call and answers by URL."""
+
+    def __init__(self):
+        self.calls = []
+        self.responses = {}
+        self.statuses = []
+
+    async def send(self, method, url, params, body, raw, force_refresh=False):
+        self.calls.append((method, url, params, body))
+        if self.statuses:
+            return self.statuses.pop(0), "error"
+        for suffix, response in self.responses.items():
+            if url.endswith(suffix):
+                return 200, response
+        if url.endswith("/sid"):
+            return 200, META
+        return 200, {}
+
+    def methods(self):
+        return [(method, url.rsplit("/", 1)[-1]) for method, url, _params, _body in self.calls]
+
+
+class SheetsClientTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # Bulkheads, token buckets and sessions belong to one event loop; every test gets its own.
+        for registry in (sheets._bulkheads, sheets._rate_limits, sheets._accounts):
+            p = patch.dict(registry, clear=True)
+            p.start()
+            self.addCleanup(p.stop)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.meta_path = os.path.join(tmp.name, "sheets_meta.json")
+        meta_path = patch.object(sheets, "SHEETS_META_PATH", self.meta_path)
+        meta_path.start()
+        self.addCleanup(meta_path.stop)
+
+        self.google = FakeGoogle()
+        self.sc = sheets.Sheets("sid", "Sheet1")
+        p = patch.object(self.sc, "_send", self.google.send)
+        p.start()
+        self.addCleanup(p.stop)
+
+
+class SheetsWriteBufferTests(SheetsClientTestCase):
+    async def test_writes_are_coalesced_into_one_batch_update(self):
+        self.sc.write(5, "B", 80.1)
+        self.sc.write(5, "c", -0.3)
+        self.sc.write(5, "B", 80.2)
+        self.assertEqual(self.google.calls, [])
+
+        self.assertEqual(await self.sc.flush(), 2)
+
+        self.assertEqual(self.google.methods(), [("POST", "values:batchUpdate")])
+        body = self.google.calls[0][3]
+        self.assertEqual(body["valueInputOption"], "RAW")
+        self.assertEqual(body["data"], [
+            {"range": "Sheet1!B5", "values": [[80.2]]},
+            {"range": "Sheet1!C5", "values": [[-0.3]]},
+        ])
+        self.assertEqual(await self.sc.flush(), 0)
+
+    async def test_window_flushes_without_explicit_call(self):
+        with patch.object(sheets, "WRITE_BUFFER_DELAY", 0.01):
+            self.sc.write(2, "D", "+")
+            await asyncio.sleep(0.05)
+
+        self.assertEqual(len(self.google.calls), 1)
+
+    async def test_write_made_during_a_flush_is_sent_by_the_timer(self):
+        release = asyncio.Event()
+        send = self.google.send
+
+        async def slow_send(*args, **kwargs):
+            await release.wait()
+            return await send(*args, **kwargs)
+
+        with patch.object(self.sc, "_send", slow_send), patch.object(sheets, "WRITE_BUFFER_DELAY", 0.01):
+            self.sc.write(2, "D", "+")
+            await asyncio.sleep(0.03)
+            # The first batch is in flight now.
+            self.sc.write(3, "D", "+")
+            release.set()
+            await asyncio.sleep(0.05)
+
+        self.assertEqual(self.sc._pending_writes, {})
+        self.assertEqual(
+            [call[3]["data"][0]["range"] for call in self.google.calls],
+            ["Sheet1!D2", "Sheet1!D3"],
+        )
+
+    async def test_reads_flush_pending_writes_first(self):
+        self.sc.write(3, "J", "100")
+        await self.sc.get_cell("J3")
+
+        self.assertEqual(self.google.methods(), [("POST", "values:batchUpdate"), ("GET", "Sheet1%21J3")])
+
+    async def test_failed_flush_keeps_writes_for_retry(self):
+        self.sc.write(2, "I", "old")
+        self.google.statuses = [400]
+        with self.assertRaises(sheets.GoogleApiError):
+            await self.sc.flush()
+        self.sc.write(2, "I", "new")
+
+        await self.sc.flush()
+
+        self.assertEqual(self.google.calls[1][3]["data"], [{"range": "Sheet1!I2", "values": [["new"]]}])
+
+
+class SheetsReadRowTests(SheetsClientTestCase):
+    async def test_row_is_read_in_one_call_when_snapshot_is_stale(self):
+        self.google.responses["Sheet1%21A4%3AK4"] = {"values": [["Ivanova", "80,5", "", "", "", "", "", "", "", "100"]]}
+
+        cells = await self.sc.read_row(4)
+
+        self.assertEqual((cells[9], cells[0], cells[1]), ("100", "Ivanova", "80,5"))
+        self.assertEqual(len(cells), sheets.TOTAL_COLS)
+        self.assertEqual(self.google.methods(), [("GET", "Sheet1%21A4%3AK4")])
+
+    async def test_fresh_snapshot_serves_row_with_queued_writes(self):
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [["Ivanova", "80"]]}
+        await self.sc.rows()
+        self.sc.write(2, "B", 79.5)
+
+        self.assertEqual((await self.sc.read_row(2))[:3], ["Ivanova", "79.5", ""])
+        self.assertEqual(await self.sc.read_row(30), [""] * sheets.TOTAL_COLS)
+        self.assertEqual(self.google.methods(), [("GET", "sid"), ("GET", "Sheet1%21A2%3AK")])
+
+
+    async def test_read_does_not_wait_behind_a_stuck_flush(self):
+        self.google.responses["Sheet1%21A4%3AK4"] = {"values": [["Ivanova", "80"]]}
+        self.sc.write(4, "B", 79.5)
+
+        # The outbox worker's flush is retrying and holds the lock.
+        async with self.sc._flush_lock:
+            cells = await asyncio.wait_for(self.sc.read_row(4), 1)
+
+        self.assertEqual(cells[:2], ["Ivanova", "79.5"])
+        self.assertEqual(self.google.methods(), [("GET", "Sheet1%21A4%3AK4")])
+
+    async def test_stale_snapshot_answers_lookups_while_google_fails(self):
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [
+            ["Ivanova", "80", "", "", "", "", "", "", "", "100"],
+        ]}
+        await self.sc.rows()
+        self.sc.invalidate()
+        self.google.statuses = [400] * 10
+
+        self.assertEqual(await self.sc.find_row_by_uid(100), 2)
+        self.assertEqual((await self.sc.read_row(2))[:2], ["Ivanova", "80"])
+        self.assertEqual((await self.sc.rows())[0][0], "Ivanova")
+
+
+class SheetsRetryTests(SheetsClientTestCase):
+    async def test_throttled_request_backs_off_without_blocking_loop(self):
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [["Ivanova"]]}
+        self.google.statuses = [429, 503]
+        ticks = 0
+
+        async def other_chat():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        other = asyncio.create_task(other_chat())
+        try:
+            with patch.object(sheets, "SPREADSHEET_READS_PER_MINUTE", 6000), \
+                    patch.object(sheets, "ACCOUNT_READS_PER_MINUTE", 6000):
+                rows = await self.sc._request("GET", self.sc._values_url(sheets.RANGE_ROWS), base_sleep=0.001)
+        finally:
+            other.cancel()
+
+        self.assertEqual(rows, {"values": [["Ivanova"]]})
+        self.assertEqual(len(self.google.calls), 3)
+        self.assertGreater(ticks, 0)
+        # The 429 also emptied the quota buckets, not just this request's backoff.
+        self.assertEqual(
+            [s["drained"] for s in sheets.rate_limit_stats().values()],
+            [1, 1],
+        )
+
+
+class SheetsRateLimitTests(SheetsClientTestCase):
+    async def test_interactive_writes_jump_ahead_of_bulk_work(self):
+        order = []
+
+        async def call(name, level, cell):
+            with sheets.request_priority(level):
+                await self.sc.get_cell(cell)
+            order.append(name)
+
+        with patch.object(sheets, "SPREADSHEET_READS_PER_MINUTE", 600), \
+                patch.object(sheets, "ACCOUNT_READS_PER_MINUTE", 6000), \
+                patch.object(sheets, "RATE_LIMIT_BURST", 1):
+            bulk = [asyncio.create_task(call(f"bulk{n}", sheets.PRIORITY_BULK, f"A{n}")) for n in range(3)]
+            await asyncio.sleep(0)
+            ping = asyncio.create_task(call("ping", sheets.PRIORITY_PING, "F2"))
+            interactive = asyncio.create_task(call("interactive", sheets.PRIORITY_INTERACTIVE, "B2"))
+            await asyncio.gather(*bulk, ping, interactive)
+
+        # bulk0 took the only burst token; everything else waited for a refill.
+        self.assertEqual(order, ["bulk0", "interactive", "ping", "bulk1", "bulk2"])
+        spreadsheet = sheets.rate_limit_stats()[("spreadsheet", "sid", "read")]
+        self.assertEqual((spreadsheet["granted"], spreadsheet["delayed"]), (5, 4))
+
+    async def test_reads_and_writes_have_separate_quotas(self):
+        with patch.object(sheets, "RATE_LIMIT_BURST", 1):
+            await self.sc.get_cell("A1")
+            self.sc.write(2, "B", 80)
+            await asyncio.wait_for(self.sc.flush(), 0.5)
+
+        self.assertEqual(
+            sorted(key[2] for key in sheets.rate_limit_stats()),
+            ["read", "read", "write", "write"],
+        )
+
+    async def test_interactive_write_lifts_a_batch_opened_by_bulk_work(self):
+        priorities = []
+        send = self.google.send
+
+        async def recording_send(*args, **kwargs):
+            priorities.append(sheets._priority.get())
+            return await send(*args, **kwargs)
+
+        with patch.object(self.sc, "_send", recording_send), patch.object(sheets, "WRITE_BUFFER_DELAY", 0):
+            with sheets.request_priority(sheets.PRIORITY_BULK):
+                self.sc.write(10, "I", "31.05")
+            self.sc.write(5, "B", 79.5)
+            await self.sc._flush_task
+
+        self.assertEqual(len(self.google.calls[0][3]["data"]), 2)
+        self.assertEqual(priorities, [sheets.PRIORITY_INTERACTIVE])
+
+    async def test_drive_probe_is_not_counted_against_sheets_quota(self):
+        await self.sc._probe_modified()
+
+        self.assertEqual(sheets.rate_limit_stats(), {})
+
+
+class SheetsUidIndexTests(SheetsClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [
+            ["Ivanova", "", "", "", "", "", "", "", "", "100"],
+            ["Petrova"],
+            ["Sidorova", "", "", "", "", "", "", "", "", "'200.0"],
+        ]}
+        self.google.responses["values:batchGet"] = {"valueRanges": [
+            {"range": "Sheet1!J2:J1000", "majorDimension": "COLUMNS", "values": [["100", "", "'200.0"]]},
+        ]}
+
+    async def test_lookup_uses_index_built_once_per_snapshot(self):
+        with patch.object(sheets, "normalize_uid_value", wraps=sheets.normalize_uid_value) as normalize:
+            self.assertEqual(await self.sc.find_row_by_uid(200), 4)
+            calls_after_fetch = normalize.call_count
+            for _ in range(50):
+                self.assertEqual(await self.sc.find_row_by_uid(100), 2)
+            self.assertIsNone(await self.sc.find_row_by_uid(999))
+
+        self.assertEqual(normalize.call_count, calls_after_fetch + 51)
+        self.assertEqual(len(self.google.calls), 1)
+
+    async def test_set_uid_and_append_update_index_without_refetch(self):
+        await self.sc.rows()
+        self.google.responses["Sheet1%21A%3AK:append"] = {"updates": {"updatedRange": "Sheet1!A5:K5"}}
+
+        self.sc.set_uid(3, 300)
+        self.assertEqual(await self.sc.append_start_user("Kuznetsova Olga", "12.06", 400), 5)
+        self.sc.set_uid(2, 500)
+
+        self.assertEqual(await self.sc.find_row_by_uid(300), 3)
+        self.assertEqual(await self.sc.find_row_by_uid(400), 5)
+        self.assertEqual(await self.sc.find_row_by_uid(500), 2)
+        self.assertIsNone(await self.sc.find_row_by_uid(100))
+        self.assertEqual((await self.sc.rows())[3][:1], ["Kuznetsova Olga"])
+        self.assertEqual(self.google.methods().count(("GET", "Sheet1%21A2%3AK")), 1)
+
+    async def test_name_index_follows_appends_without_rebuild(self):
+        self.google.responses["Sheet1%21A%3AK:append"] = {"updates": {"updatedRange": "Sheet1!A5:K5"}}
+        names = await self.sc.name_index()
+
+        await self.sc.append_start_user("Kuznetsova Olga", "", 400)
+
+        self.assertIs(await self.sc.name_index(), names)
+        self.assertEqual(await self.sc.find_rows_by_surname("kuznetsova"), [5])
+        self.assertEqual(await self.sc.find_row_by_surname_name("Ivanova", ""), 2)
+
+    async def test_rows_and_names_come_from_one_snapshot(self):
+        _rows, names = await self.sc.rows_with_names()
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [["Orlova"]]}
+        self.sc.invalidate()
+
+        rows, fresh_names = await self.sc.rows_with_names()
+
+        self.assertIsNot(fresh_names, names)
+        self.assertEqual(rows, [["Orlova"]])
+        self.assertEqual(fresh_names.rows_by_surname("orlova"), [2])
+        self.assertEqual(fresh_names.rows_by_surname("petrova"), [])
+
+    async def test_bulk_append_is_one_call_and_indexes_every_row(self):
+        await self.sc.rows()
+        self.google.responses["Sheet1%21A%3AK:append"] = {"updates": {"updatedRange": "Sheet1!A5:K7"}}
+
+        rows = await self.sc.append_rows([
+            sheets.start_user_row("Kuznetsova Olga", "12.06", 400),
+            sheets.start_user_row("Orlova Anna", "", 401),
+            sheets.start_user_row("Belova Irina", "", 402),
+        ])
+
+        self.assertEqual(rows, [5, 6, 7])
+        self.assertEqual(self.google.methods().count(("POST", "Sheet1%21A%3AK:append")), 1)
+        self.assertEqual(len(self.google.calls[-1][3]["values"]), 3)
+        self.assertEqual(await self.sc.find_row_by_uid(402), 7)
+        self.assertEqual(await self.sc.find_rows_by_surname("orlova"), [6])
+        self.assertEqual(await self.sc.append_rows([]), [])
+        self.assertEqual(self.google.methods().count(("GET", "Sheet1%21A2%3AK")), 1)
+
+    async def test_append_above_a_blank_row_drops_shifted_snapshot(self):
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [
+            ["Ivanova"], ["Sidorova"], [], ["Petrova", "", "", "", "", "", "", "", "", "555"],
+        ]}
+        await self.sc.rows()
+        self.assertEqual(await self.sc.find_row_by_uid(555), 5)
+        # The detected table ends at the blank row 4, so the new row is inserted there.
+        self.google.responses["Sheet1%21A%3AK:append"] = {"updates": {"updatedRange": "Sheet1!A4:K4"}}
+
+        self.assertEqual(await self.sc.append_start_user("Kuznetsova Olga", "", 400), 4)
+
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [
+            ["Ivanova"], ["Sidorova"], ["Kuznetsova Olga", "", "", "", "", "", "", "", "", "400"], [],
+            ["Petrova", "", "", "", "", "", "", "", "", "555"],
+        ]}
+        self.google.responses["values:batchGet"] = {"valueRanges": [
+            {"values": [["", "", "400", "", "555"]]},
+        ]}
+        self.assertEqual(await self.sc.find_row_by_uid(555), 6)
+
+    async def test_duplicate_uids_are_flagged(self):
+        self.google.responses["values:batchGet"]["valueRanges"][0]["values"] = [["100", "100", "'200.0"]]
+
+        self.assertEqual(await self.sc.find_row_by_uid(100), 2)
+        self.assertEqual(self.sc.duplicate_uids(), {"100": [2, 3]})
+
+
+class SheetsRowsCacheTests(SheetsClientTestCase):
+    async def test_own_writes_are_read_back_without_refetch(self):
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [["Ivanova", "80"]]}
+        await self.sc.rows()
+
+        self.sc.write(2, "B", 79.5)
+        self.sc.write(2, "D", "+")
+        await self.sc.flush()
+        rows = await self.sc.rows()
+
+        self.assertEqual(rows[0], ["Ivanova", "79.5", "", "+"])
+        self.assertEqual(self.google.methods().count(("GET", "Sheet1%21A2%3AK")), 1)
+        self.assertEqual(
+            self.sc.cache_stats(),
+            {"hits": 1, "misses": 1, "patches": 2, "probes": 1, "revalidated": 0, "column_fetches": 0},
+        )
+
+    async def test_refetch_after_ttl_or_invalidate(self):
+        sc = sheets.Sheets("sid", "Sheet1", rows_cache_ttl=0)
+        with patch.object(sc, "_send", self.google.send):
+            await sc.rows()
+            await sc.rows()
+        self.assertEqual(sc.cache_stats()["misses"], 2)
+
+        await self.sc.rows()
+        self.sc.invalidate()
+        await self.sc.rows()
+        self.assertEqual(self.sc.cache_stats()["misses"], 2)
+
+    async def test_unchanged_file_is_revalidated_without_refetch(self):
+        self.google.responses["files/sid"] = {"modifiedTime": "2026-05-10T09:00:00.000Z"}
+        await self.sc.rows()
+        self.sc.invalidate()
+        await self.sc.rows()
+        self.sc.invalidate()
+        await self.sc.rows()
+
+        # The first full read records modifiedTime too, so both later reads revalidate.
+        self.assertEqual(self.google.methods().count(("GET", "Sheet1%21A2%3AK")), 1)
+        self.assertEqual(self.google.calls[0][2], {"fields": "modifiedTime", "supportsAllDrives": "true"})
+        stats = self.sc.cache_stats()
+        self.assertEqual((stats["probes"], stats["revalidated"]), (3, 2))
+
+        self.google.responses["files/sid"] = {"modifiedTime": "2026-05-10T09:05:00.000Z"}
+        self.sc.invalidate()
+        await self.sc.rows()
+        self.assertEqual(self.google.methods().count(("GET", "Sheet1%21A2%3AK")), 2)
+
+    async def test_first_read_waits_for_the_probe_before_fetching(self):
+        self.google.responses["files/sid"] = {"modifiedTime": "2026-05-10T09:00:00.000Z"}
+        release = asyncio.Event()
+        send = self.google.send
+
+        async def slow_probe(method, url, *args, **kwargs):
+            if url.startswith(sheets.DRIVE_FILES_API):
+                await release.wait()
+            return await send(method, url, *args, **kwargs)
+
+        with patch.object(self.sc, "_send", slow_probe):
+            fetch = asyncio.create_task(self.sc.rows())
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.google.calls, [])
+            release.set()
+            await fetch
+
+        self.assertEqual(self.google.methods(), [("GET", "sid"), ("GET", "Sheet1%21A2%3AK")])
+
+    async def test_snapshot_is_refetched_past_max_age(self):
+        self.google.responses["files/sid"] = {"modifiedTime": "2026-05-10T09:00:00.000Z"}
+        await self.sc.rows()
+        self.sc.invalidate()
+        await self.sc.rows()
+
+        with patch.object(sheets, "ROWS_CACHE_MAX_AGE", 0):
+            self.sc.invalidate()
+            await self.sc.rows()
+
+        self.assertEqual(self.google.methods().count(("GET", "Sheet1%21A2%3AK")), 2)
+        self.assertEqual(self.sc.cache_stats()["probes"], 3)
+
+    async def test_probe_is_disabled_when_drive_refuses(self):
+        await self.sc.rows()
+        self.google.statuses = [403]
+        self.sc.invalidate()
+        await self.sc.rows()
+        self.sc.invalidate()
+        await self.sc.rows()
+
+        self.assertEqual(self.sc.cache_stats()["probes"], 2)
+        self.assertEqual(self.google.methods().count(("GET", "Sheet1%21A2%3AK")), 3)
+
+
+class SheetsColumnsTests(SheetsClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.google.responses["values:batchGet"] = {"valueRanges": [
+            {"range": "Sheet1!F2:F1000", "majorDimension": "COLUMNS", "values": [["+", "", "-"]]},
+            {"range": "Sheet1!J2:J1000", "majorDimension": "COLUMNS"},
+        ]}
+
+    async def test_only_requested_columns_are_fetched_in_one_call(self):
+        columns = await self.sc.columns("f", "J", "F")
+
+        self.assertEqual(columns, {"F": ["+", "", "-"], "J": []})
+        self.assertEqual(self.google.methods(), [("GET", "values:batchGet")])
+        self.assertEqual(self.google.calls[0][2], [
+            ("ranges", "Sheet1!F2:F"),
+            ("ranges", "Sheet1!J2:J"),
+            ("majorDimension", "COLUMNS"),
+        ])
+
+        self.sc.write(5, "J", 300)
+        self.sc.write(3, "F", "+")
+        self.assertEqual(await self.sc.columns("F", "J"), {"F": ["+", "+", "-"], "J": ["", "", "", "300"]})
+        self.assertEqual(await self.sc.find_row_by_uid(300), 5)
+        self.assertEqual(self.google.methods().count(("GET", "values:batchGet")), 1)
+
+    async def test_fresh_rows_snapshot_serves_columns(self):
+        self.google.responses["Sheet1%21A2%3AK"] = {"values": [
+            ["Ivanova", "", "", "", "", "+", "", "", "", "100"],
+            ["Petrova"],
+        ]}
+        await self.sc.rows()
+
+        self.assertEqual(await self.sc.columns("F", "J"), {"F": ["+"], "J": ["100"]})
+        self.assertNotIn(("GET", "values:batchGet"), self.google.methods())
+
+    def test_rows_from_columns_rebuilds_positions(self):
+        rows = sheets.rows_from_columns({"F": ["+", "", "-"], "J": ["100", "200"]})
+
+        self.assertEqual(rows[0][5], "+")
+        self.assertEqual(rows[1][9], "200")
+        self.assertEqual(rows[2][5:], ["-", "", "", "", ""])
+
+
+class SheetsBulkheadTests(SheetsClientTestCase):
+    async def test_saturated_spreadsheet_does_not_block_another(self):
+        release = asyncio.Event()
+
+        async def stuck_send(method, url, params, body, raw, force_refresh=False):
+            await release.wait()
+            return 200, {}
+
+        slow = sheets.Sheets("slow-sid", "Sheet1")
+        with patch.object(sheets, "SHEETS_MAX_IN_FLIGHT", 2), patch.object(slow, "_send", stuck_send):
+            slow.bulkhead = sheets.Bulkhead("slow-sid")
+            stuck = [asyncio.create_task(slow.get_cell(f"A{n}")) for n in range(5)]
+            await asyncio.sleep(0)
+
+            self.assertEqual(await asyncio.wait_for(self.sc.get_cell("A1"), 1), "")
+            self.assertEqual(slow.bulkhead.stats()["in_flight"], 2)
+            self.assertEqual(slow.bulkhead.stats()["queued"], 3)
+
+            release.set()
+            await asyncio.gather(*stuck)
+
+        stats = slow.bulkhead.stats()
+        self.assertEqual((stats["calls"], stats["queued"], stats["max_queued"]), (5, 0, 3))
+        self.assertGreater(stats["wait_max"], 0)
+
+    async def test_full_queue_rejects_instead_of_piling_up(self):
+        release = asyncio.Event()
+
+        async def stuck_send(method, url, params, body, raw, force_refresh=False):
+            await release.wait()
+            return 200, {}
+
+        with patch.object(sheets, "SHEETS_MAX_IN_FLIGHT", 1), patch.object(sheets, "SHEETS_MAX_QUEUED", 1):
+            self.sc.bulkhead = sheets.Bulkhead("sid")
+            with patch.object(self.sc, "_send", stuck_send):
+                first = asyncio.create_task(self.sc.get_cell("A1"))
+                second = asyncio.create_task(self.sc.get_cell("A2"))
+                await asyncio.sleep(0)
+
+                with self.assertRaises(sheets.SheetsBusyError):
+                    await self.sc.get_cell("A3")
+
+                release.set()
+                await asyncio.gather(first, second)
+
+        self.assertEqual(self.sc.bulkhead.stats()["rejected"], 1)
+
+
+class SheetFormatBatchTests(SheetsClientTestCase):
+    async def test_report_painting_is_one_batch_update(self):
+        async with self.sc.formatting() as fmt:
+            fmt.paint_row(2, sheets.GREEN)
+            fmt.paint_row(3, sheets.GREEN)
+            fmt.paint_row(4, sheets.RED)
+            fmt.paint_cell(5, "F", sheets.RED)
+            fmt.clear_row_background(6)
+
+        # The sheet id is resolved once, then one batchUpdate carries everything.
+        self.assertEqual(self.google.methods(), [("GET", "sid"), ("POST", "sid:batchUpdate")])
+        requests = self.google.calls[1][3]["requests"]
+        ranges = [
+            (r["repeatCell"]["range"]["startRowIndex"], r["repeatCell"]["range"]["endRowIndex"])
+            for r in requests
+        ]
+        # Rows 2 and 3 share a colour and are merged into one range.
+        self.assertEqual(ranges, [(1, 3), (3, 4), (4, 5), (5, 6)])
+        self.assertEqual(requests[0]["repeatCell"]["range"]["sheetId"], 7)
+        self.assertEqual(requests[2]["repeatCell"]["range"]["startColumnIndex"], 5)
+        self.assertEqual(requests[3]["repeatCell"]["cell"], {"userEnteredFormat": {}})
+
+    async def test_large_batches_are_chunked(self):
+        with patch.object(sheets, "FORMAT_BATCH_MAX_REQUESTS", 2):
+            async with self.sc.formatting() as fmt:
+                for row in range(2, 12, 2):
+                    fmt.paint_row(row, sheets.RED)
+
+        self.assertEqual(self.google.methods().count(("POST", "sid:batchUpdate")), 3)
+
+    async def test_nothing_is_sent_when_block_fails(self):
+        with self.assertRaises(ValueError):
+            async with self.sc.formatting() as fmt:
+                fmt.paint_row(2, sheets.RED)
+                raise ValueError
+
+        self.assertNotIn(("POST", "sid:batchUpdate"), self.google.methods())
+
+
+class SheetsMetadataTests(SheetsClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.google.responses["/sid"] = {"sheets": [
+            {"properties": {"title": "Other", "sheetId": 3, "gridProperties": {"rowCount": 10, "columnCount": 5}}},
+            {"properties": {"title": "Sheet1", "sheetId": 7, "gridProperties": {"rowCount": 1000, "columnCount": 26}}},
+        ]}
+
+    async def test_sheet_id_is_fetched_with_field_mask_and_saved(self):
+        self.assertEqual(await self.sc.get_sheet_id(), 7)
+
+        self.assertEqual(self.google.calls[0][2], {"fields": sheets.SHEET_PROPERTIES_FIELDS})
+        self.assertEqual(self.sc.grid_size, (1000, 26))
+        with open(self.meta_path, encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["sid"][1], {"sheetId": 7, "title": "Sheet1", "rowCount": 1000, "columnCount": 26})
+
+    async def test_restarted_client_reuses_saved_metadata(self):
+        await self.sc.get_sheet_id()
+        restarted = sheets.Sheets("sid", "Sheet1")
+        with patch.object(restarted, "_send", self.google.send):
+            async with restarted.formatting() as fmt:
+                fmt.paint_row(2, sheets.GREEN)
+
+        self.assertEqual(self.google.methods(), [("GET", "sid"), ("POST", "sid:batchUpdate")])
+        self.assertEqual(self.google.calls[1][3]["requests"][0]["repeatCell"]["range"]["sheetId"], 7)
+
+    async def test_stale_saved_sheet_id_is_refreshed_once(self):
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump({"sid": [{"sheetId": 99, "title": "Sheet1", "rowCount": 10, "columnCount": 11}]}, f)
+        self.google.statuses = [400]
+
+        async with self.sc.formatting() as fmt:
+            fmt.paint_row(2, sheets.RED)
+
+        self.assertEqual(
+            self.google.methods(),
+            [("POST", "sid:batchUpdate"), ("GET", "sid"), ("POST", "sid:batchUpdate")],
+        )
+        self.assertEqual(self.google.calls[2][3]["requests"][0]["repeatCell"]["range"]["sheetId"], 7)
+
+        self.google.statuses = [400]
+        with self.assertRaises(sheets.GoogleApiError):
+            await self.sc.paint_row(3, sheets.RED)
+
+
+class FakeCredentials:
+    def __init__(self, expires_in: float):
+        self.token = "old"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=expires_in)
+        self.refresh_threads = []
+        self.release = threading.Event()
+        self.release.set()
+
+    @property
+    def valid(self):
+        return self.token is not None and self.expiry > datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def refresh(self, _request):
+        self.refresh_threads.append(threading.current_thread().name)
+        self.release.wait(1)
+        self.token = "new"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+
+
+class ServiceAccountTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        p = patch.dict(sheets._accounts, clear=True)
+        p.start()
+        self.addCleanup(p.stop)
+        p = patch.object(sheets, "AuthRequest", lambda: None)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_all_groups_share_one_account(self):
+        first = sheets.Sheets("sid-1", "Sheet1")
+        second = sheets.Sheets("sid-2", "Лист1")
+
+        self.assertIs(first.account, second.account)
+
+    async def test_token_is_refreshed_in_background_before_expiry(self):
+        account = sheets._account_for("sa.json")
+        account.creds = FakeCredentials(expires_in=60)
+        account.creds.release.clear()
+
+        # The current token is still good: handed out at once, refresh runs alongside.
+        self.assertEqual(await account.token(), "old")
+        self.assertEqual(await account.token(), "old")
+        account.creds.release.set()
+        await account._refresh_task
+
+        self.assertEqual(await account.token(), "new")
+        self.assertEqual(account.refreshes, 1)
+        self.assertNotIn(threading.current_thread().name, account.creds.refresh_threads)
+
+    async def test_expired_token_is_refreshed_once_for_concurrent_callers(self):
+        account = sheets._account_for("sa.json")
+        account.creds = FakeCredentials(expires_in=-1)
+
+        tokens = await asyncio.gather(*(account.token() for _ in range(5)))
+
+        self.assertEqual(tokens, ["new"] * 5)
+        self.assertEqual(len(account.creds.refresh_threads), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,5 @@
+import asyncio
+import json
 import os
 import tempfile
 from datetime import date
@@ -35,3 +37,250 @@ class StateTests(TestCase):
                 self.assertEqual(state.cleanup_expired_manual_green(1, date(2026, 5, 15)), [])
                 self.assertEqual(state.cleanup_expired_manual_green(1, date(2026, 5, 16)), [100])
                 self.assertFalse(state.is_manual_green_today(1, 100, date(2026, 5, 16)))
+                state.close()
+
+    def test_mutations_are_flushed_atomically_after_delay(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path), patch("src.state.FLUSH_DELAY", 60):
+                state.save_mention(1, 100, "@first")
+                state.mark_active(1, 100)
+                self.assertFalse(os.path.exists(path))
+                self.assertEqual(state.get_sets(1)[2], {"100": "@first"})
+
+                state.flush()
+                self.assertEqual(os.listdir(tmp), ["state.json.journal"])
+                state.close()
+
+                excused, active, mentions, _until = state.get_sets(1)
+                self.assertEqual(active, {100})
+                self.assertEqual(mentions, {"100": "@first"})
+                state.close()
+
+    def test_journal_is_replayed_on_top_of_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path):
+                state.save_mention(1, 100, "@first")
+                state.flush()
+                state._current_store().backend.compact(state._load_all())
+                state.mark_excused(1, 200)
+                state.close()
+
+                with open(path, encoding="utf-8") as f:
+                    snapshot = json.load(f)
+                self.assertEqual(snapshot["1"]["excused"], [])
+                with open(path + ".journal", encoding="utf-8") as f:
+                    self.assertEqual(f.read(), '["put","1","excused","200",null]\n')
+
+                excused, _active, mentions, _until = state.get_sets(1)
+                self.assertEqual(excused, {200})
+                self.assertEqual(mentions, {"100": "@first"})
+                state.close()
+
+    def test_journal_is_compacted_past_size_threshold(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path), patch("src.state.JOURNAL_MAX_BYTES", 64):
+                state.save_user(1, 100, "tester", "Test User With A Long Name")
+                state.flush()
+
+                self.assertEqual(os.path.getsize(path + ".journal"), 0)
+                with open(path, encoding="utf-8") as f:
+                    self.assertEqual(json.load(f)["1"]["users"]["100"]["username"], "tester")
+                state.close()
+
+    def test_sharded_write_touches_only_its_chat(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            shards = os.path.join(tmp, "state.d")
+            with patch("src.state.STATE_BACKEND", "sharded"), \
+                    patch("src.state.STATE_SHARDS_DIR", shards), \
+                    patch("src.state.STATE_PATH", os.path.join(tmp, "state.json")), \
+                    patch("src.state.JOURNAL_MAX_BYTES", 64):
+                for uid in range(50):
+                    state.save_user(-100, uid, f"user{uid}", "Big Group Member")
+                state.flush()
+                big_group = os.path.join(shards, "-100.json")
+                big_group_stat = os.stat(big_group)
+
+                state.save_user(-200, 1, "solo", "Small Group Member")
+                state.flush()
+
+                self.assertEqual(os.stat(big_group).st_mtime_ns, big_group_stat.st_mtime_ns)
+                with open(os.path.join(shards, "-200.json"), encoding="utf-8") as f:
+                    self.assertEqual(list(json.load(f)), ["-200"])
+                state.close()
+
+                self.assertEqual(len(state.get_users(-100)), 50)
+                self.assertEqual(state.get_users(-200), {"1": {"username": "solo", "full_name": "Small Group Member"}})
+                state.close()
+
+    def test_combined_state_is_split_on_first_sharded_open(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            shards = os.path.join(tmp, "state.d")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"-100": {"active": [1]}, "-200": {"mentions": {"2": "@two"}}}, f)
+            with open(path + ".journal", "w", encoding="utf-8") as f:
+                f.write(json.dumps(["put", "-100", "active", "3", None]) + "\n")
+
+            with patch("src.state.STATE_BACKEND", "sharded"), \
+                    patch("src.state.STATE_SHARDS_DIR", shards), \
+                    patch("src.state.STATE_PATH", path):
+                self.assertEqual(state.get_sets(-100)[1], {1, 3})
+                self.assertEqual(state.get_sets(-200)[2], {"2": "@two"})
+                self.assertEqual(sorted(os.listdir(shards)), ["-100.json", "-200.json"])
+                state.close()
+
+    def test_torn_journal_tail_is_dropped(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with open(path + ".journal", "w", encoding="utf-8") as f:
+                f.write('["put","1","active","100",null]\n["put","1","act')
+
+            with patch("src.state.STATE_PATH", path):
+                self.assertEqual(state.get_sets(1)[1], {100})
+                state.mark_active(1, 200)
+                state.close()
+
+                self.assertEqual(state.get_sets(1)[1], {100, 200})
+                state.close()
+
+    def test_corrupt_snapshot_is_kept_aside(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write('{"1": {"active": [1')
+
+            with patch("src.state.STATE_PATH", path):
+                self.assertEqual(state.get_sets(1)[1], set())
+                state.close()
+
+            self.assertTrue(any(name.startswith("state.json.corrupt-") for name in os.listdir(tmp)))
+
+    def test_transaction_records_changes_once_on_exit(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path), patch("src.state.FLUSH_DELAY", 60):
+                store = state._current_store()
+                with patch.object(store, "record", wraps=store.record) as record:
+                    with state.transaction(1) as tx:
+                        tx.save_mention(100, "@first")
+                        tx.save_user(100, "first", "First User")
+                        tx.set_excused_until(100, "2026-05-20")
+                        with tx:
+                            tx.mark_active(100)
+                        self.assertEqual(state.get_sets(1)[1], {100})
+                        record.assert_not_called()
+
+                record.assert_called_once()
+                self.assertEqual(len(record.call_args.args[0]), 5)
+                self.assertEqual(state.get_sets(1)[3], {})
+                state.close()
+
+    def test_unchanged_user_and_mention_are_not_rewritten(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path), patch("src.state.FLUSH_DELAY", 60):
+                state.save_mention(1, 100, "@first")
+                state.save_user(1, 100, "first", "First User")
+                state.flush()
+                before = state.get_write_stats()
+
+                state.save_mention(1, 100, "@first")
+                state.save_user(1, 100, " first ", "First User")
+                state.flush()
+
+                after = state.get_write_stats()
+                self.assertEqual(after["elided_writes"] - before["elided_writes"], 2)
+                self.assertEqual(after["changes"], before["changes"])
+                self.assertEqual(after["flushes"], before["flushes"])
+
+                state.save_user(1, 100, "first", "Renamed User")
+                self.assertEqual(state.get_users(1)["100"]["full_name"], "Renamed User")
+                self.assertEqual(state.get_write_stats()["changes"], after["changes"] + 1)
+                state.close()
+
+    def test_expiry_index_pops_only_due_entries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path), patch("src.state.FLUSH_DELAY", 60):
+                state.set_manual_green(1, 100, "2026-05-10")
+                state.set_manual_green(1, 200, "2026-05-20")
+                state.set_manual_green(1, 300, "")
+                state.set_manual_green(1, 400, "someday")
+                self.assertEqual(state.cleanup_expired_manual_green(1, date(2026, 5, 1)), [400])
+
+                # Moving a date after the index is built must not expire the old one.
+                state.set_manual_green(1, 100, "2026-06-01")
+                state.set_manual_green(1, 500, "2026-05-11")
+                self.assertEqual(state.cleanup_expired_manual_green(1, date(2026, 5, 15)), [500])
+                self.assertEqual(set(state.get_manual_green(1)), {"100", "200", "300"})
+
+                state.flush()
+                with open(path + ".journal", encoding="utf-8") as f:
+                    lines = [json.loads(line) for line in f]
+                self.assertIn(["del", "1", "manual_green", "400", None], lines)
+                self.assertEqual(lines[-1], ["expire", "1", "manual_green", None, "2026-05-15"])
+                state.close()
+
+                self.assertEqual(set(state.get_manual_green(1)), {"100", "200", "300"})
+                state.close()
+
+    def test_excused_until_cleanup_uses_given_day(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path):
+                state.set_excused_until(1, 100, "2026-05-10")
+                state.set_excused_until(1, 200, "2026-05-12")
+                state.cleanup_expired_excused_until(1, date(2026, 5, 11))
+
+                self.assertEqual(state.get_sets(1)[3], {"200": "2026-05-12"})
+                state.close()
+
+    def test_empty_excused_until_stays_deleted_after_reload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path):
+                state.set_excused_until(1, 100, "")
+                state.set_excused_until(1, 200, "2026-05-12")
+                state.cleanup_expired_excused_until(1, date(2026, 5, 11))
+                state.close()
+
+                self.assertEqual(state.get_sets(1)[3], {"200": "2026-05-12"})
+                state.close()
+
+    def test_event_loop_keeps_running_while_large_state_is_flushed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "state.json")
+            with patch("src.state.STATE_PATH", path), \
+                    patch("src.state.FLUSH_DELAY", 0.01), \
+                    patch("src.state.JOURNAL_MAX_BYTES", 1):
+                group = state._get_group(state._load_all(), 1)
+                for uid in range(200_000):
+                    group["users"][str(uid)] = {"username": f"user{uid}", "full_name": f"User Number {uid}"}
+
+                async def measure() -> tuple[float, float, int]:
+                    loop = asyncio.get_running_loop()
+                    started = loop.time()
+                    flushes = state.get_write_stats()["flushes"]
+                    state.mark_active(1, 1)
+
+                    max_lag = 0.0
+                    ticks = 0
+                    while state.get_write_stats()["flushes"] == flushes and loop.time() - started < 60:
+                        before = loop.time()
+                        await asyncio.sleep(0.001)
+                        max_lag = max(max_lag, loop.time() - before - 0.001)
+                        state.save_mention(1, ticks, f"@u{ticks}")
+                        ticks += 1
+                    return loop.time() - started, max_lag, ticks
+
+                flush_time, max_lag, ticks = asyncio.run(measure())
+                state.close()
+
+                with open(path, encoding="utf-8") as f:
+                    self.assertEqual(len(json.load(f)["1"]["users"]), 200_000)
+                self.assertGreater(flush_time, 0.2)
+                self.assertGreater(ticks, 10)
+                self.assertLess(max_lag, 0.1)
@@ -0,0 +1,110 @@
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, r"C:\NutritionBot\src")
+
+import state
+
+PROCESSES = 4
+USERS_PER_PROCESS = 150
+
+
+def _hammer(state_path: str, worker: int):
+    state.STATE_PATH = state_path
+    state.STATE_SHARED = True
+    # Small enough that workers compact under each other's feet.
+    state.JOURNAL_MAX_BYTES = 4096
+    for i in range(USERS_PER_PROCESS):
+        uid = worker * 10000 + i
+        state.mark_active(1, uid)
+        state.save_user(1, uid, f"user{uid}", f"User {uid}")
+    state.close()
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "shared state needs fcntl and fork")
+class SharedStateTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state_path = os.path.join(self.tmp.name, "state.json")
+        self.patches = [
+            patch.object(state, "STATE_PATH", self.state_path),
+            patch.object(state, "STATE_BACKEND", "json"),
+            patch.object(state, "STATE_SHARED", True),
+        ]
+        state.close()
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        state.close()
+        for p in reversed(self.patches):
+            p.stop()
+        self.tmp.cleanup()
+
+    def test_concurrent_writers_lose_nothing(self):
+        ctx = multiprocessing.get_context("fork")
+        workers = [ctx.Process(target=_hammer, args=(self.state_path, n)) for n in range(PROCESSES)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join(60)
+            self.assertEqual(w.exitcode, 0)
+
+        expected = {n * 10000 + i for n in range(PROCESSES) for i in range(USERS_PER_PROCESS)}
+        _excused, active, _mentions, _until = state.get_sets(1)
+        self.assertEqual(active, expected)
+        self.assertEqual({int(uid) for uid in state.get_users(1)}, expected)
+
+    def test_reader_sees_other_process_commits(self):
+        self.assertEqual(state.get_sets(1)[1], set())
+
+        ctx = multiprocessing.get_context("fork")
+        worker = ctx.Process(target=_hammer, args=(self.state_path, 1))
+        worker.start()
+        worker.join(60)
+        self.assertEqual(worker.exitcode, 0)
+
+        self.assertEqual(len(state.get_sets(1)[1]), USERS_PER_PROCESS)
+
+    def test_transaction_sees_group_reloaded_mid_block(self):
+        state.mark_active(1, 1)
+
+        with state.transaction(1) as tx:
+            # What a sync() does during an await after another process set the
+            # green mark and compacted: the group is replaced by the one on disk.
+            store = state._store
+            with state._lock:
+                reloaded = state._copy_state({"1": store.data["1"]})["1"]
+                reloaded["manual_green"]["7"] = {"until": ""}
+                store.data["1"] = reloaded
+            tx.remove_manual_green(7)
+        state.flush()
+
+        self.assertEqual(state.get_manual_green(1), {})
+
+    def test_commit_is_written_by_the_writer_thread(self):
+        state.mark_active(1, 1)
+        store = state._store
+        written = threading.Event()
+        threads = []
+        write = store.backend.write
+
+        def recording_write(changes, snapshot):
+            threads.append(threading.current_thread().name)
+            write(changes, snapshot)
+            written.set()
+
+        with patch.object(store.backend, "write", recording_write), patch.object(state, "FLUSH_DELAY", 0.01):
+            state.mark_active(1, 2)
+            self.assertTrue(written.wait(5))
+
+        self.assertEqual(threads, ["state-writer"])
+        self.assertEqual(state.get_sets(1)[1], {1, 2})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from datetime import date
+from unittest.mock import patch
+
+sys.path.insert(0, r"C:\NutritionBot\src")
+
+import state
+import state_sqlite
+from state_sqlite import SqliteBackend, migrate_json_state
+
+
+class SqliteStateTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.json_path = os.path.join(self.tmp.name, "state.json")
+        self.db_path = os.path.join(self.tmp.name, "state.sqlite3")
+        self.patches = [
+            patch.object(state, "STATE_PATH", self.json_path),
+            patch.object(state, "STATE_DB_PATH", self.db_path),
+            patch.object(state, "STATE_BACKEND", "sqlite"),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        state.close()
+        for p in reversed(self.patches):
+            p.stop()
+        self.tmp.cleanup()
+
+    def test_mutations_survive_reopen(self):
+        state.save_user(1, 100, "tester", "Test User")
+        state.save_mention(1, 100, "@tester")
+        state.mark_excused(1, 200)
+        state.mark_active(1, 200)
+        state.set_excused_until(1, 300, "2026-05-20")
+        state.save_start_candidate(1, 400, "Ivanova Anna", "2026-05-11", "raw", "2026-05-09T10:00:00")
+        state.mark_start_candidate_imported(1, 400, "2026-05-09T11:00:00")
+        state.set_manual_green(2, 500, "")
+        state.close()
+
+        excused, active, mentions, excused_until = state.get_sets(1)
+        self.assertEqual(excused, set())
+        self.assertEqual(active, {200})
+        self.assertEqual(mentions, {"100": "@tester"})
+        self.assertEqual(excused_until, {"300": "2026-05-20"})
+        self.assertEqual(state.get_users(1)["100"], {"username": "tester", "full_name": "Test User"})
+        self.assertEqual(state.get_start_candidates(1)["400"]["imported_at"], "2026-05-09T11:00:00")
+        self.assertEqual(state.get_manual_green(2), {"500": {"until": ""}})
+
+    def test_cleanup_deletes_only_expired_rows(self):
+        state.set_manual_green(1, 100, "2026-05-15")
+        state.set_manual_green(1, 200, "2026-05-20")
+        state.set_manual_green(1, 300, "")
+        state.flush()
+
+        self.assertEqual(state.cleanup_expired_manual_green(1, date(2026, 5, 16)), [100])
+        state.close()
+
+        self.assertEqual(set(state.get_manual_green(1)), {"200", "300"})
+
+    def test_empty_excused_until_is_deleted_for_good(self):
+        state.set_excused_until(1, 100, "")
+        state.cleanup_expired_excused_until(1, date(2026, 5, 16))
+        state.close()
+
+        self.assertEqual(state.get_sets(1)[3], {})
+
+    def test_expire_delete_uses_date_index(self):
+        state.set_excused_until(1, 100, "2026-05-15")
+        state.flush()
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            plan = conn.execute(
+                "EXPLAIN QUERY PLAN DELETE FROM excused_until "
+                "WHERE chat_id = ? AND until_date != '' AND until_date < ?",
+                ("1", "2026-05-16"),
+            ).fetchall()
+        finally:
+            conn.close()
+
+        self.assertIn("idx_excused_until_date", " ".join(str(row) for row in plan))
+
+    def test_json_state_is_migrated_on_first_open(self):
+        with open(self.json_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "-100": {
+                    "active": [1, 2],
+                    "excused": [],
+                    "mentions": {"1": "@one"},
+                    "excused_until": {},
+                    "users": {"2": {"username": "two", "full_name": "Two"}},
+                    "start_candidates": {},
+                    "manual_green": {"1": {"until": "2026-06-01"}},
+                },
+            }, f)
+
+        _excused, active, mentions, _until = state.get_sets(-100)
+
+        self.assertEqual(active, {1, 2})
+        self.assertEqual(mentions, {"1": "@one"})
+        self.assertEqual(state.get_manual_green(-100), {"1": {"until": "2026-06-01"}})
+        self.assertTrue(os.path.exists(self.db_path))
+
+    def test_migrator_counts_rows(self):
+        with open(self.json_path, "w", encoding="utf-8") as f:
+            json.dump({"5": {"active": [1], "mentions": {"1": "@one", "2": "@two"}}}, f)
+
+        other_db = os.path.join(self.tmp.name, "other.sqlite3")
+        self.assertEqual(migrate_json_state(self.json_path, other_db), 3)
+
+
+class SharedSqlitePollTests(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.db_path = os.path.join(tmp.name, "state.sqlite3")
+        self.reader = self.open_backend()
+        self.writer = self.open_backend()
+        self.reader.load()
+
+    def open_backend(self) -> SqliteBackend:
+        backend = SqliteBackend(self.db_path, shared=True)
+        self.addCleanup(backend.close)
+        return backend
+
+    def test_poll_rereads_only_rows_other_processes_touched(self):
+        self.writer.write([
+            ["put", "1", "mentions", "100", "@old"],
+            ["put", "1", "active", "200", None],
+            ["put", "1", "mentions", "100", "@new"],
+            ["put", "1", "manual_green", "300", {"until": "2026-05-20"}],
+            ["expire", "1", "excused_until", None, "2026-05-16"],
+            ["del", "1", "active", "200", None],
+        ])
+        self.reader.write([["put", "1", "users", "400", {"username": "own", "full_name": "Own"}]])
+
+        reloaded, changes = self.reader.poll()
+
+        self.assertIsNone(reloaded)
+        self.assertEqual(changes, [
+            ["put", "1", "mentions", "100", "@new"],
+            ["put", "1", "manual_green", "300", {"until": "2026-05-20"}],
+            ["expire", "1", "excused_until", None, "2026-05-16"],
+            ["del", "1", "active", "200", None],
+        ])
+        self.assertEqual(self.reader.poll(), (None, []))
+
+    def test_reader_behind_the_pruned_log_reloads_everything(self):
+        with patch.object(state_sqlite, "CHANGES_KEEP", 1):
+            for uid in ("1", "2", "3"):
+                self.writer.write([["put", "1", "active", uid, None]])
+
+        reloaded, changes = self.reader.poll()
+
+        self.assertEqual(sorted(reloaded["1"]["active"]), [1, 2, 3])
+        self.assertEqual(changes, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
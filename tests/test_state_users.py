@@ -19,8 +19,10 @@ class StateUsersTests(unittest.TestCase):
                 state.save_user(123, 456789, "tester", "Test User")
                 users = state.get_users(123)
         finally:
-            if os.path.exists(state_path):
-                os.remove(state_path)
+            state.close()
+            for path in (state_path, state_path + ".journal"):
+                if os.path.exists(path):
+                    os.remove(path)
 
         self.assertEqual(users["456789"]["username"], "tester")
         self.assertEqual(users["456789"]["full_name"], "Test User")
@@ -35,8 +37,10 @@ class StateUsersTests(unittest.TestCase):
                 state.save_mention(123, 999888, "@fallback")
                 users = state.get_users(123)
         finally:
-            if os.path.exists(state_path):
-                os.remove(state_path)
+            state.close()
+            for path in (state_path, state_path + ".journal"):
+                if os.path.exists(path):
+                    os.remove(path)
 
         self.assertIn("999888", users)
 
@@ -58,8 +62,10 @@ class StateUsersTests(unittest.TestCase):
                 state.mark_start_candidate_imported(123, 456789, "2026-05-09T16:00:00+03:00")
                 candidates = state.get_start_candidates(123)
         finally:
-            if os.path.exists(state_path):
-                os.remove(state_path)
+            state.close()
+            for path in (state_path, state_path + ".journal"):
+                if os.path.exists(path):
+                    os.remove(path)
 
         self.assertEqual(candidates["456789"]["full_name"], "Самохина Елена")
         self.assertEqual(candidates["456789"]["start_date"], "2026-05-11")